@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks
+    ~~~~~~~~~~
+
+    Load tests for the ILog WSGI application.
+
+    `benchmarks.fixtures` creates a throwaway instance with a synthetic
+    database, `benchmarks.runner` drives the application through the
+    werkzeug test client or a real multi-threaded server and reports the
+    requests per second and the latency percentiles,
+    `benchmarks.compare` runs the same benchmark against two git revisions,
+    `benchmarks.replay` measures the journal of the IRC logger and
+    `benchmarks.parser` its parser of the IRC lines.
+
+    Everything is driven by ``scripts/benchmark``::
+
+        $ scripts/benchmark create /tmp/bench-instance \\
+              --database-uri postgres://localhost/ilog_bench
+        $ scripts/benchmark run /tmp/bench-instance --mode server
+        $ scripts/benchmark compare /tmp/bench-instance master HEAD
+        $ scripts/benchmark replay /tmp/bench-instance
+        $ scripts/benchmark parser
+
+    The modules import ILog lazily so that the benchmarked code can be
+    taken from a different checkout than the benchmarks themselves.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
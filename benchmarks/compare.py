@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.compare
+    ~~~~~~~~~~~~~~~~~~
+
+    Runs the benchmarks against two git revisions and reports the
+    differences.  Every revision is checked out into a temporary worktree
+    and benchmarked in a fresh interpreter, with the benchmark code of the
+    current checkout, so that both revisions are measured the same way.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import shutil
+import tempfile
+from subprocess import Popen, PIPE, check_call
+
+import simplejson
+
+#: the benchmark script of this checkout
+BENCHMARK_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'scripts', 'benchmark')
+
+
+def get_repository_root():
+    process = Popen(['git', 'rev-parse', '--show-toplevel'], stdout=PIPE,
+                    cwd=os.path.dirname(os.path.abspath(__file__)))
+    return process.communicate()[0].strip()
+
+
+def benchmark_revision(revision, instance_folder, options, repository=None):
+    """Benchmark one revision and return the results."""
+    repository = repository or get_repository_root()
+    folder = tempfile.mkdtemp(prefix='ilog-benchmark-')
+    worktree = os.path.join(folder, 'tree')
+    results_file = os.path.join(folder, 'results.json')
+    check_call(['git', 'worktree', 'add', '--detach', worktree, revision],
+               cwd=repository)
+    try:
+        check_call([sys.executable, BENCHMARK_SCRIPT, 'run', instance_folder,
+                    '--ilog-lib', worktree, '--json', results_file] +
+                   list(options))
+        f = open(results_file)
+        try:
+            return simplejson.load(f)
+        finally:
+            f.close()
+    finally:
+        check_call(['git', 'worktree', 'remove', '--force', worktree],
+                   cwd=repository)
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def compare_results(old, new, threshold=5.0):
+    """Compare two result lists.  Returns the report lines and the names of
+    the scenarios whose throughput dropped by more than `threshold` percent.
+    """
+    old = dict((x['name'], x) for x in old)
+    lines = ['%-22s %10s %10s %8s %10s %10s %8s' % (
+        'scenario', 'old req/s', 'new req/s', 'change', 'old p99',
+        'new p99', 'change')]
+    regressions = []
+    for result in new:
+        before = old.get(result['name'])
+        if before is None:
+            continue
+        rps_change = _change(before['rps'], result['rps'])
+        p99_change = _change(before['p99'], result['p99'])
+        if rps_change < -threshold:
+            regressions.append(result['name'])
+        lines.append('%-22s %10.1f %10.1f %+7.1f%% %9.2fms %9.2fms %+7.1f%%%s'
+                     % (result['name'], before['rps'], result['rps'],
+                        rps_change, before['p99'] * 1000,
+                        result['p99'] * 1000, p99_change,
+                        result['name'] in regressions and '  !' or ''))
+    return lines, regressions
+
+
+def _change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+
+def compare_revisions(old_revision, new_revision, instance_folder,
+                      options=(), threshold=5.0):
+    """Benchmark both revisions and return the report and the regressions,
+    see `compare_results`.
+    """
+    old = benchmark_revision(old_revision, instance_folder, options)
+    new = benchmark_revision(new_revision, instance_folder, options)
+    return compare_results(old, new, threshold)
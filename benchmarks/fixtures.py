@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.fixtures
+    ~~~~~~~~~~~~~~~~~~~
+
+    Creates a throwaway ILog instance filled with synthetic data.  The
+    events are inserted in batches through the table objects, going through
+    the ORM would take hours for a few million rows.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import random
+from datetime import datetime, timedelta
+
+import simplejson
+
+#: the file in the instance folder the fixture details are stored in
+FIXTURE_FILENAME = 'benchmark.json'
+
+#: the password of all the users created by the fixtures
+PASSWORD = u'benchmark'
+
+#: the name of the administrator account
+ADMIN_USERNAME = u'admin'
+
+#: the event types the synthetic channels are filled with, weighted
+EVENT_TYPES = ['msg'] * 85 + ['action'] * 5 + ['join'] * 4 + \
+              ['part'] * 3 + ['quit'] * 2 + ['nick']
+
+_words = (u'the of and to in is it you that he was for on are with as his '
+          u'they be at one have this from or had by hot but some what there '
+          u'we can out other were all your when up use word how said an '
+          u'each she which do their time if will way about many then them '
+          u'would write like so these her long make thing see him two has '
+          u'look more day could go come did my sound no most number who over '
+          u'know water than call first people may down side been now find '
+          u'patch commit branch merge build release bug ticket server').split()
+
+BATCH_SIZE = 10000
+
+
+def _random_message(rnd):
+    return u' '.join(rnd.choice(_words) for x in xrange(rnd.randint(2, 25)))
+
+
+def create_instance(instance_folder, database_uri, networks=2,
+                    channels_per_network=10, nicks_per_network=500,
+                    events=1000000, days=60, users=1000, seed=0,
+                    log=None):
+    """Create an instance in `instance_folder` with a fresh database.  The
+    tables of the database are dropped first, don't point this to a
+    database you care about.  The names of the objects the benchmarks need
+    are stored in the instance folder and returned, see `load_fixture`.
+    """
+    from ilog.config import CONFIG_HEADER, DEFAULT_VARS, HIDDEN_KEYS
+    from ilog.database import (db, Channel, Group, IrcEvent, IrcIdentity,
+                               Network, Privilege, User)
+    from ilog.privileges import ILOG_ADMIN
+    from ilog.utils import gen_ascii_slug
+    from ilog.utils.config import Configuration
+    from ilog.utils.crypto import gen_pwhash, gen_secret_key
+
+    def report(msg, *args):
+        if log is not None:
+            log(msg % args)
+
+    rnd = random.Random(seed)
+    if not os.path.isdir(instance_folder):
+        os.makedirs(instance_folder)
+
+    engine = db.create_engine(database_uri, instance_folder)
+    report('resetting the database')
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+
+    # the administrator goes through the ORM like in the web setup
+    session = db.scoped_session(lambda: db.create_session(
+        engine, autoflush=True, autocommit=False))
+    admin_group = Group('Administrators')
+    session.add(admin_group)
+    admin_group.privileges.add(Privilege(ILOG_ADMIN))
+    admin = User(username=ADMIN_USERNAME, email=u'admin@example.com',
+                 confirmed=True)
+    admin.passwd_hash = gen_pwhash(PASSWORD)
+    admin.groups.append(admin_group)
+    session.add(admin)
+    session.commit()
+    session.remove()
+
+    # all users share the same hash, hashing them one by one would take
+    # longer than inserting the events
+    report('creating %d users', users)
+    passwd_hash = gen_pwhash(PASSWORD)
+    now = datetime.utcnow()
+    _insert(engine, User.__table__, ({
+        'username':         u'user%d' % idx,
+        'email':            u'user%d@example.com' % idx,
+        'display_name':     u'User %d' % idx,
+        'confirmed':        True,
+        'passwd_hash':      passwd_hash,
+        'register_date':    now - timedelta(days=rnd.randint(0, 3 * 365)),
+        'last_login':       now - timedelta(days=rnd.randint(0, 30))
+    } for idx in xrange(users)))
+
+    report('creating %d networks with %d channels each', networks,
+           channels_per_network)
+    _insert(engine, Network.__table__, ({
+        'name':     u'Network %d' % idx,
+        'slug':     gen_ascii_slug(u'Network %d' % idx)
+    } for idx in xrange(networks)))
+    network_ids = [row[0] for row in engine.execute(
+        db.select([Network.id]).order_by(Network.id))]
+    _insert(engine, Channel.__table__, ({
+        'network_id':   network_id,
+        'name':         u'channel%d' % idx,
+        'slug':         gen_ascii_slug(u'channel%d' % idx),
+        'prefix':       u'#',
+        'topic':        _random_message(rnd)
+    } for network_id in network_ids for idx in xrange(channels_per_network)))
+    _insert(engine, IrcIdentity.__table__, ({
+        'network_id':   network_id,
+        'nick':         u'nick%d' % idx,
+        'realname':     u'Nick %d' % idx,
+        'ident':        u'nick%d' % idx
+    } for network_id in network_ids for idx in xrange(nicks_per_network)))
+
+    channels = {}
+    for channel_id, network_id in engine.execute(
+            db.select([Channel.id, Channel.network_id])):
+        channels[channel_id] = network_id
+    identities = {}
+    for identity_id, network_id in engine.execute(
+            db.select([IrcIdentity.id, IrcIdentity.network_id])):
+        identities.setdefault(network_id, []).append(identity_id)
+
+    # the events are spread over the last `days` days, some channels are a
+    # lot busier than others.
+    report('creating %d events over %d days', events, days)
+    channel_ids = sorted(channels)
+    weights = [rnd.paretovariate(1.5) for x in channel_ids]
+    total = sum(weights)
+    start = datetime(now.year, now.month, now.day) - timedelta(days=days)
+    span = (now - start).days * 86400 + (now - start).seconds
+
+    def generate_events():
+        for channel_id, weight in zip(channel_ids, weights):
+            nicks = identities[channels[channel_id]]
+            count = int(events * weight / total)
+            offsets = sorted(rnd.randint(0, span) for x in xrange(count))
+            for offset in offsets:
+                yield {
+                    'channel_id':   channel_id,
+                    'stamp':        start + timedelta(seconds=offset),
+                    'type':         rnd.choice(EVENT_TYPES),
+                    'identity_id':  rnd.choice(nicks),
+                    'message':      _random_message(rnd)
+                }
+    _insert(engine, IrcEvent.__table__, generate_events(), report)
+
+    # the busiest channel makes the best benchmark
+    busiest = channel_ids[weights.index(max(weights))]
+    network_slug, channel_name = engine.execute(
+        db.select([Network.slug, Channel.name],
+                  db.and_(Channel.id == busiest,
+                          Network.id == Channel.network_id))).fetchone()
+    engine.dispose()
+
+    report('writing the configuration')
+    cfg = Configuration(os.path.join(instance_folder, 'ilog.ini'), 'ilog',
+                        DEFAULT_VARS.copy(), HIDDEN_KEYS[:])
+    t = cfg.edit()
+    t.update(
+        ilog_url=u'http://localhost/',
+        secret_key=gen_secret_key(),
+        database_uri=database_uri,
+        # the error mails and the mail queue would only add noise
+        log_email_only=True,
+        maintenance_mode=False
+    )
+    cfg._comments['[ilog]'] = CONFIG_HEADER
+    t.commit(include_defaults=True)
+
+    yesterday = now - timedelta(days=1)
+    fixture = {
+        'network':  network_slug,
+        'channel':  channel_name,
+        'day':      [yesterday.year, yesterday.month, yesterday.day]
+    }
+    f = open(os.path.join(instance_folder, FIXTURE_FILENAME), 'w')
+    try:
+        simplejson.dump(fixture, f)
+    finally:
+        f.close()
+    return fixture
+
+
+def load_fixture(instance_folder):
+    """Return the details stored by `create_instance`."""
+    f = open(os.path.join(instance_folder, FIXTURE_FILENAME))
+    try:
+        return simplejson.load(f)
+    finally:
+        f.close()
+
+
+def _insert(engine, table, rows, report=None):
+    """Insert the rows in batches."""
+    batch = []
+    inserted = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            engine.execute(table.insert(), batch)
+            inserted += len(batch)
+            batch = []
+            if report is not None and inserted % (BATCH_SIZE * 10) == 0:
+                report('  %d rows', inserted)
+    if batch:
+        engine.execute(table.insert(), batch)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.parser
+    ~~~~~~~~~~~~~~~~~
+
+    Measures the IRC line parser of the logger against the obvious parser
+    that decodes and splits every line, on a synthetic stream with the mix
+    of events of the fixtures, some of them not UTF-8.  The stream is read
+    in chunks like the connections do.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+import random
+from time import time
+
+from benchmarks.fixtures import EVENT_TYPES
+
+#: the bytes read from the socket at once
+CHUNK_SIZE = 4096
+
+_words = ('the of and to in is it you that patch commit branch merge build '
+          'release bug ticket server caf\xc3\xa9 na\xc3\xafve se\xc3\xb1or '
+          'd\xe9j\xe0').split()
+
+
+def make_stream(lines, seed=0):
+    """Return `lines` IRC lines, CRLF terminated, in one string."""
+    rnd = random.Random(seed)
+    nicks = ['user%d' % idx for idx in xrange(50)]
+    rv = []
+    for idx in xrange(lines):
+        prefix = ':%s!~ident@host-%d.example.com' % (rnd.choice(nicks),
+                                                     idx % 97)
+        text = ' '.join(rnd.choice(_words)
+                        for x in xrange(rnd.randint(3, 15)))
+        event_type = rnd.choice(EVENT_TYPES)
+        if event_type == 'msg':
+            line = '%s PRIVMSG #ilog :%s' % (prefix, text)
+        elif event_type == 'action':
+            line = '%s PRIVMSG #ilog :\x01ACTION %s\x01' % (prefix, text)
+        elif event_type == 'join':
+            line = '%s JOIN :#ilog' % prefix
+        elif event_type == 'part':
+            line = '%s PART #ilog :%s' % (prefix, text)
+        elif event_type == 'quit':
+            line = '%s QUIT :Quit: %s' % (prefix, text)
+        else:
+            line = '%s NICK :%s' % (prefix, rnd.choice(nicks))
+        rv.append(line)
+        if idx % 100 == 0:
+            rv.append('PING :irc.example.com')
+    return '\r\n'.join(rv) + '\r\n'
+
+
+def naive_event(line):
+    """Decode and split the whole line, the way most IRC clients do, and
+    make the same event of it as `ilog.logger.parser.parse_event`.
+    """
+    try:
+        line = line.decode('utf-8')
+    except UnicodeDecodeError:
+        line = line.decode('latin-1')
+    if not line.startswith(u':'):
+        return None
+    prefix, line = line[1:].split(u' ', 1)
+    if u' :' in line:
+        line, trailing = line.split(u' :', 1)
+        params = line.split() + [trailing]
+    else:
+        params = line.split()
+    command = params.pop(0).upper()
+    nick, ident, host = prefix, None, None
+    if u'!' in prefix:
+        nick, ident = prefix.split(u'!', 1)
+        if u'@' in ident:
+            ident, host = ident.split(u'@', 1)
+    event = {'nick': nick.encode('utf-8'), 'ident': ident, 'host': host,
+             'target': None, 'message': None}
+    if command == u'PRIVMSG':
+        event['target'] = params[0].encode('utf-8')
+        event['message'] = params[-1]
+        event['type'] = 'msg'
+        if params[-1].startswith(u'\x01ACTION '):
+            event['message'] = params[-1][8:].rstrip(u'\x01')
+            event['type'] = 'action'
+    elif command in (u'JOIN', u'PART'):
+        event['target'] = params[0].encode('utf-8')
+        event['type'] = command.lower().encode('ascii')
+        if command == u'PART' and len(params) > 1:
+            event['message'] = params[1]
+    elif command in (u'QUIT', u'NICK'):
+        event['message'] = params and params[0] or None
+        event['type'] = command.lower().encode('ascii')
+    else:
+        return None
+    return event
+
+
+def _run(stream, parse):
+    from ilog.logger.parser import split_lines
+    count = 0
+    rest = ''
+    for pos in xrange(0, len(stream), CHUNK_SIZE):
+        lines, rest = split_lines(rest + stream[pos:pos + CHUNK_SIZE])
+        for line in lines:
+            parse(line)
+            count += 1
+    return count
+
+
+def benchmark_parser(lines=200000, repeat=3):
+    """Run both parsers over the same stream and return the best rates."""
+    from ilog.logger.parser import parse_event
+    stream = make_stream(lines)
+    results = []
+    for name, parse in (('naive', naive_event), ('parser', parse_event)):
+        best = None
+        for idx in xrange(repeat):
+            started = time()
+            count = _run(stream, parse)
+            seconds = time() - started
+            if best is None or seconds < best:
+                best = seconds
+        results.append({
+            'name':     name,
+            'lines':    count,
+            'seconds':  best,
+            'rate':     best and count / best or 0.0
+        })
+    return results
+
+
+def format_results(results):
+    lines = ['%-10s %10s %10s %12s' % ('parser', 'lines', 'seconds',
+                                       'lines/sec')]
+    for result in results:
+        lines.append('%-10s %10d %10.2f %12.1f' % (
+            result['name'], result['lines'], result['seconds'],
+            result['rate']))
+    return '\n'.join(lines)
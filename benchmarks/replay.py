@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.replay
+    ~~~~~~~~~~~~~~~~~
+
+    Measures the journal of the IRC logger: how fast the writer appends and
+    syncs events, how fast the drainer writes them into the database and
+    how fast a replay of events that are already there is skipped, which
+    is what happens after a crash of the writer.
+
+    The events are written to the busiest channel of the fixture, dated in
+    the year 2000, and removed again afterwards.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from Queue import Queue
+from time import time
+
+from benchmarks.fixtures import load_fixture
+
+#: the events of the benchmark are older than this
+_CUTOFF = datetime(2001, 1, 1)
+
+
+def _drain(drainer):
+    count = 0
+    while 1:
+        drained = drainer.drain_once()
+        if not drained:
+            return count
+        count += drained
+
+
+def _result(name, events, seconds):
+    return {
+        'name':     name,
+        'events':   events,
+        'seconds':  seconds,
+        'rate':     seconds and events / seconds or 0.0
+    }
+
+
+def benchmark_replay(instance_folder, events=100000):
+    """Run the journal benchmarks and return the results."""
+    from ilog import _core
+    from ilog.database import db, Channel, IrcEvent, Network
+    from ilog.logger.journal import Drainer, Journal, save_checkpoint
+    from ilog.logger.writer import BatchWriter
+
+    app = _core.setup(instance_folder)
+    engine = app.database_engine
+    fixture = load_fixture(instance_folder)
+    channel_id = engine.execute(db.select([Channel.id], db.and_(
+        Network.slug == fixture['network'],
+        Channel.network_id == Network.id,
+        Channel.name == fixture['channel']))).scalar()
+
+    start = datetime(2000, 1, 1)
+    queue = Queue()
+    received = time()
+    for idx in xrange(events):
+        queue.put({
+            'channel_id':   channel_id,
+            'stamp':        start + timedelta(milliseconds=idx * 10),
+            'type':         'msg',
+            'identity_id':  None,
+            'message':      u'replay benchmark event %d' % idx,
+            'network_id':   fixture['network'],
+            'received':     received
+        })
+    queue.put(None)
+
+    folder = tempfile.mkdtemp(prefix='ilog-journal-')
+    results = []
+    try:
+        journal = Journal(folder)
+        started = time()
+        BatchWriter(queue, journal).run()
+        results.append(_result('journal.append', events, time() - started))
+
+        drainer = Drainer(app, journal)
+        started = time()
+        count = _drain(drainer)
+        results.append(_result('journal.drain', count, time() - started))
+
+        # as if the writer crashed before it moved the checkpoint
+        save_checkpoint(folder, 0, 0, -1)
+        started = time()
+        count = _drain(drainer)
+        results.append(_result('journal.replay', count, time() - started))
+        journal.close()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+        table = IrcEvent.__table__
+        engine.execute(table.delete(db.and_(table.c.channel_id == channel_id,
+                                            table.c.stamp < _CUTOFF)))
+    return results
+
+
+def format_results(results):
+    lines = ['%-22s %10s %10s %12s' % ('phase', 'events', 'seconds',
+                                       'events/sec')]
+    for result in results:
+        lines.append('%-22s %10d %10.2f %12.1f' % (
+            result['name'], result['events'], result['seconds'],
+            result['rate']))
+    return '\n'.join(lines)
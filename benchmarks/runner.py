@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.runner
+    ~~~~~~~~~~~~~~~~~
+
+    Drives the application either in process through the werkzeug test
+    client, which shows the cost of the application alone, or through a
+    real multi-threaded server with concurrent clients, which includes the
+    HTTP handling and the contention between the threads.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+import httplib
+from Cookie import SimpleCookie
+from threading import Thread
+from time import time
+from urllib import urlencode
+
+from benchmarks.fixtures import ADMIN_USERNAME, PASSWORD, load_fixture
+
+_input_re = re.compile(r'<input\s[^>]*>', re.I)
+_attr_re = re.compile(r'''(\w+)\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+
+
+class Scenario(object):
+    """A page to benchmark.  If `login` is set the requests are sent as the
+    administrator, if `is_login` is set every request is a login.
+    """
+
+    def __init__(self, name, path, login=False, is_login=False):
+        self.name = name
+        self.path = path
+        self.login = login
+        self.is_login = is_login
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.name)
+
+
+def get_scenarios(instance_folder):
+    """Return the default scenarios for a benchmark instance."""
+    fixture = load_fixture(instance_folder)
+    year, month, day = fixture['day']
+    return [
+        Scenario('index', '/'),
+        Scenario('network.index', '/network/'),
+        Scenario('channel.browse', '/network/%s/%s/%04d/%02d/%02d/' % (
+            fixture['network'], fixture['channel'], year, month, day)),
+        Scenario('account.login', '/account/login', is_login=True),
+        Scenario('admin.index', '/admin/', login=True),
+        Scenario('admin.manage.users', '/admin/manage/users/', login=True)
+    ]
+
+
+def percentile(values, percent):
+    """Return the percentile of the sorted `values`."""
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * percent / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def summarize(name, durations, elapsed, errors=0):
+    """Summarize the durations of the requests of one scenario."""
+    durations = sorted(durations)
+    return {
+        'name':         name,
+        'requests':     len(durations),
+        'errors':       errors,
+        'rps':          elapsed and len(durations) / elapsed or 0.0,
+        'mean':         durations and sum(durations) / len(durations) or 0.0,
+        'p50':          percentile(durations, 50),
+        'p90':          percentile(durations, 90),
+        'p99':          percentile(durations, 99),
+        'max':          durations and durations[-1] or 0.0
+    }
+
+
+def format_results(results):
+    """Format the results as a table, the latencies are in milliseconds."""
+    lines = ['%-22s %8s %7s %9s %8s %8s %8s %8s' % (
+        'scenario', 'requests', 'errors', 'req/sec', 'p50', 'p90', 'p99',
+        'max')]
+    for result in results:
+        lines.append('%-22s %8d %7d %9.1f %8.2f %8.2f %8.2f %8.2f' % (
+            result['name'], result['requests'], result['errors'],
+            result['rps'], result['p50'] * 1000, result['p90'] * 1000,
+            result['p99'] * 1000, result['max'] * 1000))
+    return '\n'.join(lines)
+
+
+def get_hidden_fields(html):
+    """Return the hidden form fields of a page, the CSRF token for example."""
+    rv = {}
+    for tag in _input_re.findall(html):
+        attrs = dict((key.lower(), a or b) for key, a, b in
+                     _attr_re.findall(tag))
+        if attrs.get('type', '').lower() == 'hidden' and 'name' in attrs:
+            rv[attrs['name']] = attrs.get('value', '')
+    return rv
+
+
+def make_app(instance_folder):
+    """Return the WSGI application the way a deployment creates it."""
+    from ilog import get_wsgi_app
+    return get_wsgi_app(instance_folder)
+
+
+# -- in process ---------------------------------------------------------------
+
+def _client_login(client, username=ADMIN_USERNAME):
+    response = client.get('/account/login')
+    data = get_hidden_fields(response.data)
+    data.update(username=username, password=PASSWORD)
+    response = client.post('/account/login', data=data)
+    return response.status_code == 302
+
+
+def run_client(app, scenarios, requests=200, warmup=10):
+    """Benchmark the scenarios with the werkzeug test client."""
+    from werkzeug import BaseResponse, Client
+    results = []
+    for scenario in scenarios:
+        client = Client(app, BaseResponse)
+        if scenario.login and not _client_login(client):
+            raise RuntimeError('could not log in for %r' % scenario)
+        durations = []
+        errors = 0
+        for idx in xrange(warmup + requests):
+            if scenario.is_login:
+                # every login needs a fresh session and a CSRF token,
+                # only the POST is measured.
+                client = Client(app, BaseResponse)
+                form = get_hidden_fields(client.get(scenario.path).data)
+                form.update(username=ADMIN_USERNAME, password=PASSWORD)
+                start = time()
+                response = client.post(scenario.path, data=form)
+                ok = response.status_code == 302
+            else:
+                start = time()
+                response = client.get(scenario.path)
+                ok = response.status_code in (200, 304)
+            duration = time() - start
+            if idx >= warmup:
+                durations.append(duration)
+                errors += not ok
+        results.append(summarize(scenario.name, durations, sum(durations),
+                                 errors))
+    return results
+
+
+# -- over HTTP ----------------------------------------------------------------
+
+class _HTTPClient(object):
+    """Minimal HTTP client that keeps the session cookie."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.cookies = SimpleCookie()
+
+    def request(self, method, path, data=None):
+        headers = {}
+        cookie = '; '.join('%s=%s' % (key, morsel.value)
+                           for key, morsel in self.cookies.iteritems())
+        if cookie:
+            headers['Cookie'] = cookie
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        # the development server speaks HTTP/1.0, one connection per request
+        conn = httplib.HTTPConnection(self.host, self.port)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+        set_cookie = response.getheader('set-cookie')
+        if set_cookie:
+            self.cookies.load(set_cookie)
+        return response.status, data
+
+    def login(self, username=ADMIN_USERNAME):
+        form = get_hidden_fields(self.request('GET', '/account/login')[1])
+        form.update(username=username, password=PASSWORD)
+        return self.request('POST', '/account/login', form)[0] == 302
+
+
+def _http_worker(host, port, scenario, requests, durations, errors):
+    client = _HTTPClient(host, port)
+    if scenario.login and not client.login():
+        errors.append(requests)
+        return
+    for idx in xrange(requests):
+        if scenario.is_login:
+            client = _HTTPClient(host, port)
+            form = get_hidden_fields(client.request('GET', scenario.path)[1])
+            form.update(username=ADMIN_USERNAME, password=PASSWORD)
+            start = time()
+            status = client.request('POST', scenario.path, form)[0]
+            ok = status == 302
+        else:
+            start = time()
+            status = client.request('GET', scenario.path)[0]
+            ok = status in (200, 304)
+        durations.append(time() - start)
+        if not ok:
+            errors.append(1)
+
+
+def run_server(app, scenarios, requests=200, concurrency=8, warmup=10,
+               host='127.0.0.1'):
+    """Benchmark the scenarios against a multi-threaded werkzeug server
+    with `concurrency` clients.
+    """
+    from werkzeug.serving import make_server
+    server = make_server(host, 0, app, threaded=True)
+    port = server.socket.getsockname()[1]
+    thread = Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+    results = []
+    try:
+        for scenario in scenarios:
+            _http_worker(host, port, scenario, warmup, [], [])
+            durations = []
+            errors = []
+            per_client = max(1, requests // concurrency)
+            workers = [Thread(target=_http_worker,
+                              args=(host, port, scenario, per_client,
+                                    durations, errors))
+                       for x in xrange(concurrency)]
+            start = time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            results.append(summarize(scenario.name, durations,
+                                     time() - start, sum(errors)))
+    finally:
+        server.shutdown()
+    return results
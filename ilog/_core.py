@@ -83,6 +83,10 @@ def _unload_ilog():
 
     _setup_lock.acquire()
     try:
+        # the threads of the old application must not outlive its modules
+        stop = getattr(_application, 'stop', None)
+        if stop is not None:
+            stop()
         _application = None
         _setup_failed = False
 
@@ -146,6 +150,15 @@ def get_wsgi_app(instance_folder):
             if app is not None and app.wants_reload or _setup_failed:
                 _unload_ilog()
                 app = None
+            elif app is not None and app.cfg.changed_external:
+                # configuration changes are applied to the running
+                # application.  If that's not possible fall back to
+                # a full reload.
+                try:
+                    app.reload_config()
+                except Exception:
+                    _unload_ilog()
+                    app = None
             if app is None:
                 try:
                     app = _create_ilog(instance_folder)
@@ -6,6 +6,7 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 
+import sys
 import logging
 from inspect import getdoc
 from os import environ, path
@@ -13,23 +14,32 @@ from time import time
 from urlparse import urlparse
 
 from babel.core import Locale
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
 from sqlalchemy.exc import SQLAlchemyError, OperationalError
-from werkzeug.contrib.securecookie import SecureCookie
 from werkzeug.exceptions import HTTPException, Forbidden, NotFound
 from werkzeug.urls import url_quote, url_encode
 from werkzeug.utils import redirect as _redirect
 from werkzeug.wrappers import Request as RequestBase, Response as ResponseBase
 from werkzeug.wsgi import ClosingIterator, SharedDataMiddleware
 
-from ilog import _core, i18n
+from ilog import _core, i18n, metrics
+from ilog.assets import AssetMiddleware, load_manifest
 from ilog.cache import get_cache
+from ilog.sessions import get_session_store, load_session, renew_session, \
+     save_session
 from ilog.environment import SHARED_DATA, TEMPLATE_PATH
 from ilog.utils import flash, htmlhelpers, local, local_manager
 from ilog.utils.exceptions import UserException
 
 log = logging.getLogger(__name__)
 
+#: the number of seconds between two checks for changed code
+CODE_CHECK_INTERVAL = 2
+
+#: the file in the instance folder that records that the tables of the
+#: configured database exist and are up to date, so that the check can be
+#: skipped on startup
+DATABASE_MARKER = '.database_initialized'
+
 class InternalError(UserException):
     """Subclasses of this exception are used to signal internal errors that
     should not happen, but may do if the configuration is garbage.  If an
@@ -53,6 +63,25 @@ def get_application():
     """
     return _core._application
 
+
+def get_code_mtime():
+    """Return the newest modification time of the loaded ILog modules."""
+    import sys
+    result = 0
+    for name, module in sys.modules.items():
+        if module is None or not (name == 'ilog' or name.startswith('ilog.')):
+            continue
+        filename = getattr(module, '__file__', None)
+        if not filename:
+            continue
+        if filename[-4:] in ('.pyc', '.pyo'):
+            filename = filename[:-1]
+        try:
+            result = max(result, path.getmtime(filename))
+        except OSError:
+            pass
+    return result
+
 def url_for(endpoint, **args):
     """Get the URL to an endpoint.  The keyword arguments provided are used
     as URL values.  Unknown URL values are used as keyword argument.
@@ -82,9 +111,11 @@ def url_for(endpoint, **args):
 
 
 def shared_url(spec):
-    """Returns a URL to a shared resource."""
-#    endpoint, filename = spec.split('::', 1)
-    return url_for('static', path=spec)
+    """Returns a URL to a shared resource.  If the assets were built the
+    URL points to the fingerprinted file.
+    """
+    return url_for('static', path=get_application().asset_manifest.get(spec,
+                                                                       spec))
 
 def add_metanav_item(menu_item, endpoint, label, children=[]):
     get_request().metanav.append((menu_item, endpoint, label, children))
@@ -192,6 +223,7 @@ def build_core_items(_active_menu_item=None):
 
 def select_template(templates):
     """Selects the first template from a list of templates that exists."""
+    from jinja2 import TemplateNotFound
     env = get_application().template_env
     for template in templates:
         if template is not None:
@@ -209,11 +241,13 @@ def render_template(template_name, _stream=False, **context):
     strings the first template that exists is selected.
     """
     request = get_request()
+    started = time()
     context.update({
         '_': request.translations.gettext,
         'ngettext': request.translations.ngettext,
         'core': build_core_items(context.pop('_active_menu_item', None))
     })
+    started = request.add_timing('core', started)
     if not isinstance(template_name, basestring):
         tmpl = select_template(template_name)
         template_name = tmpl.name
@@ -222,7 +256,9 @@ def render_template(template_name, _stream=False, **context):
 
     if _stream:
         return tmpl.stream(context)
-    return tmpl.render(context)
+    rv = tmpl.render(context)
+    request.add_timing('render', started)
+    return rv
 
 
 def render_response(template_name, **context):
@@ -239,6 +275,9 @@ class Request(RequestBase):
     """This class holds the incoming request data."""
 
     def __init__(self, environ, app=None):
+        self.started = started = time()
+        self.timings = []
+        self.query_count = 0
         RequestBase.__init__(self, environ)
         self.queries = []
         self.metanav = []
@@ -254,8 +293,8 @@ class Request(RequestBase):
         # get the session and try to get the user object for this request.
         from ilog.database import db, User
         user = None
-        cookie_name = app.cfg['cookie_name']
-        session = SecureCookie.load_cookie(self, cookie_name, app.secret_key)
+        session = load_session(app, self)
+        started = self.add_timing('session', started)
         user_id = session.get('uid')
         if user_id:
             user = User.query.options(
@@ -264,15 +303,31 @@ class Request(RequestBase):
         if user is None:
             self.locale = self.app.default_locale
             self.translations = self.app.default_translations
+            self.tz_info = i18n.get_timezone(app.cfg['timezone'])
             user = User.query.get_nobody()
         else:
             self.locale = Locale(user.locale)
             self.translations = i18n.load_translations(self.locale)
+            self.tz_info = i18n.get_timezone(user.tzinfo or
+                                             app.cfg['timezone'])
         self.user = user
+        started = self.add_timing('user', started)
         self.user.update_last_login()
         db.commit()
+        self.add_timing('last_login', started)
         self.session = session
 
+    def add_timing(self, name, started):
+        """Record that the phase `name` of the request, which started at
+        `started`, just finished.  Returns the current time so that it can
+        be used as start of the next phase.  The timings are sent to the
+        administrators as ``Server-Timing`` header and aggregated in
+        histograms.
+        """
+        now = time()
+        self.timings.append((name, now - started))
+        return now
+
     @property
     def is_behind_proxy(self):
         """Are we behind a proxy?"""
@@ -293,6 +348,7 @@ class Request(RequestBase):
         log.debug("Binding user %r to request(%d)", self.user.username, id(self))
         self.user.update_last_login()
         db.commit()
+        self.session = renew_session(self.app, self.session)
         self.session['uid'] = user.id
         self.session['lt'] = time()
         if permanent:
@@ -304,6 +360,7 @@ class Request(RequestBase):
 #        user = self.user
         self.user = User.query.get_nobody()
         self.session.clear()
+        self.session = renew_session(self.app, self.session)
 
 
 class Response(ResponseBase):
@@ -337,6 +394,10 @@ class ILog(object):
         # do because it could happen that events are sent during setup
         self.initialized = False
 
+        # how long the phases of the setup took, see `add_startup_timing`
+        self.startup_timings = []
+        started = time()
+
         # Setup logging
         import logging.config
         logging_file = path.join(self.instance_folder, 'logging.ini')
@@ -358,24 +419,54 @@ class ILog(object):
 
         if not self.cfg.exists:
             raise _core.InstanceNotInitialized()
-
-        # connect to the database
-        from ilog.database import db, User
-        self.database_engine = db.create_engine(
-            self.cfg['database_uri'],
-            self.instance_folder,
-            self.cfg['database_debug']
-        )
-
-        try:
-            if not self.database_engine.has_table('users'):
-                raise _core.InstanceNotInitialized()
-        except OperationalError, error:
-            raise _core.DatabaseProblem("Database is not running??? %s" % error)
+        started = self.add_startup_timing('config', started)
+
+        # remember how the code looked like, only code changes trigger a
+        # full reload, configuration changes are applied in place.
+        self._code_mtime = get_code_mtime()
+        self._code_checked = time()
+
+        # connect to the database.  The engine connects lazily, the tables
+        # are only looked for, and brought up to date, if that was not done
+        # for this database and schema version before.
+        self.database_engine = self._create_database_engine()
+        if not self._database_marked():
+            from ilog.database import upgrade_database
+            try:
+                if not self.database_engine.has_table('users'):
+                    raise _core.InstanceNotInitialized()
+                upgrade_database(self.database_engine)
+            except OperationalError, error:
+                raise _core.DatabaseProblem("Database is not running??? %s" %
+                                            error)
+            self._mark_database()
+        started = self.add_startup_timing('database', started)
+
+        # the metrics of all processes are collected in the instance
+        metrics.setup(path.join(self.instance_folder,
+                                self.cfg['metrics_path']))
 
         # now setup the cache system
         self.cache = get_cache(self)
 
+        # and the session store, if the sessions are kept on the server
+        self.session_store = get_session_store(self)
+
+        # the outgoing mails are queued and delivered in the background
+        from ilog.utils.mail import MailQueue
+        self.mail_queue = MailQueue(self)
+
+        # errors seen by non administrators are mailed as digests
+        from ilog.notifications import ErrorNotifier
+        self.error_notifier = ErrorNotifier(
+                                self, self.cfg['error_notification_interval'])
+
+        # the periodic maintenance jobs declared by the modules, the
+        # threads are started with the first request
+        from ilog.scheduler import Scheduler
+        self.scheduler = Scheduler(self)
+        started = self.add_startup_timing('services', started)
+
         # setup core package urls and shared stuff
         import ilog
         from ilog.urls import urls_map
@@ -385,20 +476,22 @@ class ILog(object):
         self.url_map = urls_map
 
         # and create a url adapter
-        scheme, netloc, script_name = urlparse(self.cfg['ilog_url'])[:3]
-        self.url_adapter = self.url_map.bind(netloc, script_name,
-                                             url_scheme=scheme)
+        self.url_adapter = self._create_url_adapter()
 
         del all_views, urls_map
+        started = self.add_startup_timing('urls', started)
 
         # initialize default i18n/l10n system
+        i18n.load_all_translations()
         self.default_locale = Locale(self.cfg['language'])
         self.default_translations = i18n.load_translations(self.default_locale)
+        started = self.add_startup_timing('translations', started)
 
         # register the default privileges
         from ilog.privileges import DEFAULT_PRIVILEGES
         self.privileges = DEFAULT_PRIVILEGES.copy()
 
+        from jinja2 import Environment, FileSystemLoader
         env = Environment(loader=FileSystemLoader(TEMPLATE_PATH),
                           extensions=['jinja2.ext.i18n'])
 
@@ -420,17 +513,25 @@ class ILog(object):
             datetime_format=i18n.format_datetime,
             date_format=i18n.format_date,
             time_format=i18n.format_time,
+            log_time_format=i18n.format_log_time,
             timedelta_format=i18n.format_timedelta
         )
 
         env.install_gettext_translations(self.default_translations)
         self.template_env = env
+        started = self.add_startup_timing('templates', started)
 
-        # now add the middleware for static file serving
+        # now add the middleware for static file serving.  The built
+        # assets are served by the asset middleware, everything else falls
+        # through to the original files.
         self.add_middleware(SharedDataMiddleware, {
             '/_static': SHARED_DATA,
             '/favicon.ico': SHARED_DATA
         })
+        self.asset_manifest = load_manifest()
+        if self.asset_manifest:
+            self.add_middleware(AssetMiddleware, self.asset_manifest)
+        self.add_startup_timing('middlewares', started)
 
         # mark the app as finished and override the setup functions
         def _error(*args, **kwargs):
@@ -441,12 +542,129 @@ class ILog(object):
 
     @property
     def wants_reload(self):
-        """True if the application requires a reload.  This is `True` if
-        the config was changed on the file system.  A dispatcher checks this
-        value every request and automatically unloads and reloads the
-        application if necessary.
+        """True if the application requires a full reload.  This is `True` if
+        the code of one of the loaded ILog modules was changed on the file
+        system.  A dispatcher checks this value every request and
+        automatically unloads and reloads the application if necessary.
+        The file system is looked at once every `CODE_CHECK_INTERVAL`
+        seconds at most.
+
+        Configuration changes don't require a reload, they are applied
+        in place by :meth:`reload_config`.
+        """
+        now = time()
+        if now - self._code_checked < CODE_CHECK_INTERVAL:
+            return False
+        self._code_checked = now
+        return get_code_mtime() > self._code_mtime
+
+    def stop(self):
+        """Stop the background threads of the application.  This is called
+        before the application is unloaded, the threads would go on running
+        the old code otherwise.
         """
-        return self.cfg.changed_external
+        from ilog.utils.crypto import hashing_pool
+        for service in (self.scheduler, self.error_notifier, self.mail_queue,
+                        hashing_pool):
+            try:
+                service.stop()
+            except Exception:
+                log.exception('Could not stop %r', service)
+
+    def reload_config(self):
+        """Re-read the configuration file and apply the changed values to
+        the running application.  This is called by the dispatcher if the
+        configuration was changed on the file system, either by this or by
+        another process.
+        """
+        changed = self.cfg.reload()
+        log.debug('Applying changed configuration values: %s',
+                  ', '.join(sorted(changed)))
+
+        if changed & set(['database_uri', 'database_debug']):
+            old_engine = self.database_engine
+            self.database_engine = self._create_database_engine()
+            old_engine.dispose()
+
+        if changed & set(['cache_system', 'cache_timeout', 'memcached_servers',
+                          'filesystem_cache_path']):
+            self.cache = get_cache(self)
+
+        if 'metrics_path' in changed:
+            metrics.setup(path.join(self.instance_folder,
+                                    self.cfg['metrics_path']))
+
+        if changed & set(['session_store', 'session_path']):
+            self.session_store = get_session_store(self)
+
+        if 'mail_spool_path' in changed:
+            from ilog.utils.mail import MailQueue
+            self.mail_queue.stop()
+            self.mail_queue = MailQueue(self)
+
+        if 'error_notification_interval' in changed:
+            self.error_notifier.interval = \
+                                    self.cfg['error_notification_interval']
+
+        if changed & self.scheduler.settings:
+            self.scheduler.update_schedules()
+
+        if 'ilog_url' in changed:
+            self.url_adapter = self._create_url_adapter()
+
+        if 'language' in changed:
+            self.default_locale = Locale(self.cfg['language'])
+            self.default_translations = i18n.load_translations(
+                                                        self.default_locale)
+            self.template_env.install_gettext_translations(
+                                                    self.default_translations)
+
+    def _create_database_engine(self):
+        from ilog.database import db
+        return db.create_engine(self.cfg['database_uri'],
+                                self.instance_folder,
+                                self.cfg['database_debug'])
+
+    def _get_database_marker(self):
+        from ilog.database import SCHEMA_VERSION
+        return '%s\n%d' % (self.cfg['database_uri'].encode('utf-8'),
+                           SCHEMA_VERSION)
+
+    def _database_marked(self):
+        """True if the tables of the configured database are known to
+        exist and to be up to date.
+        """
+        try:
+            f = open(path.join(self.instance_folder, DATABASE_MARKER))
+            try:
+                return f.read().strip() == self._get_database_marker()
+            finally:
+                f.close()
+        except IOError:
+            return False
+
+    def _mark_database(self):
+        try:
+            f = open(path.join(self.instance_folder, DATABASE_MARKER), 'w')
+            try:
+                f.write(self._get_database_marker())
+            finally:
+                f.close()
+        except IOError:
+            log.warning('Could not write the database marker, the tables '
+                        'are looked for on every startup')
+
+    def add_startup_timing(self, name, started):
+        """Record how long the setup phase `name` took, works like
+        `Request.add_timing`.
+        """
+        now = time()
+        self.startup_timings.append((name, now - started))
+        return now
+
+    def _create_url_adapter(self):
+        scheme, netloc, script_name = urlparse(self.cfg['ilog_url'])[:3]
+        return self.url_map.bind(netloc, script_name, url_scheme=scheme)
 
     @property
     def secret_key(self):
@@ -484,29 +702,10 @@ class ILog(object):
         return response
 
     def send_error_notification(self, request, error):
-        from pprint import pprint
-        from cStringIO import StringIO
-        from ilog.database import User, Privilege
-        from ilog.utils.mail import send_email
-        request_buffer = StringIO()
-        pprint(request.__dict__, request_buffer)
-        request_buffer.seek(0)
-        admins = Privilege.query.get('ILOG_ADMIN').priveliged_users
-        email_contents = render_template('mails/error_notification.txt',
-                                         request=request_buffer.read(),
-                                         error=error)
-        send_email(i18n._(u"Server Error on ILog"), email_contents,
-                   [admin.email for admin in admins], quiet=False)
-#        from zine.notifications import send_notification_template, ZINE_ERROR
-#        request_buffer = StringIO()
-#        pprint(request.__dict__, request_buffer)
-#        request_buffer.seek(0)
-#        send_notification_template(
-#            ZINE_ERROR, 'notifications/on_server_error.zeml',
-#            user=request.user, summary=error.message,
-#            request_details=request_buffer.read(),
-#            longtext=''.join(format_exception(*sys.exc_info()))
-#        )
+        """Notify the administrators about an error.  Notifications are
+        grouped and sent as a digest, see :class:`ErrorNotifier`.
+        """
+        self.error_notifier.notify(request, error, sys.exc_info())
 
     def handle_server_error(self, request, exc_info=None, suppress_log=False):
         """Called if a server error happens.  Logs the error and returns a
@@ -541,9 +740,12 @@ class ILog(object):
         # normal request dispatching
         try:
             try:
+                started = time()
                 endpoint, args = self.url_adapter.match(request.path)
                 request.endpoint = endpoint
+                started = request.add_timing('url', started)
                 response = self.views[endpoint](request, **args)
+                request.add_timing('view', started)
             except NotFound, e:
                 response = self.handle_not_found(request, e)
             except Forbidden, e:
@@ -585,6 +787,7 @@ class ILog(object):
         local.page_metadata = []
         local.request_locals = {}
         request.__init__(environ, self)
+        self.scheduler.ensure_running()
 
         # check if the blog is in maintenance_mode and the user is
         # not an administrator. in that case just show a message that
@@ -627,19 +830,17 @@ class ILog(object):
 
         # update the session cookie at the request end if the
         # session data requires an update.
-        if request.session.should_save:
-            # set the secret key explicitly at the end of the request
-            # to not log out the administrator if he changes the secret
-            # key in the config editor.
-            request.session.secret_key = self.secret_key
-            cookie_name = self.cfg['cookie_name']
-            if request.session.get('pmt'):
-                max_age = 60 * 60 * 24 * 31
-                expires = time() + max_age
-            else:
-                max_age = expires = None
-            request.session.save_cookie(response, cookie_name, max_age=max_age,
-                                        expires=expires, session_expires=expires)
+        started = time()
+        save_session(self, request, response)
+        request.add_timing('session_save', started)
+
+        request.add_timing('total', request.started)
+        metrics.observe_request(request, response)
+        # checking the privileges may load them, only do it if needed
+        if self.cfg['server_timing'] and request.user.is_somebody and \
+           request.user.is_admin:
+            response.headers['Server-Timing'] = \
+                metrics.format_server_timing(request.timings)
 
         return response(environ, start_response)
 
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.assets
+    ~~~~~~~~~~~
+
+    This module implements the static asset pipeline.  `build_assets`
+    copies everything below the shared folder into the build folder under
+    a name that contains a hash of the contents, stores gzip and, if the
+    `brotli` module is available, brotli compressed variants next to it and
+    writes a manifest that maps the original names to the fingerprinted
+    ones.
+
+    The application uses the manifest to build the URLs in `shared_url`
+    and serves the built files with `AssetMiddleware`.  Because the name
+    changes whenever the contents change these files can be cached forever.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import re
+import gzip
+import posixpath
+import mimetypes
+from cStringIO import StringIO
+from datetime import datetime
+from hashlib import md5
+from time import time
+
+import simplejson
+from werkzeug import Response, wrap_file, http_date, is_resource_modified
+
+from ilog.environment import SHARED_DATA, ASSETS_BUILD
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+#: the name of the manifest file in the build folder
+MANIFEST_FILENAME = 'manifest.json'
+
+#: the cache control header sent for the fingerprinted files
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+#: the encodings we precompress for, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+#: compressed variants are only kept if they are smaller than this
+#: fraction of the original, images for example don't get any smaller.
+COMPRESSION_THRESHOLD = 0.9
+
+_css_url_re = re.compile(r'''url\(\s*(['"]?)([^'"\)]+)\1\s*\)''')
+
+
+def load_manifest(folder=ASSETS_BUILD):
+    """Load the manifest of the built assets.  If the assets were not built
+    an empty manifest is returned and the original files are used.
+    """
+    try:
+        f = open(os.path.join(folder, MANIFEST_FILENAME))
+    except IOError:
+        return {}
+    try:
+        return simplejson.load(f)
+    finally:
+        f.close()
+
+
+def _fingerprint(filename, data):
+    base, ext = posixpath.splitext(filename)
+    return '%s.%s%s' % (base, md5(data).hexdigest()[:12], ext)
+
+
+def _compress_gzip(data):
+    buf = StringIO()
+    # a fixed mtime keeps the output of repeated builds identical
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return buf.getvalue()
+
+
+def _compress_brotli(data):
+    return brotli.compress(data)
+
+
+def _write_file(filename, data):
+    folder = os.path.dirname(filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    f = open(filename, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def _rewrite_css_urls(filename, data, manifest):
+    """Point the relative URLs in a stylesheet to the fingerprinted files."""
+    folder = posixpath.dirname(filename)
+    def _replace(match):
+        url = match.group(2)
+        if ':' in url or url.startswith(('/', '#')):
+            return match.group(0)
+        path, query = (url.split('?', 1) + [None])[:2]
+        target = posixpath.normpath(posixpath.join(folder, path))
+        if target not in manifest:
+            return match.group(0)
+        url = posixpath.relpath(manifest[target], folder)
+        if query is not None:
+            url += '?' + query
+        return 'url(%s%s%s)' % (match.group(1), url, match.group(1))
+    return _css_url_re.sub(_replace, data)
+
+
+def build_assets(source=SHARED_DATA, destination=ASSETS_BUILD):
+    """Build the assets and return the manifest.  Stylesheets are handled
+    last so that the URLs they reference can be rewritten to the
+    fingerprinted names first.
+    """
+    filenames = []
+    for dirpath, dirnames, files in os.walk(source):
+        dirnames[:] = [x for x in dirnames if not x.startswith('.')]
+        relpath = os.path.relpath(dirpath, source)
+        for name in files:
+            if name.startswith('.'):
+                continue
+            filename = posixpath.normpath(posixpath.join(
+                relpath.replace(os.path.sep, '/'), name))
+            filenames.append(filename)
+    filenames.sort(key=lambda x: (x.endswith('.css'), x))
+
+    compressors = [('.gz', _compress_gzip)]
+    if brotli is not None:
+        compressors.insert(0, ('.br', _compress_brotli))
+
+    manifest = {}
+    for filename in filenames:
+        f = open(os.path.join(source, filename), 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if filename.endswith('.css'):
+            data = _rewrite_css_urls(filename, data, manifest)
+        built = _fingerprint(filename, data)
+        target = os.path.join(destination, built)
+        _write_file(target, data)
+        for suffix, compress in compressors:
+            compressed = compress(data)
+            if len(compressed) < len(data) * COMPRESSION_THRESHOLD:
+                _write_file(target + suffix, compressed)
+            elif os.path.isfile(target + suffix):
+                os.remove(target + suffix)
+        manifest[filename] = built
+
+    _write_file(os.path.join(destination, MANIFEST_FILENAME),
+                simplejson.dumps(manifest, indent=2, sort_keys=True))
+    return manifest
+
+
+def _accepted_encodings(environ):
+    rv = set()
+    for item in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = item.strip().split(';')
+        if not parts[0]:
+            continue
+        quality = [x.strip() for x in parts[1:] if x.strip().startswith('q=')]
+        if quality and quality[0] in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        rv.add(parts[0].strip().lower())
+    return rv
+
+
+class AssetMiddleware(object):
+    """Serves the fingerprinted files from the build folder with far future
+    cache headers, picking the precompressed variant the client accepts.
+    Requests for everything else are passed to the wrapped application,
+    which usually is a `SharedDataMiddleware` for the original files.
+    """
+
+    def __init__(self, app, manifest, prefix='/_static/',
+                 folder=ASSETS_BUILD):
+        self.app = app
+        self.prefix = prefix
+        self.folder = folder
+        self.built = frozenset(manifest.itervalues())
+
+    def find_file(self, filename, environ):
+        """Return the path, size, mtime and encoding of the best variant."""
+        path = os.path.join(self.folder, *filename.split('/'))
+        accepted = _accepted_encodings(environ)
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted or '*' in accepted:
+                try:
+                    stat = os.stat(path + suffix)
+                except OSError:
+                    continue
+                return path + suffix, stat.st_size, stat.st_mtime, encoding
+        stat = os.stat(path)
+        return path, stat.st_size, stat.st_mtime, None
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(self.prefix) or \
+           environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+        filename = path[len(self.prefix):]
+        if filename not in self.built:
+            return self.app(environ, start_response)
+        try:
+            real_filename, size, mtime, encoding = \
+                self.find_file(filename, environ)
+        except OSError:
+            return self.app(environ, start_response)
+
+        # the contents of a fingerprinted file never change, the name and
+        # the encoding are all that's needed for the etag.
+        etag = '%s-%s' % (filename, encoding or 'identity')
+        last_modified = datetime.utcfromtimestamp(int(mtime))
+        mimetype = mimetypes.guess_type(filename)[0] or \
+                   'application/octet-stream'
+        if is_resource_modified(environ, etag, last_modified=last_modified):
+            response = Response(wrap_file(environ, open(real_filename, 'rb')),
+                                mimetype=mimetype, direct_passthrough=True)
+            response.headers['Content-Length'] = str(size)
+        else:
+            response = Response(status=304)
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.headers['Expires'] = http_date(time() + 31536000)
+        response.headers['Vary'] = 'Accept-Encoding'
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.last_modified = last_modified
+        response.set_etag(etag)
+        return response(environ, start_response)
@@ -15,6 +15,7 @@ import os
 from werkzeug.contrib.cache import NullCache, SimpleCache, FileSystemCache, \
      MemcachedCache
 
+from ilog import metrics
 from ilog.utils import local
 
 
@@ -23,7 +24,39 @@ def get_cache(app):
     application setup by the application itself.  No need to call that
     afterwards.
     """
-    return systems[app.cfg['cache_system']](app)
+    backend = app.cfg['cache_system']
+    return InstrumentedCache(systems[backend](app), backend)
+
+
+class InstrumentedCache(object):
+    """Wraps a cache and counts the hits and misses of the lookups."""
+
+    def __init__(self, cache, backend):
+        self.cache = cache
+        self.backend = backend
+
+    def get(self, key):
+        rv = self.cache.get(key)
+        metrics.cache_requests.inc(backend=self.backend,
+                                   result=rv is None and 'miss' or 'hit')
+        return rv
+
+    def get_many(self, *keys):
+        rv = self.cache.get_many(*keys)
+        hits = len([x for x in rv if x is not None])
+        if hits:
+            metrics.cache_requests.inc(hits, backend=self.backend,
+                                       result='hit')
+        if len(rv) > hits:
+            metrics.cache_requests.inc(len(rv) - hits, backend=self.backend,
+                                       result='miss')
+        return rv
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
 
 
 def get_cache_context(vary, eager_caching=False, request=None):
@@ -37,7 +70,7 @@ def get_cache_context(vary, eager_caching=False, request=None):
         # doesn't do anything anyways but if one tests for caching to
         # disable some more expensive caculations in the function we can
         # tell him to not perform anything if the cache won't hold the data
-        request.app.cache is NullCache or
+        request.app.cache.backend == 'null' or
 
         # if this is an eager caching method and eager caching is disabled
         # we don't do anything here
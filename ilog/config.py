@@ -6,7 +6,7 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 
-from ilog.i18n import lazy_gettext, list_languages, list_timezones
+from ilog.i18n import lazy_gettext, list_languages, list_timezones_by_code
 from bureaucracy.forms import (ChoiceField, CommaSeparated, TextField,
                                BooleanField, IntegerField)
 from ilog import __summary__
@@ -25,6 +25,28 @@ class DefaultValueMixin(object):
             return self._default()
         return self._default
 
+class LazyChoices(object):
+    """Choices for a `ChoiceField` that are only calculated when they are
+    used.  `func` is called every time and has to do its own caching.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __iter__(self):
+        return iter(self.func(*self.args, **self.kwargs))
+
+    def __len__(self):
+        return len(self.func(*self.args, **self.kwargs))
+
+    def __getitem__(self, index):
+        return self.func(*self.args, **self.kwargs)[index]
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.func.__name__)
+
 class DChoiceField(DefaultValueMixin, ChoiceField):
     pass
 
@@ -52,6 +74,15 @@ DEFAULT_VARS = {
         help_text=l_(u'If there are multiple Zine installations on '
         u'the same host, the cookie name should be set to something different '
         u'for each blog.')),
+    'session_store':            DChoiceField(choices=[
+        (u'cookie', l_(u'Signed Cookie')),
+        (u'filesystem', l_(u'Filesystem'))
+    ], default=u'cookie', help_text=l_(u'Where the session data is kept.  '
+        u'With the filesystem store the cookie only holds the session id, '
+        u'which is useful if the sessions get big.')),
+    'session_path':             DTextField(default=u'sessions', help_text=l_(
+        u'The folder, relative to the instance folder, the filesystem '
+        u'session store keeps the sessions in.')),
     'secret_key':               DTextField(default=u'', help_text=l_(
         u'The secret key is used for various security related tasks in the '
         u'system.  For example, the cookie is signed with this value.')),
@@ -68,16 +99,28 @@ DEFAULT_VARS = {
         u'If enabled, only administrator will be able to use ILog, all other '
         u'user will see a nice message stating the ILog is not available at '
         u'the moment.')),
-    'timezone':                 DChoiceField(choices=sorted(list_timezones()),
-                                             default=u'UTC', help_text=l_(
+    'timezone':                 DChoiceField(
+        choices=LazyChoices(list_timezones_by_code), default=u'UTC',
+        help_text=l_(
         u'The timezone of the blog.  All times and dates in the user interface '
         u'and on the website will be shown in this timezone.  It\'s save to '
         u'change the timezone after posts are created because the information '
         u'in the database is stored as UTC.')),
-    'language':                 DChoiceField(choices=list_languages(),
-                                             default=u'en', help_text=l_(
+    'language':                 DChoiceField(
+                                    choices=LazyChoices(list_languages),
+                                    default=u'en', help_text=l_(
         u'The default ILog language. Users will have the choice to choose the '
         u'language, from the available ones, the one their desire.')),
+    'password_hash_method':     DChoiceField(choices=[
+        (u'pbkdf2', u'PBKDF2-SHA256'),
+        (u'sha', u'SHA1')
+    ], default=u'pbkdf2', help_text=l_(u'The method new password hashes are '
+        u'created with.  Existing hashes are updated when the users log in.')),
+    'password_hash_cost':       DIntegerField(default=50000, min_value=1000,
+        help_text=l_(u'The number of iterations of the PBKDF2 password '
+        u'hashes.  Use scripts/benchmark_pwhash to find a value that suits '
+        u'the server.')),
+
     # RPXNow.com settings
     'rpxnow/app_domain':        DTextField(default=u'', help_text=l_(
         u'The RPXNow.com application domain.')),
@@ -107,6 +150,44 @@ DEFAULT_VARS = {
     'smtp_use_tls':             DBooleanField(default=False),
     'email_signature':          DTextField(default=__summary__),
     'log_email_only':           DBooleanField(default=False),
+    'mail_spool_path':          DTextField(default=u'mail_spool', help_text=l_(
+        u'The folder, relative to the instance folder, outgoing mails are '
+        u'queued in until they are delivered.')),
+    'mail_workers':             DIntegerField(default=2, min_value=1,
+        help_text=l_(u'The number of threads per process delivering the '
+        u'queued mails.')),
+    'metrics_path':             DTextField(default=u'metrics', help_text=l_(
+        u'The folder, relative to the instance folder, the processes keep '
+        u'their metrics in.')),
+    'metrics_allowed_hosts':    DCommaSeparated(DTextField(),
+        default=lambda: [u'127.0.0.1', u'::1'], help_text=l_(u'The '
+        u'addresses that may scrape the metrics without being logged in as '
+        u'administrator.  Ignored behind a proxy, where every request '
+        u'comes from the proxy.')),
+    'server_timing':            DBooleanField(default=False, help_text=l_(
+        u'Send the timings of the requests of administrators back in a '
+        u'Server-Timing header.')),
+    'metrics_token':            DTextField(default=u'', help_text=l_(
+        u'If set, scrapers sending this token as bearer token in the '
+        u'Authorization header may see the metrics.')),
+    'error_notification_interval': DIntegerField(default=300, min_value=10,
+        help_text=l_(u'Errors are mailed to the administrators as a digest '
+        u'once every this many seconds at most.')),
+    'logger_shards':            DIntegerField(default=2, min_value=1,
+        help_text=l_(u'The number of processes the networks are spread over '
+        u'by the IRC logger.')),
+    'logger_journal_path':      DTextField(default=u'journal', help_text=l_(
+        u'The folder, relative to the instance folder, the IRC logger '
+        u'journals the events in before they are written to the database.')),
+    'scheduler_enabled':        DBooleanField(default=True, help_text=l_(
+        u'Run the periodic maintenance jobs in the background of the web '
+        u'processes.')),
+    'scheduler_workers':        DIntegerField(default=2, min_value=1,
+        help_text=l_(u'The number of threads per process running the '
+        u'maintenance jobs.')),
+    'activation_expiry_interval': DIntegerField(default=3600, min_value=60,
+        help_text=l_(u'Accounts not activated in time are deleted once every '
+        u'this many seconds.')),
 
     'gravatar/url':             DTextField(
         default=u'http://www.gravatar.com/avatar/',
@@ -140,7 +221,7 @@ DEFAULT_VARS = {
 
 }
 
-HIDDEN_KEYS = ('secret_key',)
+HIDDEN_KEYS = ('secret_key', 'metrics_token')
 
 #: header for the config file
 CONFIG_HEADER = '''\
@@ -22,14 +22,16 @@ from sqlalchemy import and_, or_
 from sqlalchemy import orm, schema
 from sqlalchemy.interfaces import ConnectionProxy
 from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import (EXT_CONTINUE, MapperExtension, dynamic_loader,
                             deferred)
 
 #from ilog import application as app
-from ilog.utils import local_manager, gen_ascii_slug
-from ilog.utils.crypto import gen_pwhash, check_pwhash
+from ilog.utils import local, local_manager, gen_ascii_slug
+from ilog.utils.crypto import (DEFAULT_METHOD, HashingPoolFull, check_pwhash,
+                               gen_pwhash, hashing_pool, pwhash_needs_update)
 
 log = logging.getLogger(__name__)
 
@@ -90,11 +92,24 @@ def create_engine(uri, relative_to=None, debug=False):
         if value is not None:
             options[key] = int(value)
 
-    # if debugging is enabled, hook the ConnectionDebugProxy in
+    # if debugging is enabled, hook the ConnectionDebugProxy in, otherwise
+    # just count the queries
     if debug:
         options['proxy'] = ConnectionDebugProxy()
+    else:
+        options['proxy'] = QueryCountProxy()
     return sqlalchemy.create_engine(info, **options)
 
+class QueryCountProxy(ConnectionProxy):
+    """Counts the queries of the current request."""
+
+    def cursor_execute(self, execute, cursor, statement, parameters,
+                       context, executemany):
+        request = getattr(local, 'request', None)
+        if request is not None:
+            request.query_count += 1
+        return execute(cursor, statement, parameters, context)
+
 class ConnectionDebugProxy(ConnectionProxy):
     """Helps debugging the database."""
 
@@ -108,6 +123,7 @@ class ConnectionDebugProxy(ConnectionProxy):
             from ilog.utils.debug import find_calling_context
             request = get_request()
             if request is not None:
+                request.query_count += 1
                 request.queries.append((statement, parameters, start,
                                         time(), find_calling_context()))
 
@@ -145,6 +161,98 @@ db.cleanup_session = cleanup_session = session.remove
 
 log = logging.getLogger(__name__)
 
+
+def escape_like(text, escape='\\'):
+    """Escape the wildcards of `text` for a LIKE with the given escape
+    character.
+    """
+    return text.replace(escape, escape * 2).replace('%', escape + '%') \
+               .replace('_', escape + '_')
+
+
+def pick_slug(base, taken):
+    """Return `base` or the first of `base-1`, `base-2`... not in `taken`."""
+    if base not in taken:
+        return base
+    idx = 1
+    while '%s-%d' % (base, idx) in taken:
+        idx += 1
+    return '%s-%d' % (base, idx)
+
+
+def allocate_slug(column, text, *criteria):
+    """Return a slug for `text` that is unique among the values of `column`
+    (in the rows matching `criteria`).  All the slugs it could clash with
+    are fetched with one prefix query, which can use the index on the
+    column, pending objects of the session are flushed first.
+    """
+    base = gen_ascii_slug(text) or 'unnamed'
+    query = session.query(column).filter(
+        column.like(escape_like(base) + '%', escape='\\'))
+    if criteria:
+        query = query.filter(and_(*criteria))
+    return pick_slug(base, set(row[0] for row in query))
+
+
+#: the version of the schema, raised whenever tables or columns are added.
+#: The application brings databases of older versions up to date with
+#: `upgrade_database` when it starts.
+SCHEMA_VERSION = 4
+
+
+def upgrade_database(engine):
+    """Create the missing tables and add the columns and indexes that were
+    added to the existing ones since they were created.
+    """
+    metadata.create_all(engine)
+    events = db.Table('irc_events', db.MetaData(), autoload=True,
+                      autoload_with=engine)
+    if 'seq' not in events.c:
+        log.warning('Adding the seq column to irc_events')
+        engine.execute('ALTER TABLE irc_events ADD COLUMN seq INTEGER')
+        engine.execute('CREATE UNIQUE INDEX ix_irc_events_channel_stamp_seq '
+                       'ON irc_events (channel_id, stamp, seq)')
+    channels = db.Table('channels', db.MetaData(), autoload=True,
+                        autoload_with=engine)
+    if 'slug' not in channels.c:
+        log.warning('Adding the slug column to channels')
+        engine.execute('ALTER TABLE channels ADD COLUMN slug %s' %
+                       engine.dialect.type_descriptor(
+                           Channel.__table__.c.slug.type).get_col_spec())
+        engine.execute('CREATE INDEX ix_channels_slug ON channels (slug)')
+    _fill_channel_slugs(engine)
+    # create_all only creates the indexes of new tables and the reflection
+    # does not know about indexes, creating an existing one just fails
+    try:
+        engine.execute('CREATE INDEX ix_users_register_date '
+                       'ON users (register_date)')
+    except DBAPIError:
+        pass
+    else:
+        log.warning('Added the ix_users_register_date index')
+
+
+def _fill_channel_slugs(engine):
+    """Give the channels without a slug one, unique within their network
+    like the ones `Channel` allocates.
+    """
+    table = Channel.__table__
+    rows = engine.execute(db.select([table.c.id, table.c.network_id,
+                                     table.c.name, table.c.slug],
+                                    order_by=[table.c.id])).fetchall()
+    taken = {}
+    for row in rows:
+        if row.slug is not None:
+            taken.setdefault(row.network_id, set()).add(row.slug)
+    for row in rows:
+        if row.slug is not None:
+            continue
+        slugs = taken.setdefault(row.network_id, set())
+        slug = pick_slug(gen_ascii_slug(row.name) or 'unnamed', slugs)
+        slugs.add(slug)
+        engine.execute(table.update(table.c.id == row.id), slug=slug)
+
+
 class _ModelBase(object):
     # Query Object
     query         = session.query_property(orm.Query)
@@ -174,19 +282,63 @@ class UserQuery(orm.Query):
     def get_nobody(self):
         return AnonymousUser()
 
-    def too_old_activations(self):
-        return self.filter(
-            db.and_(User.active==False,
-                 User.register_date<=datetime.utcnow()-timedelta(days=30)
-            )
+    def _too_old_activations_clause(self):
+        # only registrations that were never activated expire.  Accounts
+        # waiting for the confirmation of a changed email were activated
+        # before: they're confirmed, or, if activated before `confirmed`
+        # was kept, were granted privileges on activation
+        return db.and_(
+            User.register_date<=datetime.utcnow()-timedelta(days=30),
+            User.activation_key!='!',
+            User.confirmed==False,
+            ~db.exists([user_privileges.c.user_id],
+                       user_privileges.c.user_id==User.id)
         )
 
+    def by_activation_key(self, key):
+        """Return the account waiting for activation with `key`, accounts
+        too old to be activated are ignored even if they were not deleted
+        yet.
+        """
+        return self.filter(db.and_(
+            User.activation_key==key,
+            db.not_(self._too_old_activations_clause())
+        )).first()
+
+    def too_old_activations(self):
+        return self.filter(self._too_old_activations_clause())
+
+    def delete_too_old_activations(self):
+        """Delete the accounts that were not activated within 30 days,
+        together with their group memberships and providers.  The ids are
+        fetched with one query and deleted with one statement per table,
+        the accounts are never loaded.  Returns the number of deleted
+        accounts.
+        """
+        user_ids = [row[0] for row in self.session.execute(
+            db.select([User.__table__.c.id],
+                      self._too_old_activations_clause()))]
+        if not user_ids:
+            return 0
+        for column in (group_users.c.user_id, Provider.__table__.c.user_id,
+                       User.__table__.c.id):
+            self.session.execute(column.table.delete(column.in_(user_ids)))
+        return len(user_ids)
+
     def by_provider(self, identifier):
         provider = Provider.query.get(identifier)
         if provider:
             return provider.account
         return None
 
+    def prefix_search(self, prefix):
+        """Users whose username or email starts with `prefix`.  Being
+        prefix searches these can use the indexes on both columns.
+        """
+        pattern = escape_like(prefix) + '%'
+        return self.filter(db.or_(User.username.like(pattern, escape='\\'),
+                                  User.email.like(pattern, escape='\\')))
+
 
 class User(DeclarativeBase, _ModelBase):
     __tablename__ = 'users'
@@ -201,7 +353,7 @@ class User(DeclarativeBase, _ModelBase):
     confirmed     = db.Column(db.Boolean, default=False)
     passwd_hash   = db.Column(db.String, default="!")
     last_login    = db.Column(db.DateTime, default=datetime.utcnow)
-    register_date = orm.deferred(db.Column(db.DateTime,
+    register_date = orm.deferred(db.Column(db.DateTime, index=True,
                                            default=datetime.utcnow))
     activation_key= db.Column(db.String, default="!")
     tzinfo        = db.Column(db.String(25), default="UTC")
@@ -243,6 +395,7 @@ class User(DeclarativeBase, _ModelBase):
 
     def activate(self):
         self.activation_key = '!'
+        self.confirmed = True
 
     def get_gravatar_url(self, size=80):
         from ilog.application import get_application
@@ -256,13 +409,40 @@ class User(DeclarativeBase, _ModelBase):
         )
     gravatar_url = property(get_gravatar_url)
 
+    @staticmethod
+    def _get_hash_settings():
+        from ilog.application import get_application
+        app = get_application()
+        if app is None:
+            return DEFAULT_METHOD, None
+        return app.cfg['password_hash_method'], app.cfg['password_hash_cost']
+
+    @classmethod
+    def hash_password(cls, password):
+        """Hash `password` with the configured method and cost in the
+        hashing pool.  Raises `HashingPoolFull` if the pool is overloaded.
+        """
+        method, cost = cls._get_hash_settings()
+        return hashing_pool.apply(gen_pwhash, password, method, cost)
+
     def set_password(self, password):
-        self.passwd_hash = gen_pwhash(password)
+        self.passwd_hash = self.hash_password(password)
 
     def check_password(self, password):
+        """Check the password.  The hashes are calculated in the hashing
+        pool, if the pool is overloaded `HashingPoolFull` is raised.  Hashes
+        of other methods or costs than the configured ones are replaced.
+        """
         if self.passwd_hash == '!':
             return False
-        if check_pwhash(self.passwd_hash, password):
+        if hashing_pool.apply(check_pwhash, self.passwd_hash, password):
+            method, cost = self._get_hash_settings()
+            if pwhash_needs_update(self.passwd_hash, method, cost):
+                try:
+                    self.set_password(password)
+                except HashingPoolFull:
+                    # the password was right, it's upgraded another time
+                    pass
             self.update_last_login()
             return True
         return False
@@ -296,12 +476,67 @@ class AnonymousUser(User):
     locale        = 'en'
 
 
+#: privilege name -> id.  The privileges table holds a handful of rows which
+#: never change once created, so the ids are remembered for the lifetime of
+#: the process and the rows looked up in the identity map of the session.
+_privilege_ids = {}
+
+
 class PrivilegeQuery(orm.Query):
 
+    def _get_cached(self, name):
+        privilege_id = _privilege_ids.get(name)
+        if privilege_id is None:
+            return None
+        privilege = orm.Query.get(self, privilege_id)
+        if privilege is None or privilege.name != name:
+            # the row went away behind our back
+            _privilege_ids.pop(name, None)
+            return None
+        return privilege
+
     def get(self, privilege):
         if not isinstance(privilege, basestring):
             privilege = privilege.name
-        return self.filter(Privilege.name==privilege).first()
+        rv = self._get_cached(privilege)
+        if rv is None:
+            rv = self.filter(Privilege.name==privilege).first()
+            if rv is not None:
+                _privilege_ids[rv.name] = rv.id
+        return rv
+
+    def get_many(self, names):
+        """Return a dict of the privileges with the given names, loaded with
+        one query.  The known ids are looked up by primary key, the other
+        names by name.  Names that do not exist in the database are missing
+        from the dict.
+        """
+        names = set(names)
+        if not names:
+            return {}
+        ids = []
+        missing = []
+        for name in names:
+            privilege_id = _privilege_ids.get(name)
+            if privilege_id is None:
+                missing.append(name)
+            else:
+                ids.append(privilege_id)
+        criteria = []
+        if ids:
+            criteria.append(Privilege.id.in_(ids))
+        if missing:
+            criteria.append(Privilege.name.in_(missing))
+        rv = {}
+        for privilege in self.filter(db.or_(*criteria)):
+            if privilege.name in names:
+                _privilege_ids[privilege.name] = privilege.id
+                rv[privilege.name] = privilege
+        for name in names:
+            if name not in rv:
+                # the row went away behind our back
+                _privilege_ids.pop(name, None)
+        return rv
 
 
 class Privilege(DeclarativeBase, _ModelBase):
@@ -386,18 +621,7 @@ class Network(DeclarativeBase, _ModelBase):
 
     def __init__(self, name):
         self.name = name
-        self.slug = self.__create_slug(name)
-
-    def __create_slug(self, name):
-        initial_slug = gen_ascii_slug(name)
-        slug = initial_slug
-        similiars = 1
-        sa_session = db.session()
-        while sa_session.query(Network).filter(Network.slug==slug).first():
-            slug = "%s-%i" % (initial_slug, similiars)
-            similiars += 1
-        sa_session.close()
-        return slug
+        self.slug = allocate_slug(Network.slug, name)
 
 
 class NetworkServer(DeclarativeBase, _ModelBase):
@@ -446,6 +670,7 @@ class Channel(DeclarativeBase, _ModelBase):
     id             = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name           = db.Column(db.String, index=True)
     network_id     = db.Column(db.ForeignKey('networks.id'), index=True)
+    slug           = db.Column(db.String, index=True)
     prefix         = db.Column(db.String(3))
 #    locale         = db.Column(db.String(6))
     key            = db.Column(db.String, nullable=True)
@@ -456,9 +681,28 @@ class Channel(DeclarativeBase, _ModelBase):
     changed_by_id = db.Column('topic_changed_by_identity_id',
                               db.ForeignKey('identities.id'))
 
+    # Relationships
+    network       = db.relation("Network", backref="channels")
+
+    def __init__(self, network, name, prefix=u'#'):
+        self.name = name
+        self.prefix = prefix
+        if network.id is None:
+            # a network that was not flushed yet has all of its channels
+            # in memory
+            self.slug = pick_slug(gen_ascii_slug(name) or 'unnamed',
+                                  set(x.slug for x in network.channels))
+        else:
+            self.slug = allocate_slug(Channel.slug, name,
+                                      Channel.network_id == network.id)
+        self.network = network
+
 
 class IrcEvent(DeclarativeBase, _ModelBase):
     __tablename__  = 'irc_events'
+    # the sequence number is given by the logger journal, it tells events
+    # apart that are written again after a crash
+    __table_args__ = (db.UniqueConstraint('channel_id', 'stamp', 'seq'), {})
 
     id             = db.Column(db.Integer, primary_key=True, autoincrement=True)
     channel_id     = db.Column(db.ForeignKey('channels.id'), index=True)
@@ -466,6 +710,27 @@ class IrcEvent(DeclarativeBase, _ModelBase):
     type           = db.Column(db.String(10))
     identity_id    = db.Column(db.ForeignKey('identities.id'), index=True)
     message        = db.Column(db.String)
+    seq            = db.Column(db.Integer, nullable=True)
+
+    # Relationships
+    identity       = db.relation("IrcIdentity")
+
+
+class SchedulerLock(DeclarativeBase, _ModelBase):
+    """The run of a scheduled job last claimed by one of the processes, see
+    `ilog.scheduler`.
+    """
+    __tablename__  = 'scheduler_locks'
+
+    name           = db.Column(db.String(50), primary_key=True)
+    scheduled      = db.Column(db.DateTime)
+    holder         = db.Column(db.String(100))
+    locked_until   = db.Column(db.DateTime, nullable=True)
+    last_duration  = db.Column(db.Float, nullable=True)
+    last_status    = db.Column(db.String(10), nullable=True)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.name)
 
 
 # circular imports
@@ -20,6 +20,9 @@ LOCALE_DOMAIN = 'messages'
 
 SHARED_DATA = join(PACKAGE_CONTENTS, 'shared')
 
+# the fingerprinted and precompressed copies of the shared data
+ASSETS_BUILD = join(PACKAGE_CONTENTS, 'shared_build')
+
 
 TEMPLATE_PATH = join(PACKAGE_CONTENTS, 'templates')
 
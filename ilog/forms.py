@@ -13,9 +13,23 @@ from ilog.database import db, Group, User, Network, NetworkServer
 from ilog.i18n import _, lazy_gettext, list_languages, list_timezones
 from ilog.privileges import bind_privileges
 from ilog.utils import flash, forms, validators
+from ilog.utils.crypto import HashingPoolFull
 
 log = logging.getLogger(__name__)
 
+
+def _hash_password(password):
+    """Hash a new password during the validation, an overloaded hashing
+    pool is reported like an invalid value.
+    """
+    try:
+        return User.hash_password(password)
+    except HashingPoolFull:
+        log.warning("Too many password hashes, refused a new password")
+        raise forms.ValidationError(_(u"Too many passwords are being "
+                                      u"checked right now, please try "
+                                      u"again."))
+
 class _GroupBoundForm(forms.Form):
     """Internal baseclass for group bound forms."""
 
@@ -149,7 +163,15 @@ class LoginForm(forms.Form):
         public_data['password'] = '*****'
         log.debug("Validating context with data: %s", public_data)
         account = User.query.filter(User.username==data['username']).first()
-        if not account.check_password(data['password']):
+        try:
+            authenticated = account is not None and \
+                            account.check_password(data['password'])
+        except HashingPoolFull:
+            log.warning("Too many logins, refused the one for %s",
+                        data['username'])
+            raise forms.ValidationError(_(u"Too many people are logging in "
+                                          u"right now, please try again."))
+        if not authenticated:
             log.debug("Failed authentication for %s", data['username'])
             raise forms.ValidationError(_(u"Failed login!"))
         get_request().login(account.id, permanent=data['remember_me'])
@@ -172,9 +194,14 @@ class RegisterForm(forms.Form):
                                    widget=forms.PasswordInput,
                                    validators=[validators.not_empty])
 
+    def __init__(self, initial=None):
+        forms.Form.__init__(self, initial)
+        self.password_hash = None
+
     def context_validate(self, data):
         if data['new_password'] != data['rep_password']:
             raise forms.ValidationError(_('The two passwords don\'t match.'))
+        self.password_hash = _hash_password(data['new_password'])
 
 
 class AccountProfileForm(_UserBoundForm):
@@ -253,6 +280,7 @@ class EditUserForm(AccountProfileForm):
                 groups=[g.name for g in user.groups],
             )
         AccountProfileForm.__init__(self, user, initial)
+        self.password_hash = None
         self.privileges.choices = self.app.list_privileges()
         self.groups.choices = [g.name for g in Group.query.all()]
 
@@ -266,6 +294,11 @@ class EditUserForm(AccountProfileForm):
         if query.first() is not None:
             raise forms.ValidationError(_('This username is already in use'))
 
+    def context_validate(self, data):
+        AccountProfileForm.context_validate(self, data)
+        if data['password']:
+            self.password_hash = _hash_password(data['password'])
+
     def _set_common_attributes(self, user):
         bind_privileges(user.privileges, self.data['privileges'], user)
         bound_groups = set(g.name for g in user.groups)
@@ -282,8 +315,9 @@ class EditUserForm(AccountProfileForm):
     def make_user(self):
         """A helper function that creates a new user object."""
         user = User(username=self.data['username'],
-                    email=self.data['email'],
-                    password=self.data['password'])
+                    email=self.data['email'])
+        # hashed during the validation
+        user.passwd_hash = self.password_hash
         self._set_common_attributes(user)
         self.user = user
         return user
@@ -292,8 +326,8 @@ class EditUserForm(AccountProfileForm):
         """Apply the changes."""
         if self.username.editable:
             self.user.username = self.data['username']
-        if self.data['password']:
-            self.user.set_password(self.data['password'])
+        if self.password_hash is not None:
+            self.user.passwd_hash = self.password_hash
         self.user.email = self.data['email']
         self._set_common_attributes(self.user)
 
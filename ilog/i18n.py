@@ -6,15 +6,21 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 
-from os import listdir
-from os.path import join, isfile
+from datetime import date as _date, datetime as _datetime, time as _time
+import cPickle as pickle
+from os import fdopen, listdir, makedirs, rename
+from os.path import dirname, join, isdir, isfile
+from tempfile import mkstemp
 from babel.core import Locale, UnknownLocaleError
-from babel.dates import get_timezone_location
+from babel.dates import (get_date_format, get_datetime_format,
+                         get_time_format, get_timezone_location,
+                         parse_pattern,
+                         format_timedelta as babel_format_timedelta)
 from babel.support import Format, LazyProxy, Translations
 
 from ilog.environment import LOCALE_DOMAIN, LOCALE_PATH
 
-from pytz import common_timezones, timezone
+from pytz import UTC, UnknownTimeZoneError, common_timezones, timezone
 
 class ILogTranslations(Translations):
 
@@ -42,7 +48,7 @@ def get_locale():
 
 
 def get_tzinfo():
-    """Return the locale set for the current request."""
+    """Return the timezone set for the current request."""
     from ilog.application import get_request
     try:
         return get_request().tz_info
@@ -82,12 +88,126 @@ def lazy_ngettext(singular, plural, n):
     return LazyProxy(ngettext, singular, plural, n)
 
 
-def __format_obj():
+#: the pattern used for the times of the log lines.  It has a fast path in
+#: :meth:`Formatter.time` that doesn't involve babel at all.
+LOG_TIME_FORMAT = 'HH:mm:ss'
+
+_NAMED_FORMATS = ('full', 'long', 'medium', 'short')
+
+
+class Formatter(object):
+    """A formatter bound to a locale and a timezone.  Unlike babel's
+    `Format` the date and time patterns are parsed only once and kept on
+    the instance.  Formatters are shared between requests, use
+    :func:`get_formatter` to get one.
+    """
+
+    def __init__(self, locale, tzinfo=None):
+        self.locale = Locale.parse(locale)
+        if tzinfo is UTC:
+            tzinfo = None
+        self.tzinfo = tzinfo
+        self._format = Format(self.locale, tzinfo)
+        self._patterns = {}
+
+    def _get_pattern(self, kind, format):
+        try:
+            return self._patterns[kind, format]
+        except KeyError:
+            pass
+        if format not in _NAMED_FORMATS:
+            pattern = parse_pattern(format)
+        elif kind == 'date':
+            pattern = get_date_format(format, self.locale)
+        elif kind == 'time':
+            pattern = get_time_format(format, self.locale)
+        else:
+            # babel formats the date and the time separately and merges
+            # the results.  We merge the patterns once instead.
+            pattern = parse_pattern(
+                get_datetime_format(format, self.locale)
+                    .replace('{0}', get_time_format(format, self.locale).pattern)
+                    .replace('{1}', get_date_format(format, self.locale).pattern)
+            )
+        self._patterns[kind, format] = pattern
+        return pattern
+
+    def _to_local(self, value):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=UTC)
+        if self.tzinfo is not None:
+            value = self.tzinfo.normalize(value.astimezone(self.tzinfo))
+        return value
+
+    def date(self, date=None, format='medium'):
+        if date is None:
+            date = _date.today()
+        elif isinstance(date, _datetime):
+            date = self._to_local(date).date()
+        return self._get_pattern('date', format).apply(date, self.locale)
+
+    def datetime(self, datetime=None, format='medium'):
+        if datetime is None:
+            datetime = _datetime.utcnow()
+        return self._get_pattern('datetime', format).apply(
+                                    self._to_local(datetime), self.locale)
+
+    def time(self, time=None, format='medium'):
+        if time is None:
+            time = _datetime.utcnow()
+        elif isinstance(time, _time):
+            time = _datetime.combine(_date.today(), time)
+        time = self._to_local(time)
+        if format == LOG_TIME_FORMAT:
+            return u'%02d:%02d:%02d' % (time.hour, time.minute, time.second)
+        return self._get_pattern('time', format).apply(time, self.locale)
+
+    def timedelta(self, delta, granularity='second', threshold=.85):
+        return babel_format_timedelta(delta, granularity=granularity,
+                                      threshold=threshold, locale=self.locale)
+
+    def __getattr__(self, name):
+        # the number formatting is left to babel
+        return getattr(self._format, name)
+
+
+_formatters = {}
+
+def get_formatter(locale=None, tzinfo=None):
+    """Return the shared formatter for the given locale and timezone."""
+    key = (str(locale or 'en'), tzinfo)
+    try:
+        return _formatters[key]
+    except KeyError:
+        return _formatters.setdefault(key, Formatter(key[0], tzinfo))
+
+
+def _get_formatter():
     from ilog.application import get_request
-    current_request = get_request()
-    if not hasattr(current_request, '_formats'):
-        current_request._formats = Format(get_locale(), get_tzinfo())
-    return current_request._formats
+    request = get_request()
+    if request is None:
+        return get_formatter()
+    try:
+        return request._formatter
+    except AttributeError:
+        request._formatter = get_formatter(get_locale(), get_tzinfo())
+        return request._formatter
+
+
+_tzinfos = {}
+
+def get_timezone(name):
+    """Return the timezone for the given name.  Unknown names are treated
+    as UTC.
+    """
+    try:
+        return _tzinfos[name]
+    except KeyError:
+        try:
+            tzinfo = timezone(name)
+        except (UnknownTimeZoneError, AttributeError):
+            tzinfo = UTC
+        return _tzinfos.setdefault(name, tzinfo)
 
 
 def format_date(date=None, format="medium"):
@@ -99,7 +219,7 @@ def format_date(date=None, format="medium"):
 
     :see: `babel.dates.format_date`
     """
-    return __format_obj().date(date=None, format=format)
+    return _get_formatter().date(date, format)
 
 
 def format_datetime(datetime=None, format='medium'):
@@ -112,10 +232,11 @@ def format_datetime(datetime=None, format='medium'):
 
     :see: `babel.dates.format_datetime`
     """
-    return __format_obj().datetime(datetime, format)
+    return _get_formatter().datetime(datetime, format)
 
-def format_time(self, time=None, format='medium'):
-    """Return a time formatted according to the given pattern.
+def format_time(time=None, format='medium'):
+    """Return a time formatted according to the given pattern.  Log lines
+    should use `LOG_TIME_FORMAT` which is considerably faster.
 
     >>> from pytz import timezone
     >>> fmt = Format('en_US', tzinfo=timezone('US/Eastern'))
@@ -124,9 +245,13 @@ def format_time(self, time=None, format='medium'):
 
     :see: `babel.dates.format_time`
     """
-    return __format_obj().time(time, format)
+    return _get_formatter().time(time, format)
+
+def format_log_time(time=None):
+    """Return a time formatted with `LOG_TIME_FORMAT`, for the log lines."""
+    return _get_formatter().time(time, LOG_TIME_FORMAT)
 
-def format_timedelta(self, delta, granularity='second', threshold=.85):
+def format_timedelta(delta, granularity='second', threshold=.85):
     """Return a time delta according to the rules of the given locale.
 
     >>> fmt = Format('en_US')
@@ -135,10 +260,10 @@ def format_timedelta(self, delta, granularity='second', threshold=.85):
 
     :see: `babel.dates.format_timedelta`
     """
-    return __format_obj().format_timedelta(delta, granularity=granularity,
-                                           threshold=threshold)
+    return _get_formatter().timedelta(delta, granularity=granularity,
+                                      threshold=threshold)
 
-def format_number(self, number):
+def format_number(number):
     """Return an integer number formatted for the locale.
 
     >>> fmt = Format('en_US')
@@ -147,9 +272,9 @@ def format_number(self, number):
 
     :see: `babel.numbers.format_number`
     """
-    return __format_obj().number(number)
+    return _get_formatter().number(number)
 
-def format_decimal(self, number, format=None):
+def format_decimal(number, format=None):
     """Return a decimal number formatted for the locale.
 
     >>> fmt = Format('en_US')
@@ -158,16 +283,16 @@ def format_decimal(self, number, format=None):
 
     :see: `babel.numbers.format_decimal`
     """
-    return __format_obj().decimal(number, format)
+    return _get_formatter().decimal(number, format)
 
-def format_currency(self, number, currency):
+def format_currency(number, currency):
     """Return a number in the given currency formatted for the locale.
 
     :see: `babel.numbers.format_currency`
     """
-    return __format_obj().currency(number, currency)
+    return _get_formatter().currency(number, currency)
 
-def format_percent(self, number, format=None):
+def format_percent(number, format=None):
     """Return a number formatted as percentage for the locale.
 
     >>> fmt = Format('en_US')
@@ -176,54 +301,127 @@ def format_percent(self, number, format=None):
 
     :see: `babel.numbers.format_percent`
     """
-    return __format_obj().percent(number, format)
+    return _get_formatter().percent(number, format)
 
-def format_scientific(self, number):
+def format_scientific(number):
     """Return a number formatted using scientific notation for the locale.
 
     :see: `babel.numbers.format_scientific`
     """
-    return __format_obj().scientific(number)
+    return _get_formatter().scientific(number)
 
 _  = gettext
 
 
-FOUND_LANGUAGES = set(['en'])
-KNOWN_LANGUAGES = [('en', Locale('en').display_name)]
+#: the available languages as list of ``(code, display_name)`` tuples.  This
+#: is filled by `list_languages` the first time it's called.
+KNOWN_LANGUAGES = None
+FOUND_LANGUAGES = frozenset()
 
-def list_languages():
+def _index_languages():
+    languages = [('en', Locale('en').display_name)]
     for locale in listdir(LOCALE_PATH):
-        if locale == 'en' or locale in FOUND_LANGUAGES:
+        if locale == 'en':
             continue
         try:
             l = Locale.parse(locale)
         except (ValueError, UnknownLocaleError):
             continue
 
-        mo_file = join(LOCALE_PATH, locale, 'LC_MESSAGES', 'messages.mo')
+        mo_file = join(LOCALE_PATH, locale, 'LC_MESSAGES',
+                       LOCALE_DOMAIN + '.mo')
         if isfile(mo_file):
-            KNOWN_LANGUAGES.append((str(l), l.display_name))
-            FOUND_LANGUAGES.add(str(l))
+            languages.append((str(l), l.display_name))
+
+    languages.sort(key=lambda x: x[1].lower())
+    return languages
 
-    KNOWN_LANGUAGES.sort(key=lambda x: x[1].lower())
+def list_languages():
+    """Return a list of ``(code, display_name)`` tuples of the languages
+    ILog has catalogs for.  The locale folder is only scanned once.
+    """
+    global KNOWN_LANGUAGES, FOUND_LANGUAGES
+    if KNOWN_LANGUAGES is None:
+        languages = _index_languages()
+        FOUND_LANGUAGES = frozenset(code for code, name in languages)
+        KNOWN_LANGUAGES = languages
     return KNOWN_LANGUAGES[:]
 
 def has_language(language):
-    list_languages()
+    if KNOWN_LANGUAGES is None:
+        list_languages()
     return language in FOUND_LANGUAGES
 
+#: the loaded catalogs by locale name.  Catalogs are only read, never
+#: changed after loading, which is why all the requests share them.
 LOADED_TRANSLATIONS = {}
 
 def load_translations(locale):
-    if locale not in LOADED_TRANSLATIONS:
-        LOADED_TRANSLATIONS[locale] = ILogTranslations.load(LOCALE_PATH,
-                                                            [locale],
-                                                            LOCALE_DOMAIN)
-    return LOADED_TRANSLATIONS[locale]
+    key = str(locale)
+    try:
+        return LOADED_TRANSLATIONS[key]
+    except KeyError:
+        translations = ILogTranslations.load(LOCALE_PATH, [key],
+                                             LOCALE_DOMAIN)
+        return LOADED_TRANSLATIONS.setdefault(key, translations)
+
+def load_all_translations():
+    """Load the catalogs of all the available languages.  This is called
+    during the application setup so that no request has to wait for a
+    catalog to be loaded.  Loading them before the server forks its workers
+    also lets the workers share the memory of the catalogs.
+    """
+    for code, name in list_languages():
+        load_translations(code)
 
+#: the sorted timezone lists by locale name
 TIMEZONES = {}
 
-def list_timezones(locale=None):
+#: the timezone lists sorted by the timezone codes by locale name
+TIMEZONES_BY_CODE = {}
+
+def _get_timezones_cache_filename(locale):
+    from ilog.application import get_application
+    app = get_application()
+    if app is None:
+        return None
+    return join(app.instance_folder, 'i18n', 'timezones-%s.pickle' % locale)
+
+def _get_timezones_cache_version():
+    import babel, pytz
+    return (getattr(babel, '__version__', None), pytz.__version__)
+
+def _load_timezones_cache(filename):
+    try:
+        f = open(filename, 'rb')
+        try:
+            version, result = pickle.load(f)
+        finally:
+            f.close()
+    except Exception:
+        return None
+    if version != _get_timezones_cache_version():
+        return None
+    return result
+
+def _save_timezones_cache(filename, result):
+    folder = dirname(filename)
+    try:
+        if not isdir(folder):
+            makedirs(folder)
+        fd, tmp_filename = mkstemp(dir=folder)
+        f = fdopen(fd, 'wb')
+        try:
+            pickle.dump((_get_timezones_cache_version(), result), f,
+                        pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        rename(tmp_filename, filename)
+    except (IOError, OSError):
+        # the cache is just an optimization, go on without it
+        pass
+
+def _get_timezones_locale(locale):
     from ilog.application import get_request
     if not locale:
         request = get_request()
@@ -231,10 +429,36 @@ def list_timezones(locale=None):
             locale = 'en'
         else:
             locale = request.locale
+    return str(locale)
 
-    if str(locale) not in TIMEZONES:
+def list_timezones(locale=None):
+    """Return a list of ``(timezone, location)`` tuples sorted by the
+    location name in the given locale, or the locale of the current request.
+    The lists are calculated the first time they are needed and pickled to
+    the instance folder so that other processes and later starts don't have
+    to calculate them again.
+    """
+    locale = _get_timezones_locale(locale)
+    try:
+        return TIMEZONES[locale]
+    except KeyError:
+        pass
+
+    filename = _get_timezones_cache_filename(locale)
+    result = filename and _load_timezones_cache(filename)
+    if result is None:
         result = [(x, get_timezone_location(timezone(x), locale))
                   for x in common_timezones]
         result.sort(key=lambda x: x[1].lower())
-        TIMEZONES[str(locale)] = result
-    return TIMEZONES[str(locale)]
+        if filename:
+            _save_timezones_cache(filename, result)
+    return TIMEZONES.setdefault(locale, result)
+
+def list_timezones_by_code(locale=None):
+    """Like `list_timezones` but sorted by the timezone codes."""
+    locale = _get_timezones_locale(locale)
+    try:
+        return TIMEZONES_BY_CODE[locale]
+    except KeyError:
+        return TIMEZONES_BY_CODE.setdefault(locale,
+                                            sorted(list_timezones(locale)))
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+"""
+The IRC logger, the processes that sit in the channels and write what
+happens there into the database.
+"""
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+"""
+The IRC connections of the logger.
+
+A shard keeps one `IrcConnection` per network and multiplexes their sockets
+with ``select`` in a single thread (see `ilog.logger.supervisor.Shard`).
+A connection picks its server from the `ServerPool` of the network,
+registers with the nick of the network participation, joins the channels
+of the network and turns the lines it reads into events with
+`ilog.logger.parser`.  It answers the PINGs of the server, sends PINGs of
+its own to measure the lag and gives the connection up when the server
+stops answering, the pool makes the server back off then.
+"""
+
+import socket
+import logging
+from datetime import datetime
+from time import time
+
+from ilog.logger.parser import decode, parse_event, parse_line, split_lines
+
+log = logging.getLogger(__name__)
+
+#: the prefixes of the nicks in ``NAMES`` replies
+_NICK_MODES = '@+%&~'
+
+
+class IrcConnection(object):
+    """The connection to one network.  `channels` maps the lower cased
+    channel names, prefix included, to the ids and keys of the channels.
+    Events are passed to `emit` with the nick and ident of the sender, the
+    identities are looked up by the drainer of the journal, never in the
+    IRC loop.
+    """
+
+    #: seconds connecting or registering may take
+    connect_timeout = 15
+
+    #: seconds the server may lag until the connection is given up
+    lag_timeout = 240
+
+    #: bytes read from the socket at once
+    read_size = 4096
+
+    #: the longest incomplete line kept, IRC lines are 512 bytes at most
+    max_line_length = 8192
+
+    ident = 'ilog'
+    realname = 'ILog IRC Logger'
+
+    def __init__(self, pool, nick, password, channels, emit):
+        self.pool = pool
+        self.nick = nick
+        self.password = password
+        self.channels = channels
+        self.emit = emit
+        self.sock = None
+        self.server = None
+        self.registered = False
+        self.current_nick = nick
+        #: lower cased channel name -> the lower cased nicks in the channel
+        self.members = {}
+        self._rest = ''
+        self._connected_at = 0
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def connect(self, now=None):
+        """Connect to the best available server of the pool and register.
+        Returns `False` if no server is available or connecting failed.
+        """
+        if now is None:
+            now = time()
+        server = self.pool.select(now)
+        if server is None:
+            return False
+        self.server = server
+        try:
+            self.sock = socket.create_connection(
+                (server.address, server.port), self.connect_timeout)
+        except socket.error, e:
+            self.sock = None
+            server.failed(str(e), now)
+            return False
+        log.info('Connected to %s:%d', server.address, server.port)
+        self.registered = False
+        self.current_nick = self.nick
+        self.members = {}
+        self._rest = ''
+        self._connected_at = now
+        if self.password:
+            self.send('PASS %s' % self.password)
+        self.send('NICK %s' % self.current_nick)
+        self.send('USER %s 0 * :%s' % (self.ident, self.realname))
+        return self.connected
+
+    def send(self, line):
+        if self.sock is None:
+            return
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        try:
+            self.sock.sendall(line + '\r\n')
+        except socket.error, e:
+            self.fail(str(e))
+
+    def fail(self, message, now=None):
+        """Drop the connection, the server backs off."""
+        self.close()
+        if self.server is not None:
+            self.server.failed(message, now)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.registered = False
+
+    def quit(self, message):
+        self.send('QUIT :%s' % message)
+        self.close()
+
+    def read(self, now=None):
+        """Read from the socket, which must be readable, and handle the
+        complete lines.
+        """
+        if now is None:
+            now = time()
+        try:
+            data = self.sock.recv(self.read_size)
+        except socket.error, e:
+            self.fail(str(e), now)
+            return
+        if not data:
+            self.fail('Connection closed', now)
+            return
+        lines, self._rest = split_lines(self._rest + data)
+        for line in lines:
+            self.handle_line(line, now)
+            if self.sock is None:
+                return
+        if len(self._rest) > self.max_line_length:
+            self.fail('Line too long', now)
+
+    def handle_line(self, line, now):
+        # the events are the bulk of the lines, they're parsed first
+        event = parse_event(line)
+        if event is not None:
+            self.handle_event(event, now)
+            return
+        prefix, command, params = parse_line(line)
+        if command == 'PING':
+            self.send('PONG :%s' % (params and params[-1] or ''))
+        elif command == 'PONG':
+            if params:
+                self.server.pong(params[-1], now)
+        elif command == '001':
+            self.registered = True
+            if params:
+                self.current_nick = params[0]
+            self.server.connected()
+            for name, (channel_id, key) in self.channels.iteritems():
+                self.send('JOIN %s%s' % (name, key and ' ' + key or ''))
+        elif command in ('432', '433', '436') and not self.registered:
+            # the nick is taken or invalid, try another one
+            self.current_nick += '_'
+            self.send('NICK %s' % self.current_nick)
+        elif command == '353' and len(params) >= 3:
+            members = self.members.setdefault(params[-2].lower(), set())
+            for nick in params[-1].split():
+                members.add(nick.lstrip(_NICK_MODES).lower())
+        elif command == 'KICK' and len(params) >= 2:
+            channel, nick = params[0].lower(), params[1].lower()
+            self.members.get(channel, set()).discard(nick)
+            if nick == self.current_nick.lower() and channel in self.channels:
+                key = self.channels[channel][1]
+                self.send('JOIN %s%s' % (channel, key and ' ' + key or ''))
+        elif command == 'ERROR':
+            self.fail(params and params[-1] or 'ERROR', now)
+
+    def handle_event(self, event, now):
+        event_type = event['type']
+        nick = event['nick'].lower()
+        target = event['target']
+        if target is None:
+            # quits and nick changes happen in all the channels of the nick
+            channels = [name for name, members in self.members.iteritems()
+                        if nick in members]
+        else:
+            target = target.lower()
+            channels = [target]
+
+        if event_type == 'join':
+            if nick == self.current_nick.lower():
+                self.members[target] = set()
+            self.members.setdefault(target, set()).add(nick)
+        elif event_type == 'part':
+            if nick == self.current_nick.lower():
+                self.members.pop(target, None)
+            else:
+                self.members.get(target, set()).discard(nick)
+        elif event_type == 'quit' or event_type == 'nick':
+            new_nick = None
+            if event_type == 'nick' and event['message']:
+                new_nick = event['message'].encode('utf-8')
+            for name in channels:
+                self.members[name].discard(nick)
+                if new_nick:
+                    self.members[name].add(new_nick.lower())
+            if new_nick and nick == self.current_nick.lower():
+                self.current_nick = new_nick
+
+        channels = [self.channels[name][0] for name in channels
+                    if name in self.channels]
+        if not channels:
+            return
+        nick = decode(event['nick'])
+        ident = event['ident'] and decode(event['ident'])
+        stamp = datetime.utcnow()
+        for channel_id in channels:
+            self.emit({
+                'channel_id':   channel_id,
+                'stamp':        stamp,
+                'type':         event_type,
+                'nick':         nick,
+                'ident':        ident,
+                'message':      event['message'],
+                'network_id':   self.pool.network_id
+            })
+
+    def tick(self, now=None):
+        """Send the PINGs that are due and give up connections that don't
+        answer.
+        """
+        if self.sock is None:
+            return
+        if now is None:
+            now = time()
+        if not self.registered:
+            if now - self._connected_at > self.connect_timeout:
+                self.fail('Registration timed out', now)
+            return
+        tracker = self.server.tracker
+        if tracker.ping_due(now):
+            self.send('PING :%s' % tracker.make_ping(now))
+        if tracker.current_lag(now) > self.lag_timeout:
+            self.fail('Ping timeout', now)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+"""
+The health of the servers of the networks.
+
+While connected the logger sends a ``PING`` with a token of its own every
+`LagTracker.ping_interval` seconds and measures the time until the matching
+``PONG``, the exponentially weighted moving average of those round-trips is
+the lag of the server.  Connections that fail make the server back off
+exponentially.  The lags and failures are kept in memory and written to the
+``network_servers`` table in batches, and when the logger (re)connects it
+picks the available server with the fewest failures and the lowest lag.
+"""
+
+import random
+import logging
+from time import time
+
+from ilog import metrics
+
+log = logging.getLogger(__name__)
+
+
+def backoff_delay(failures, base=5, maximum=600):
+    """Return the seconds to wait before connecting to a server that failed
+    `failures` times in a row.  The delay doubles with every failure up to
+    `maximum`, half of it is random so that the loggers don't all come back
+    at the same moment.
+    """
+    if failures <= 0:
+        return 0
+    delay = min(maximum, base * 2 ** min(failures - 1, 16))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+class LagTracker(object):
+    """Measures the round-trip time of the PINGs of one connection."""
+
+    #: seconds between two PINGs
+    ping_interval = 30
+
+    #: the weight of a new measurement in the moving average
+    alpha = 0.3
+
+    #: PINGs waiting for their PONG that are remembered at most
+    max_outstanding = 5
+
+    def __init__(self, lag=None):
+        self.lag = lag
+        self.last_ping = 0
+        self._outstanding = []
+        self._counter = 0
+
+    def reset(self):
+        """Forget the PINGs sent over a connection that is gone."""
+        self._outstanding = []
+        self.last_ping = 0
+
+    def ping_due(self, now=None):
+        if now is None:
+            now = time()
+        return now - self.last_ping >= self.ping_interval
+
+    def make_ping(self, now=None):
+        """Return the token for a new PING."""
+        if now is None:
+            now = time()
+        self._counter += 1
+        token = 'ilog-lag-%d' % self._counter
+        self._outstanding.append((token, now))
+        del self._outstanding[:-self.max_outstanding]
+        self.last_ping = now
+        return token
+
+    def pong(self, token, now=None):
+        """Record the PONG for `token`.  Returns the round-trip time or
+        `None` if the token is not one of ours.
+        """
+        if now is None:
+            now = time()
+        for idx, (outstanding, sent) in enumerate(self._outstanding):
+            if outstanding == token:
+                break
+        else:
+            return None
+        # the PONGs come in order, the PINGs before this one were lost
+        del self._outstanding[:idx + 1]
+        rtt = max(0.0, now - sent)
+        if self.lag is None:
+            self.lag = rtt
+        else:
+            self.lag = self.alpha * rtt + (1 - self.alpha) * self.lag
+        return rtt
+
+    def current_lag(self, now=None):
+        """The lag, or how long the oldest PING is waiting for its PONG if
+        that's longer.  A server that stopped answering is lagging even if
+        its last measurements were good.
+        """
+        if now is None:
+            now = time()
+        lag = self.lag or 0.0
+        if self._outstanding:
+            lag = max(lag, now - self._outstanding[0][1])
+        return lag
+
+
+class ServerHealth(object):
+    """The state of one server of a network."""
+
+    def __init__(self, server_id, address, port, lag=None, conn_failures=0,
+                 failure_msg=None):
+        self.server_id = server_id
+        self.address = address
+        self.port = port
+        # the column defaults to 0.0, that's a server never measured
+        self.tracker = LagTracker(lag or None)
+        self.conn_failures = conn_failures or 0
+        self.failure_msg = failure_msg
+        self.next_attempt = 0
+        self.dirty = False
+
+    @property
+    def lag(self):
+        return self.tracker.lag
+
+    def available(self, now=None):
+        """True if the server may be connected to."""
+        if now is None:
+            now = time()
+        return self.next_attempt <= now
+
+    def connected(self):
+        """Record a successful connection."""
+        self.tracker.reset()
+        if self.conn_failures or self.failure_msg:
+            self.conn_failures = 0
+            self.failure_msg = None
+            self.dirty = True
+        self.next_attempt = 0
+
+    def failed(self, message, now=None):
+        """Record a failed connection (or one that was lost)."""
+        if now is None:
+            now = time()
+        self.tracker.reset()
+        self.conn_failures += 1
+        self.failure_msg = message
+        self.next_attempt = now + backoff_delay(self.conn_failures)
+        self.dirty = True
+        log.info('Server %s:%d failed (%d times in a row): %s, next '
+                 'attempt in %ds', self.address, self.port,
+                 self.conn_failures, message, self.next_attempt - now)
+
+    def pong(self, token, now=None):
+        rtt = self.tracker.pong(token, now)
+        if rtt is not None:
+            self.dirty = True
+        return rtt
+
+    def __repr__(self):
+        return '<%s %s:%d lag=%r failures=%d>' % (
+            self.__class__.__name__, self.address, self.port, self.lag,
+            self.conn_failures)
+
+
+class ServerPool(object):
+    """The servers of one network."""
+
+    #: seconds between two writes of the changed states to the database
+    persist_interval = 60
+
+    def __init__(self, network_id, servers=(), network_name=None):
+        self.network_id = network_id
+        self.network_name = network_name or unicode(network_id)
+        self.servers = list(servers)
+        self.last_persist = time()
+
+    @classmethod
+    def load(cls, network):
+        """Create the pool of a `Network` from its servers."""
+        return cls(network.id, [
+            ServerHealth(server.id, server.address, server.port, server.lag,
+                         server.conn_failures, server.failure_msg)
+            for server in network.servers], network.slug)
+
+    def select(self, now=None):
+        """Return the server to connect to or `None` if all are backing off,
+        see `next_attempt` for when to try again.  Of the available servers
+        the ones that failed the least are preferred, then the ones with
+        the lowest lag.  Servers that were never measured count as without
+        lag so that they get a chance to be measured.
+        """
+        if now is None:
+            now = time()
+        candidates = [x for x in self.servers if x.available(now)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda x: (x.conn_failures, x.lag or 0.0))
+
+    def next_attempt(self):
+        """The time the first server is available again."""
+        if not self.servers:
+            return None
+        return min(x.next_attempt for x in self.servers)
+
+    def maybe_persist(self, engine, now=None):
+        """Persist the changed states if that wasn't done for a while."""
+        if now is None:
+            now = time()
+        if now - self.last_persist >= self.persist_interval:
+            persist([self], engine)
+            self.last_persist = now
+
+
+def persist(pools, engine):
+    """Write the changed server states of `pools` to the database with one
+    statement.  Returns the number of updated servers.
+    """
+    from ilog.database import db, NetworkServer
+    changed = []
+    for pool in pools:
+        for server in pool.servers:
+            if server.lag is not None:
+                metrics.logger_server_lag.set(server.lag,
+                    network=pool.network_name,
+                    server='%s:%d' % (server.address, server.port))
+            if server.dirty:
+                changed.append(server)
+    if not changed:
+        return 0
+    table = NetworkServer.__table__
+    engine.execute(table.update(table.c.id == db.bindparam('server_id')), [{
+        'server_id':        server.server_id,
+        'lag':              server.lag or 0.0,
+        'conn_failures':    server.conn_failures,
+        'failure_msg':      server.failure_msg
+    } for server in changed])
+    # only now, if the database is gone the states are written next time
+    for server in changed:
+        server.dirty = False
+    return len(changed)
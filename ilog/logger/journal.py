@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+"""
+The local journal the IRC events are written to before the database.
+
+The writer appends the events it gets from the shards to the journal, one
+JSON object per line in segment files in the instance folder, and syncs
+them to the disk once per batch (see `ilog.logger.writer`).  The
+`Drainer` copies the synced events into the ``irc_events`` table in a
+thread of its own and remembers how far it got in a checkpoint file.  If
+the database is down the events just pile up in the journal and the
+loggers carry on, once it's back the drainer catches up.
+
+Every event gets a sequence number from the journal.  Together with the
+channel and the time stamp it's unique in ``irc_events``, so events that
+are replayed after a crash between the insert and the checkpoint are
+recognized and skipped.
+
+The shards journal the nick and ident of the sender of an event, the
+drainer looks the identities up, or creates them, when it writes the
+events.  That way the IRC loops never wait for the database and no event
+loses its sender while the database is down.
+"""
+
+import os
+import logging
+from datetime import datetime
+from threading import Event, Lock
+from time import time
+
+import simplejson
+
+from ilog import metrics
+from ilog.logger.health import backoff_delay
+
+log = logging.getLogger(__name__)
+
+#: the columns of the events stored in ``irc_events``
+EVENT_COLUMNS = ('channel_id', 'stamp', 'type', 'identity_id', 'message',
+                 'seq')
+
+#: the sequence numbers wrap around before they overflow an integer column
+SEQ_MODULO = 2 ** 31
+
+_SEGMENT_PREFIX = 'segment-'
+_SEGMENT_SUFFIX = '.log'
+_CHECKPOINT_FILENAME = 'checkpoint'
+_STAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _segment_filename(number):
+    return '%s%010d%s' % (_SEGMENT_PREFIX, number, _SEGMENT_SUFFIX)
+
+
+def dump_event(event):
+    """Serialize an event for the journal."""
+    event = dict(event)
+    if isinstance(event.get('stamp'), datetime):
+        event['stamp'] = event['stamp'].strftime(_STAMP_FORMAT)
+    return simplejson.dumps(event, separators=(',', ':'))
+
+
+def load_event(line):
+    """Deserialize an event written by `dump_event`."""
+    event = simplejson.loads(line)
+    if event.get('stamp') is not None:
+        event['stamp'] = datetime.strptime(event['stamp'], _STAMP_FORMAT)
+    return event
+
+
+class Journal(object):
+    """The segments in `path`.  A new segment is started by every process
+    opening the journal and whenever the current one grows beyond
+    `segment_size` bytes.
+    """
+
+    #: the size in bytes a segment is rotated at
+    segment_size = 16 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = Lock()
+        self._file = None
+        self._dirty = False
+        segments = self.list_segments()
+        self.next_seq = self._find_next_seq(segments)
+        self.segment = (segments and segments[-1] or 0) + 1
+        self.synced = (self.segment, 0)
+        self._open_segment()
+
+    def list_segments(self):
+        """Return the numbers of the segments on the disk, in order."""
+        rv = []
+        for filename in os.listdir(self.path):
+            if filename.startswith(_SEGMENT_PREFIX) and \
+               filename.endswith(_SEGMENT_SUFFIX):
+                try:
+                    rv.append(int(filename[len(_SEGMENT_PREFIX):
+                                           -len(_SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(rv)
+
+    def segment_path(self, number):
+        return os.path.join(self.path, _segment_filename(number))
+
+    def _find_next_seq(self, segments):
+        """Continue after the last sequence number used, the one of the last
+        complete event of the newest segment or the one of the checkpoint.
+        """
+        for number in reversed(segments):
+            last = None
+            for offset, event in read_segment(self.segment_path(number)):
+                last = event
+            if last is not None:
+                return (last['seq'] + 1) % SEQ_MODULO
+        return (load_checkpoint(self.path)[2] + 1) % SEQ_MODULO
+
+    def _open_segment(self):
+        self._file = open(self.segment_path(self.segment), 'ab')
+
+    def append(self, events):
+        """Append the events, they are numbered on the way.  They are only
+        durable, and seen by the drainer, after the next `sync`.
+        """
+        lines = []
+        for event in events:
+            event['seq'] = self.next_seq
+            self.next_seq = (self.next_seq + 1) % SEQ_MODULO
+            lines.append(dump_event(event) + '\n')
+        self._file.write(''.join(lines))
+        self._dirty = True
+
+    def sync(self):
+        """Write the appended events to the disk and make them visible to
+        the drainer.
+        """
+        if self._dirty:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._dirty = False
+        position = (self.segment, self._file.tell())
+        if self._file.tell() >= self.segment_size:
+            self._file.close()
+            self.segment += 1
+            self._open_segment()
+        self._lock.acquire()
+        try:
+            self.synced = position
+        finally:
+            self._lock.release()
+
+    def get_synced(self):
+        """The segment and offset everything before was synced."""
+        self._lock.acquire()
+        try:
+            return self.synced
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+def read_segment(filename, offset=0, end=None, limit=None):
+    """Yield the offsets after and the events of a segment starting at
+    `offset`.  A partially written last line is ignored, as are lines that
+    can't be read at all.
+    """
+    f = open(filename, 'rb')
+    try:
+        f.seek(offset)
+        count = 0
+        while end is None or offset < end:
+            if limit is not None and count >= limit:
+                break
+            line = f.readline()
+            if not line.endswith('\n'):
+                break
+            offset += len(line)
+            count += 1
+            try:
+                event = load_event(line)
+            except ValueError:
+                log.error('Skipping a broken line in %s', filename)
+                continue
+            yield offset, event
+    finally:
+        f.close()
+
+
+def _naive(stamp):
+    # time zone aware columns come back with the time zone of the
+    # connection, the events are stored without
+    if stamp is not None and stamp.tzinfo is not None:
+        stamp = stamp.replace(tzinfo=None)
+    return stamp
+
+
+def load_checkpoint(path):
+    """Return the segment, the offset in it and the sequence number of the
+    last event written to the database.
+    """
+    try:
+        f = open(os.path.join(path, _CHECKPOINT_FILENAME))
+        try:
+            segment, offset, seq = map(int, f.read().split())
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return 0, 0, -1
+    return segment, offset, seq
+
+
+def save_checkpoint(path, segment, offset, seq):
+    filename = os.path.join(path, _CHECKPOINT_FILENAME)
+    f = open(filename + '.tmp', 'w')
+    try:
+        f.write('%d %d %d' % (segment, offset, seq))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(filename + '.tmp', filename)
+
+
+class Drainer(object):
+    """Copies the synced events of `journal` into the database of `app`."""
+
+    #: the maximum number of events per insert
+    batch_size = 1000
+
+    #: seconds to wait for new events if the journal is drained
+    poll_interval = 0.5
+
+    #: the number of identity ids cached at most
+    identity_cache_size = 50000
+
+    def __init__(self, app, journal):
+        self.app = app
+        self.journal = journal
+        self.failures = 0
+        self.identities = {}
+
+    def drain_once(self):
+        """Insert the next batch of events and return how many there were.
+        Segments that are drained completely are removed.
+        """
+        segment, offset, seq = load_checkpoint(self.journal.path)
+        synced_segment, synced_offset = self.journal.get_synced()
+        segments = [x for x in self.journal.list_segments()
+                    if x <= synced_segment]
+        for number in segments:
+            if number < segment:
+                # drained before the checkpoint was moved on
+                os.remove(self.journal.segment_path(number))
+                continue
+            if number > segment:
+                segment, offset = number, 0
+            end = None
+            if number == synced_segment:
+                end = synced_offset
+            events = []
+            for offset_after, event in read_segment(
+                    self.journal.segment_path(number), offset, end,
+                    self.batch_size):
+                events.append(event)
+                offset = offset_after
+            if events:
+                self.insert(events)
+                save_checkpoint(self.journal.path, number, offset,
+                                events[-1]['seq'])
+                return len(events)
+            if number < synced_segment:
+                # the journal moved on to a newer segment, this one is done
+                save_checkpoint(self.journal.path, number + 1, 0, seq)
+                os.remove(self.journal.segment_path(number))
+        return 0
+
+    def insert(self, events):
+        """Insert the events, the ones that are already in the database
+        from an earlier attempt are skipped.
+        """
+        from sqlalchemy.exc import IntegrityError
+        from ilog.database import db, IrcEvent
+        table = IrcEvent.__table__
+        engine = self.app.database_engine
+        self.resolve_identities(engine, events)
+        rows = [dict((key, event.get(key)) for key in EVENT_COLUMNS)
+                for event in events]
+        try:
+            engine.execute(table.insert(), rows)
+        except IntegrityError:
+            existing = set((channel_id, _naive(stamp), seq) for
+                           channel_id, stamp, seq in engine.execute(db.select(
+                [table.c.channel_id, table.c.stamp, table.c.seq],
+                table.c.seq.in_([row['seq'] for row in rows]))))
+            rows = [row for row in rows if (row['channel_id'], row['stamp'],
+                                            row['seq']) not in existing]
+            log.info('Skipping %d events already written', len(events) -
+                     len(rows))
+            self._insert_each(engine, table, rows)
+        self.observe(events)
+
+    def resolve_identities(self, engine, events):
+        """Set the `identity_id` of the events from the nicks of their
+        senders.  The identities that don't exist yet are created, all
+        the ones of a batch are looked up with one query per network.
+        """
+        missing = {}
+        for event in events:
+            nick = event.get('nick')
+            if nick is None or event.get('identity_id') is not None:
+                continue
+            key = (event['network_id'], nick)
+            identity_id = self.identities.get(key)
+            if identity_id is None:
+                missing.setdefault(event['network_id'], {}) \
+                       .setdefault(nick, event.get('ident'))
+            else:
+                event['identity_id'] = identity_id
+        if not missing:
+            return
+        if len(self.identities) > self.identity_cache_size:
+            self.identities.clear()
+        for network_id, idents in missing.iteritems():
+            found = self._find_identities(engine, network_id, idents)
+            created = [nick for nick in idents if nick not in found]
+            if created:
+                self._create_identities(engine, network_id, created, idents)
+                found.update(self._find_identities(engine, network_id,
+                                                   created))
+            for nick, identity_id in found.iteritems():
+                self.identities[network_id, nick] = identity_id
+        for event in events:
+            if event.get('nick') is not None and \
+               event.get('identity_id') is None:
+                event['identity_id'] = self.identities.get(
+                    (event['network_id'], event['nick']))
+
+    def _find_identities(self, engine, network_id, nicks):
+        from ilog.database import db, IrcIdentity
+        table = IrcIdentity.__table__
+        return dict((nick, identity_id) for identity_id, nick in
+                    engine.execute(db.select([table.c.id, table.c.nick],
+                        db.and_(table.c.network_id == network_id,
+                                table.c.nick.in_(list(nicks))))))
+
+    def _create_identities(self, engine, network_id, nicks, idents):
+        from sqlalchemy.exc import IntegrityError
+        from ilog.database import IrcIdentity
+        table = IrcIdentity.__table__
+        rows = [dict(network_id=network_id, nick=nick, ident=idents[nick])
+                for nick in nicks]
+        try:
+            engine.execute(table.insert(), rows)
+        except IntegrityError:
+            # some of them were created in the meantime
+            for row in rows:
+                try:
+                    engine.execute(table.insert(), row)
+                except IntegrityError:
+                    pass
+
+    def _insert_each(self, engine, table, rows):
+        from sqlalchemy.exc import IntegrityError
+        try:
+            if rows:
+                engine.execute(table.insert(), rows)
+        except IntegrityError:
+            # not a replay, one of the rows can't be written at all, the
+            # channel was deleted for example.  Find it and drop it
+            for row in rows:
+                try:
+                    engine.execute(table.insert(), row)
+                except IntegrityError, e:
+                    log.error('Dropping event %d: %s', row['seq'], e)
+
+    def observe(self, events):
+        now = time()
+        networks = {}
+        for event in events:
+            network = event.get('network_id')
+            count, lag = networks.get(network, (0, 0.0))
+            networks[network] = (count + 1,
+                                 max(lag, now - event.get('received', now)))
+        for network, (count, lag) in networks.iteritems():
+            metrics.logger_events.inc(count, network=network)
+            metrics.logger_lag.set(lag, network=network)
+
+    def run(self, stopped=None):
+        """Drain until `stopped` (an `Event`) is set and everything synced
+        is written.  While the database fails the drainer backs off.
+        """
+        if stopped is None:
+            stopped = Event()
+        while 1:
+            try:
+                count = self.drain_once()
+                self.failures = 0
+            except Exception:
+                self.failures += 1
+                delay = backoff_delay(self.failures, 1, 60)
+                log.exception('Could not write the journal to the database, '
+                              'retrying in %ds', delay)
+                if stopped.isSet():
+                    return
+                stopped.wait(delay)
+                continue
+            if not count:
+                if stopped.isSet():
+                    return
+                stopped.wait(self.poll_interval)
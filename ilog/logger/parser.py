@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+"""
+The parser of the IRC protocol lines the logger receives.
+
+The lines stay byte strings.  The parts of a line are found with a handful
+of string method calls, which is way cheaper than walking the line in
+Python, and only the parts an event needs are sliced out.  Only the message
+text is decoded, with the first encoding of a fallback chain that can
+decode it; ``latin-1`` at the end of the default chain decodes anything.
+
+The commands the logger stores are mapped straight to the type codes of
+``irc_events`` by `parse_event`, everything else, ``PING`` for example, is
+left to `parse_line`.
+"""
+
+#: the type codes of the events in ``irc_events`` by IRC command
+EVENT_TYPES = {
+    'PRIVMSG':  'msg',
+    'NOTICE':   'notice',
+    'JOIN':     'join',
+    'PART':     'part',
+    'QUIT':     'quit',
+    'NICK':     'nick',
+    'TOPIC':    'topic',
+    'MODE':     'mode'
+}
+
+#: the encodings tried on the message text, in order
+DEFAULT_ENCODINGS = ('utf-8', 'cp1252', 'latin-1')
+
+_CTCP_ACTION = '\x01ACTION '
+
+
+def decode(data, encodings=DEFAULT_ENCODINGS):
+    """Decode `data` with the first encoding that can.  If none can the
+    undecodable bytes of the last one are replaced.
+    """
+    for encoding in encodings:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode(encodings[-1], 'replace')
+
+
+def split_lines(data):
+    """Split received data into the complete lines, without the line
+    breaks, and the incomplete rest, which is to be prepended to the data
+    received next.
+    """
+    lines = data.split('\n')
+    rest = lines.pop()
+    return [line.rstrip('\r') for line in lines if line.rstrip('\r')], rest
+
+
+def _to_str(line):
+    # a line sliced out of a bytearray or a memoryview, it's copied
+    if isinstance(line, memoryview):
+        return line.tobytes()
+    return str(line)
+
+
+def parse_line(line):
+    """Split a line into the prefix (or `None`), the command and the list
+    of parameters, the trailing one included.  The parts are byte strings.
+    """
+    if not isinstance(line, str):
+        line = _to_str(line)
+    prefix = None
+    if line[:1] == ':':
+        prefix, _, line = line[1:].partition(' ')
+    if line[:1] == ':':
+        return prefix, '', [line[1:]]
+    line, sep, trailing = line.partition(' :')
+    params = line.split()
+    if sep:
+        params.append(trailing)
+    if not params:
+        return prefix, '', []
+    return prefix, params[0].upper(), params[1:]
+
+
+def split_prefix(prefix):
+    """Split a ``nick!ident@host`` prefix, missing parts are `None`."""
+    nick, sep, host = prefix.partition('!')
+    ident = None
+    if sep:
+        ident, sep, host = host.partition('@')
+    else:
+        nick, sep, host = nick.partition('@')
+    return nick, ident, host or None
+
+
+def parse_event(line, encodings=DEFAULT_ENCODINGS):
+    """Parse a line into an event for ``irc_events`` or return `None` if
+    the line is nothing the logger stores.  The event is a dict with the
+    `type` code, the `target` (the channel, `None` for ``QUIT`` and
+    ``NICK``), the `nick`, `ident` and `host` of the sender and the decoded
+    `message` (`None` for ``JOIN``).  Channel names and nicks are byte
+    strings, they're looked up as they are.  Lines that aren't byte
+    strings, a ``bytearray`` or a ``memoryview``, are copied into one
+    first, so they don't save anything.
+    """
+    if not isinstance(line, str):
+        line = _to_str(line)
+    # only events sent by somebody are logged
+    if line[:1] != ':':
+        return None
+    parts = line[1:].split(None, 2)
+    if len(parts) == 3:
+        prefix, command, rest = parts
+    elif len(parts) == 2:
+        # ``QUIT`` without a reason
+        prefix, command = parts
+        rest = ''
+    else:
+        return None
+    event_type = EVENT_TYPES.get(command)
+    if event_type is None:
+        event_type = EVENT_TYPES.get(command.upper())
+        if event_type is None:
+            return None
+
+    if rest[:1] == ':':
+        target = None
+        text = rest[1:]
+    else:
+        target, sep, text = rest.partition(' :')
+        if not sep:
+            text = None
+        if event_type == 'mode':
+            # the modes and their arguments are the message
+            target, sep, modes = target.partition(' ')
+            if text is None:
+                text = modes
+            elif modes:
+                text = modes + ' ' + text
+        elif ' ' in target:
+            target = target.split(None, 1)[0]
+
+    if event_type == 'msg' or event_type == 'notice':
+        if text is None:
+            return None
+        if text[:1] == '\x01':
+            # of the CTCPs only the actions are logged, and only when sent
+            if event_type == 'notice' or not text.startswith(_CTCP_ACTION):
+                return None
+            event_type = 'action'
+            text = text[8:]
+            if text[-1:] == '\x01':
+                text = text[:-1]
+    elif event_type == 'join':
+        # JOIN :#channel is as common as JOIN #channel
+        if target is None:
+            target = text
+        text = None
+    elif event_type == 'nick':
+        if text is None:
+            text = target
+        if not text:
+            return None
+        target = None
+    elif event_type == 'quit':
+        target = None
+    if not target and event_type != 'quit' and event_type != 'nick':
+        return None
+
+    nick, ident, host = split_prefix(prefix)
+    if text is not None:
+        try:
+            text = text.decode(encodings[0])
+        except UnicodeDecodeError:
+            text = decode(text, encodings[1:] or encodings)
+    return {
+        'type':     event_type,
+        'target':   target,
+        'nick':     nick,
+        'ident':    ident,
+        'host':     host,
+        'message':  text
+    }
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+"""
+Consistent hashing of the networks onto the logger shards.  Every shard
+owns many points on a ring, a network belongs to the shard owning the
+first point after the hash of its id.  Adding or removing a shard only
+moves the networks of the ring segments that change hands, all other
+networks stay where they are and keep their connections.
+"""
+
+from bisect import bisect
+from hashlib import md5
+
+
+def _hash(key):
+    return int(md5(str(key)).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """A consistent hash ring over `nodes`."""
+
+    #: points per node, the more the more even the distribution
+    replicas = 128
+
+    def __init__(self, nodes=(), replicas=None):
+        if replicas is not None:
+            self.replicas = replicas
+        self.nodes = set()
+        self._points = []
+        self._owners = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for idx in xrange(self.replicas):
+            point = _hash('%s#%d' % (node, idx))
+            # on the unlikely collision the smaller node wins, for all
+            # processes alike
+            if point in self._owners and self._owners[point] < node:
+                continue
+            self._owners[point] = node
+        self._points = sorted(self._owners)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        remaining = self.nodes
+        self.nodes = set()
+        self._points = []
+        self._owners = {}
+        for node in remaining:
+            self.add(node)
+
+    def get_node(self, key):
+        """Return the node `key` belongs to or `None` if there are none."""
+        if not self._points:
+            return None
+        idx = bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[idx]]
+
+    def assign(self, keys):
+        """Return a dict of the nodes and the frozen sets of their keys.
+        Nodes without keys are included with an empty set.
+        """
+        rv = dict((node, set()) for node in self.nodes)
+        for key in keys:
+            node = self.get_node(key)
+            if node is not None:
+                rv[node].add(key)
+        return dict((node, frozenset(keys)) for node, keys in rv.iteritems())
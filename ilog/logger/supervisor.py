@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+"""
+The supervisor of the logger processes.
+
+The networks the bots participate in are spread over ``logger_shards``
+shard processes with a consistent hash ring on the network id, all shards
+send their events to one writer process (see `ilog.logger.writer`) which
+journals them and writes them to the database.  The
+supervisor looks for new or removed network participations and channels
+every `Supervisor.rebalance_interval` seconds, or right away on ``HUP``,
+and restarts the shards whose networks changed; shards that crash are
+restarted with a backoff.
+
+Signals: ``TERM`` and ``INT`` stop the logger, ``HUP`` rebalances.
+"""
+
+import os
+import errno
+import signal
+import logging
+from multiprocessing import Queue
+from select import select, error as select_error
+from threading import Event, Thread
+from time import sleep, time
+
+from ilog.logger.client import IrcConnection
+from ilog.logger.health import ServerPool, backoff_delay, persist
+from ilog.logger.journal import Drainer, Journal
+from ilog.logger.sharding import HashRing
+from ilog.logger.writer import BatchWriter
+
+log = logging.getLogger(__name__)
+
+
+class Shard(object):
+    """The logger for some of the networks, run in a process of its own.
+    The connections to the networks are handled in one thread, see
+    `ilog.logger.client`.  The IRC events are sent to the writer through
+    `queue`.
+    """
+
+    #: the class of the connections to the networks
+    connection_class = IrcConnection
+
+    def __init__(self, app, name, network_ids, queue):
+        self.app = app
+        self.name = name
+        self.network_ids = network_ids
+        self.queue = queue
+        self.pools = {}
+        self.connections = []
+        self.running = True
+
+    def load_networks(self):
+        """Create the connections to the networks of the shard.  A network
+        is logged by the first bot participating in it, with all of its
+        channels.
+        """
+        from ilog.database import Network, cleanup_session
+        try:
+            for network in Network.query.filter(
+                    Network.id.in_(list(self.network_ids))):
+                participations = sorted(network.participations,
+                                        key=lambda x: x.id)
+                if not participations:
+                    continue
+                participation = participations[0]
+                pool = self.pools[network.id] = ServerPool.load(network)
+                channels = dict(((channel.prefix + channel.name).encode(
+                    'utf-8').lower(), (channel.id, channel.key))
+                    for channel in network.channels)
+                self.connections.append(self.connection_class(
+                    pool, participation.nick.encode('utf-8'),
+                    participation.password, channels, self.emit))
+        finally:
+            cleanup_session()
+
+    def run(self):
+        self.load_networks()
+        self.serve()
+
+    def serve(self):
+        """Log the networks until `running` is unset."""
+        engine = self.app.database_engine
+        try:
+            while self.running:
+                now = time()
+                for connection in self.connections:
+                    if not connection.connected:
+                        connection.connect(now)
+                ready = [x for x in self.connections if x.connected]
+                readable = []
+                if ready:
+                    try:
+                        readable = select(ready, [], [], 1)[0]
+                    except select_error, e:
+                        if e.args[0] != errno.EINTR:
+                            raise
+                else:
+                    sleep(1)
+                now = time()
+                for connection in readable:
+                    connection.read(now)
+                for connection in self.connections:
+                    connection.tick(now)
+                    try:
+                        connection.pool.maybe_persist(engine, now)
+                    except Exception:
+                        log.exception('Could not store the server states')
+        finally:
+            for connection in self.connections:
+                connection.quit('Logger stopped')
+            try:
+                persist(self.pools.values(), engine)
+            except Exception:
+                log.exception('Could not store the server states')
+
+    def emit(self, event):
+        """Send an event to the writer, see `BatchWriter`."""
+        event.setdefault('received', time())
+        self.queue.put(event)
+
+
+class Supervisor(object):
+    """Runs the shards and the writer of the application."""
+
+    #: seconds between two looks for changed network participations
+    rebalance_interval = 30
+
+    #: the class run by the shard processes
+    shard_class = Shard
+
+    #: seconds the stopping writer waits for the database at most
+    drain_timeout = 30
+
+    def __init__(self, app, shards=None):
+        self.app = app
+        if shards is None:
+            shards = app.cfg['logger_shards']
+        self.ring = HashRing('shard-%d' % idx for idx in xrange(shards))
+        self.assignment = {}
+        self.channels = {}
+        self.children = {}
+        self.failures = {}
+        self.restart_at = {}
+        self.stopping = set()
+        self.queue = Queue()
+        self.writer_pid = None
+        self.running = False
+        self._rebalance_now = True
+
+    def check_database(self):
+        """Refuse to start on a database without the columns the writer
+        needs, the events would pile up in the journal forever.  The
+        application brings the database up to date when it starts, see
+        `ilog.database.upgrade_database`.
+        """
+        from ilog.database import db
+        events = db.Table('irc_events', db.MetaData(), autoload=True,
+                          autoload_with=self.app.database_engine)
+        if 'seq' not in events.c:
+            raise RuntimeError('irc_events has no seq column, the database '
+                               'was not upgraded')
+
+    def serve_forever(self):
+        self.check_database()
+        self.running = True
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_rebalance)
+        # the children create their own connections
+        self.app.database_engine.dispose()
+        next_rebalance = 0
+        try:
+            while self.running:
+                now = time()
+                if self._rebalance_now or now >= next_rebalance:
+                    self._rebalance_now = False
+                    next_rebalance = now + self.rebalance_interval
+                    try:
+                        self.rebalance()
+                    except Exception:
+                        log.exception('Could not rebalance the shards')
+                self.reap()
+                self.start_missing(now)
+                sleep(1)
+        finally:
+            self.stop()
+
+    def get_network_ids(self):
+        from ilog.database import db, NetworkParticipation, cleanup_session
+        try:
+            return set(row[0] for row in db.session.query(
+                NetworkParticipation.network_id).distinct())
+        finally:
+            cleanup_session()
+            self.app.database_engine.dispose()
+
+    def get_channels(self):
+        """Return the channels the shards join, as a set of tuples, by
+        network id.
+        """
+        from ilog.database import db, Channel, cleanup_session
+        rv = {}
+        try:
+            for row in db.session.query(Channel.network_id, Channel.id,
+                                        Channel.prefix, Channel.name,
+                                        Channel.key):
+                rv.setdefault(row[0], set()).add(tuple(row[1:]))
+        finally:
+            cleanup_session()
+            self.app.database_engine.dispose()
+        return rv
+
+    def rebalance(self):
+        """Assign the networks to the shards, the shards whose networks
+        or their channels changed are restarted.
+        """
+        assignment = self.ring.assign(self.get_network_ids())
+        channels = self.get_channels()
+        for name, network_ids in assignment.iteritems():
+            if self.assignment.get(name) == network_ids and \
+               all(self.channels.get(x) == channels.get(x)
+                   for x in network_ids):
+                continue
+            log.info('Shard %s now logs %d networks', name, len(network_ids))
+            pid = self._pid_of(name)
+            if pid is not None:
+                self._terminate(pid)
+            # a new assignment is a fresh start
+            self.failures.pop(name, None)
+            self.restart_at.pop(name, None)
+        self.assignment = assignment
+        self.channels = channels
+
+    def start_missing(self, now):
+        """Start the writer and the shards that should be running."""
+        if self.writer_pid is None:
+            self.writer_pid = self._fork(self._run_writer)
+        for name, network_ids in self.assignment.iteritems():
+            if not network_ids or self._pid_of(name) is not None:
+                continue
+            if self.restart_at.get(name, 0) > now:
+                continue
+            self.children[self._fork(self._run_shard, name, network_ids)] = \
+                name
+
+    def reap(self):
+        """Collect the exited children, crashed shards are restarted after
+        a backoff.
+        """
+        while 1:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            if not pid:
+                return
+            if pid == self.writer_pid:
+                log.error('The writer exited with %d, restarting', status)
+                self.writer_pid = None
+                continue
+            name = self.children.pop(pid, None)
+            if name is None:
+                continue
+            if pid in self.stopping:
+                self.stopping.discard(pid)
+            elif self.running:
+                self.failures[name] = self.failures.get(name, 0) + 1
+                delay = backoff_delay(self.failures[name])
+                self.restart_at[name] = time() + delay
+                log.error('Shard %s exited with %d, restarting in %ds',
+                          name, status, delay)
+
+    def stop(self):
+        """Stop the shards, then the writer once it wrote what they sent."""
+        for pid in self.children.keys():
+            self._terminate(pid)
+        self._wait_for(self.children.keys())
+        self.children = {}
+        if self.writer_pid is not None:
+            self.queue.put(None)
+            self._wait_for([self.writer_pid])
+            self.writer_pid = None
+
+    def _pid_of(self, name):
+        for pid, child in self.children.iteritems():
+            if child == name:
+                return pid
+        return None
+
+    def _terminate(self, pid):
+        self.stopping.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def _wait_for(self, pids):
+        pids = set(pids)
+        while pids:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            pids.discard(pid)
+
+    def _fork(self, func, *args):
+        pid = os.fork()
+        if pid:
+            return pid
+        exit_code = 0
+        try:
+            try:
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                func(*args)
+            except Exception:
+                log.exception('Logger process %d failed', os.getpid())
+                exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _run_writer(self):
+        # the writer stops when the supervisor sends it `None`, after the
+        # shards are gone
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        self.app.database_engine.dispose()
+        journal = Journal(os.path.join(self.app.instance_folder,
+                                       self.app.cfg['logger_journal_path']))
+        stopped = Event()
+        drainer = Thread(target=Drainer(self.app, journal).run,
+                         args=(stopped,), name='ILogJournalDrainer')
+        drainer.start()
+        try:
+            BatchWriter(self.queue, journal).run()
+        finally:
+            journal.close()
+            # whatever the drainer can't write now is written by the next
+            # writer
+            stopped.set()
+            drainer.join(self.drain_timeout)
+
+    def _run_shard(self, name, network_ids):
+        self.app.database_engine.dispose()
+        shard = self.shard_class(self.app, name, network_ids, self.queue)
+        def stop(signum, frame):
+            shard.running = False
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            shard.run()
+        finally:
+            # the process ends with `os._exit`, the events still buffered
+            # by the feeder thread of the queue have to be flushed first
+            self.queue.close()
+            self.queue.join_thread()
+
+    def _handle_stop(self, signum, frame):
+        self.running = False
+
+    def _handle_rebalance(self, signum, frame):
+        self._rebalance_now = True
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+"""
+The writer all the logger shards send their IRC events to.  It runs in a
+process of its own and appends the events in batches to the journal, with
+one sync to the disk per `BatchWriter.batch_size` events or
+`BatchWriter.flush_interval` seconds, whatever comes first.  The drainer
+of the journal writes them to the database in a thread of the same
+process (see `ilog.logger.journal`), so a slow or missing database never
+holds the shards up.
+"""
+
+import logging
+from Queue import Empty
+from time import time
+
+log = logging.getLogger(__name__)
+
+
+class BatchWriter(object):
+    """Reads events from `queue` and appends them to `journal`.  An event
+    is a dict with the columns of ``irc_events``, the network id, the
+    `nick` and `ident` of the sender and the `received` timestamp.  `None`
+    on the queue stops the writer after everything before it was synced.
+    """
+
+    #: the maximum number of events per sync
+    batch_size = 500
+
+    #: seconds an event waits for more to fill its batch at most
+    flush_interval = 0.1
+
+    def __init__(self, queue, journal):
+        self.queue = queue
+        self.journal = journal
+        self.batch = []
+
+    def run(self):
+        running = True
+        deadline = None
+        while running:
+            timeout = self.flush_interval
+            if deadline is not None:
+                timeout = max(0, deadline - time())
+            try:
+                event = self.queue.get(timeout=timeout)
+            except Empty:
+                event = False
+            if event is None:
+                running = False
+            elif event is not False:
+                if not self.batch:
+                    deadline = time() + self.flush_interval
+                self.batch.append(event)
+            if self.batch and (not running or event is False or
+                               len(self.batch) >= self.batch_size or
+                               time() >= deadline):
+                self.flush()
+                deadline = None
+
+    def flush(self):
+        """Append the collected events to the journal and sync it."""
+        self.journal.append(self.batch)
+        self.journal.sync()
+        self.batch = []
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+"""
+Prometheus style metrics that work across processes.
+
+Every process writes its values into its own memory mapped file in the
+metrics folder of the instance, updating a value is a dict lookup and a
+``struct.pack_into``.  When the metrics are scraped all the files are read
+and merged: counters and histograms are summed over all processes, also
+the ones that died, gauges only over the live processes.  The files of
+dead processes are folded into one archive file so that they don't pile
+up when workers get recycled.
+
+Until `setup` is called the values are kept in memory.
+"""
+
+import os
+import mmap
+import errno
+import fcntl
+import struct
+from bisect import bisect_left
+from glob import glob
+from threading import Lock
+
+import simplejson
+
+#: the upper bounds of the timing histogram buckets in seconds
+TIMING_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                  0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#: the buckets of the queries per request histogram
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+#: the buckets of the scheduled job durations in seconds
+JOB_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0,
+               3600.0)
+
+#: the content type of the exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_INITIAL_SIZE = 1 << 16
+_ARCHIVE_FILENAME = 'archive.db'
+_LOCK_FILENAME = 'merge.lock'
+
+#: all the known metrics by name
+REGISTRY = {}
+
+_folder = None
+_store = None
+_store_pid = None
+_store_lock = Lock()
+
+
+class MmapedValues(object):
+    """Floats stored under string keys in a memory mapped file.  The file
+    starts with the number of used bytes, followed by the entries: the
+    length of the key, the key padded to eight bytes and the value.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._f = open(filename, 'a+b')
+        if os.fstat(self._f.fileno()).st_size == 0:
+            self._f.truncate(_INITIAL_SIZE)
+        self._capacity = os.fstat(self._f.fileno()).st_size
+        self._m = mmap.mmap(self._f.fileno(), self._capacity)
+        self._used = struct.unpack_from('i', self._m, 0)[0]
+        if self._used == 0:
+            self._used = 8
+            struct.pack_into('i', self._m, 0, self._used)
+        self._positions = {}
+        for key, value, pos in _read_entries(self._m, self._used):
+            self._positions[key] = pos
+
+    def _init_value(self, key):
+        encoded = key.encode('utf-8')
+        padded = encoded + ' ' * (8 - (len(encoded) + 4) % 8)
+        entry = struct.pack('i%dsd' % len(padded), len(encoded), padded, 0.0)
+        while self._used + len(entry) > self._capacity:
+            self._capacity *= 2
+            self._f.truncate(self._capacity)
+            self._m.close()
+            self._m = mmap.mmap(self._f.fileno(), self._capacity)
+        self._m[self._used:self._used + len(entry)] = entry
+        self._used += len(entry)
+        struct.pack_into('i', self._m, 0, self._used)
+        self._positions[key] = self._used - 8
+        return self._used - 8
+
+    def add(self, key, amount):
+        pos = self._positions.get(key)
+        if pos is None:
+            pos = self._init_value(key)
+        struct.pack_into('d', self._m, pos,
+                         struct.unpack_from('d', self._m, pos)[0] + amount)
+
+    def set(self, key, value):
+        pos = self._positions.get(key)
+        if pos is None:
+            pos = self._init_value(key)
+        struct.pack_into('d', self._m, pos, value)
+
+    def items(self):
+        return [(key, value) for key, value, pos in
+                _read_entries(self._m, self._used)]
+
+    def close(self):
+        self._m.close()
+        self._f.close()
+
+
+class MemoryValues(dict):
+    """The in memory store used until the metrics are set up."""
+
+    def add(self, key, amount):
+        self[key] = self.get(key, 0.0) + amount
+
+    def set(self, key, value):
+        self[key] = value
+
+
+def _read_entries(data, used):
+    pos = 8
+    while pos < used:
+        length = struct.unpack_from('i', data, pos)[0]
+        pos += 4
+        key = data[pos:pos + length].decode('utf-8')
+        pos += length + 8 - (length + 4) % 8
+        yield key, struct.unpack_from('d', data, pos)[0], pos
+        pos += 8
+
+
+def _read_file(filename):
+    f = open(filename, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if len(data) < 8:
+        return []
+    used = min(struct.unpack_from('i', data, 0)[0], len(data))
+    return [(key, value) for key, value, pos in _read_entries(data, used)]
+
+
+def setup(folder):
+    """Keep the metrics of this process in `folder`.  This is called by
+    the application during the setup.
+    """
+    global _folder, _store, _store_pid
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    _store_lock.acquire()
+    try:
+        # the store of this process must not keep the old file open
+        if _store_pid == os.getpid() and isinstance(_store, MmapedValues):
+            _store.close()
+        _folder = folder
+        _store = _store_pid = None
+    finally:
+        _store_lock.release()
+
+
+def _get_store():
+    """Return the store of this process, a forked process gets a new one."""
+    global _store, _store_pid
+    pid = os.getpid()
+    if _store_pid != pid:
+        if _folder is None:
+            _store = MemoryValues()
+        else:
+            _store = MmapedValues(os.path.join(_folder, 'metrics_%d.db' % pid))
+        _store_pid = pid
+    return _store
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, mode='sum'):
+        self.name = name
+        self.help = help
+        self.mode = mode
+        self._keys = {}
+        REGISTRY[name] = self
+
+    def _key(self, suffix, labels):
+        cache_key = (suffix, labels)
+        rv = self._keys.get(cache_key)
+        if rv is None:
+            rv = self._keys[cache_key] = simplejson.dumps(
+                [self.name, suffix, self.mode, labels])
+        return rv
+
+    def _add(self, suffix, labels, amount):
+        key = self._key(suffix, labels)
+        _store_lock.acquire()
+        try:
+            _get_store().add(key, amount)
+        finally:
+            _store_lock.release()
+
+
+class Counter(_Metric):
+    """A value that only goes up."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self._add('_total', tuple(sorted(labels.iteritems())), amount)
+
+
+class Gauge(_Metric):
+    """A value that goes up and down.  Of the live processes the values
+    are either summed up (``'sum'``) or the maximum is used (``'max'``).
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key('', tuple(sorted(labels.iteritems())))
+        _store_lock.acquire()
+        try:
+            _get_store().set(key, value)
+        finally:
+            _store_lock.release()
+
+
+class Histogram(_Metric):
+    """Counts the observed values in fixed buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=TIMING_BUCKETS):
+        _Metric.__init__(self, name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        labels = tuple(sorted(labels.iteritems()))
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            bucket = self.buckets[index]
+        else:
+            bucket = '+Inf'
+        _store_lock.acquire()
+        try:
+            store = _get_store()
+            store.add(self._key('_bucket', labels + (('le', bucket),)), 1)
+            store.add(self._key('_sum', labels), value)
+        finally:
+            _store_lock.release()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _fold_dead_processes(folder):
+    """Add the counters and histograms of the dead processes to the archive
+    and remove their files.  Must be called with the merge lock held.
+    """
+    dead = []
+    for filename in glob(os.path.join(folder, 'metrics_*.db')):
+        pid = int(os.path.basename(filename)[8:-3])
+        if not _pid_alive(pid):
+            dead.append(filename)
+    if not dead:
+        return
+    archive = MmapedValues(os.path.join(folder, _ARCHIVE_FILENAME))
+    try:
+        for filename in dead:
+            for key, value in _read_file(filename):
+                # only the gauges have no suffix, they die with the process
+                if simplejson.loads(key)[1]:
+                    archive.add(key, value)
+            os.remove(filename)
+    finally:
+        archive.close()
+
+
+def collect(folder=None):
+    """Merge the values of all processes.  Returns a dict mapping the metric
+    names to lists of ``(suffix, labels, value)``.
+    """
+    folder = folder or _folder
+    if folder is None:
+        sources = [(True, _get_store().items())]
+    else:
+        lock = open(os.path.join(folder, _LOCK_FILENAME), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            _fold_dead_processes(folder)
+            sources = []
+            for filename in glob(os.path.join(folder, 'metrics_*.db')):
+                sources.append((True, _read_file(filename)))
+            archive = os.path.join(folder, _ARCHIVE_FILENAME)
+            if os.path.isfile(archive):
+                sources.append((False, _read_file(archive)))
+        finally:
+            lock.close()
+
+    merged = {}
+    for alive, items in sources:
+        for key, value in items:
+            name, suffix, mode, labels = simplejson.loads(key)
+            metric = REGISTRY.get(name)
+            if metric is None:
+                continue
+            labels = tuple(tuple(x) for x in labels)
+            if metric.kind == 'gauge':
+                if not alive:
+                    continue
+                if (name, suffix, labels) in merged and mode == 'max':
+                    value = max(value, merged[name, suffix, labels])
+                elif (name, suffix, labels) in merged:
+                    value += merged[name, suffix, labels]
+            else:
+                value += merged.get((name, suffix, labels), 0.0)
+            merged[name, suffix, labels] = value
+
+    rv = {}
+    for (name, suffix, labels), value in merged.iteritems():
+        rv.setdefault(name, []).append((suffix, labels, value))
+    return rv
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, unicode(value).replace(
+        '\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels)
+
+
+def _format_value(value):
+    if value == int(value):
+        return '%d' % value
+    return repr(value)
+
+
+def generate_latest(folder=None):
+    """Return the metrics of all processes in the text exposition format."""
+    collected = collect(folder)
+    lines = []
+    for name in sorted(collected):
+        metric = REGISTRY[name]
+        lines.append('# HELP %s %s' % (name, metric.help))
+        lines.append('# TYPE %s %s' % (name, metric.kind))
+        samples = collected[name]
+        if metric.kind != 'histogram':
+            for suffix, labels, value in sorted(samples):
+                lines.append('%s%s%s %s' % (name, suffix,
+                             _format_labels(labels), _format_value(value)))
+            continue
+
+        # the buckets are stored per bucket, exported cumulative
+        series = {}
+        for suffix, labels, value in samples:
+            if suffix == '_bucket':
+                bucket = labels[-1][1]
+                series.setdefault(labels[:-1], [{}, 0.0])[0][bucket] = value
+            else:
+                series.setdefault(labels, [{}, 0.0])[1] = value
+        for labels in sorted(series):
+            counts, total = series[labels]
+            cumulative = 0
+            for bucket in metric.buckets + ('+Inf',):
+                cumulative += counts.get(bucket, 0)
+                lines.append('%s_bucket%s %s' % (name, _format_labels(
+                    labels + (('le', bucket),)), _format_value(cumulative)))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels),
+                                          _format_value(total)))
+            lines.append('%s_count%s %s' % (name, _format_labels(labels),
+                                            _format_value(cumulative)))
+    return '\n'.join(lines) + '\n'
+
+
+#: the metrics of ILog itself
+requests = Counter('ilog_requests', 'The handled requests by endpoint and '
+                   'status code.')
+request_duration = Histogram('ilog_request_duration_seconds', 'The time '
+                             'spent handling the requests by endpoint.')
+request_phases = Histogram('ilog_request_phase_seconds', 'The time spent in '
+                           'the phases of the requests.')
+request_queries = Histogram('ilog_request_queries', 'The database queries '
+                            'per request.', QUERY_BUCKETS)
+cache_requests = Counter('ilog_cache_requests', 'The cache lookups by '
+                         'backend and result.')
+db_pool_connections = Gauge('ilog_db_pool_connections', 'The connections '
+                            'of the database pools by state.')
+mail_queue_depth = Gauge('ilog_mail_queue_depth', 'The mails waiting for '
+                         'delivery.', mode='max')
+logger_events = Counter('ilog_logger_events', 'The IRC events written by '
+                        'the loggers by network.')
+logger_lag = Gauge('ilog_logger_lag_seconds', 'The time between receiving '
+                   'and storing the IRC events by network.', mode='max')
+logger_server_lag = Gauge('ilog_logger_server_lag_seconds', 'The smoothed '
+                          'PING round-trip time of the IRC servers by network '
+                          'and server.', mode='max')
+job_runs = Counter('ilog_job_runs', 'The runs of the scheduled jobs by job '
+                   'and status.')
+job_duration = Histogram('ilog_job_duration_seconds', 'The time the '
+                         'scheduled jobs took by job.', JOB_BUCKETS)
+
+
+def observe_request(request, response):
+    """Add a finished request to the metrics."""
+    endpoint = getattr(request, 'endpoint', None) or 'unknown'
+    requests.inc(endpoint=endpoint, status=response.status_code)
+    for name, duration in request.timings:
+        if name == 'total':
+            request_duration.observe(duration, endpoint=endpoint)
+        else:
+            request_phases.observe(duration, phase=name)
+    request_queries.observe(request.query_count, endpoint=endpoint)
+    pool = request.app.database_engine.pool
+    if hasattr(pool, 'checkedout'):
+        db_pool_connections.set(pool.checkedout(), state='checked_out')
+        db_pool_connections.set(pool.size(), state='size')
+
+
+def format_server_timing(timings):
+    """Format the timings as value for the ``Server-Timing`` header."""
+    return ', '.join('%s;dur=%.3f' % (name, duration * 1000)
+                     for name, duration in timings)
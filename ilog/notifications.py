@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+import os
+import fcntl
+import logging
+from cStringIO import StringIO
+from datetime import datetime
+from pprint import pprint
+from threading import Event, Lock, Thread
+from time import time
+
+from ilog.utils.exceptions import summarize_exception
+
+log = logging.getLogger(__name__)
+
+#: the file in the instance folder the processes agree on the time of the
+#: last digest with
+_STAMP_FILENAME = 'error_notification.stamp'
+
+
+def _error_text(error):
+    # messages of exceptions may be byte strings in any encoding
+    try:
+        return unicode(error)
+    except UnicodeError:
+        return str(error).decode('utf-8', 'replace')
+
+
+def get_error_fingerprint(error, exc_info=None):
+    """Return a key that is the same for all occurrences of an error.  If
+    a traceback is available that's the exception type and the location
+    it was raised at, otherwise the exception type and its message.
+    """
+    if exc_info is not None and exc_info[2] is not None:
+        summary, (filename, lineno) = summarize_exception(exc_info)
+        return '%s:%s:%s' % (error.__class__.__name__, filename, lineno)
+    return u'%s:%s' % (error.__class__.__name__, _error_text(error))
+
+
+class ErrorNotifier(object):
+    """Collects the internal errors and mails a digest to the administrators
+    once every `interval` seconds at most.  Errors are grouped by their
+    fingerprint and only the request details of the first occurrence are
+    kept, all other occurrences just increase the counter.
+
+    The digest is built and queued by a background thread so the failing
+    requests don't have to wait for it.  Every process collects its own
+    errors, the processes of an instance agree on the time of the last
+    digest through a file in the instance folder, so that all of them
+    together send one digest per interval at most.  The errors of the
+    processes that have to wait are sent with one of the next digests.
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._errors = {}
+        self._order = []
+        self._admin_emails = []
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+        self._pid = None
+
+    def notify(self, request, error, exc_info=None):
+        """Record an error that happened while handling `request`."""
+        fingerprint = get_error_fingerprint(error, exc_info)
+        now = datetime.utcnow()
+        self._lock.acquire()
+        try:
+            entry = self._errors.get(fingerprint)
+            if entry is not None:
+                entry['count'] += 1
+                entry['last_seen'] = now
+                return
+            request_buffer = StringIO()
+            pprint(request.__dict__, request_buffer)
+            self._errors[fingerprint] = {
+                'fingerprint':  fingerprint,
+                'error':        _error_text(error),
+                'request':      request_buffer.getvalue(),
+                'count':        1,
+                'first_seen':   now,
+                'last_seen':    now
+            }
+            self._order.append(fingerprint)
+        finally:
+            self._lock.release()
+        self.ensure_running()
+
+    def ensure_running(self):
+        """Start the digest thread if it's not running in this process."""
+        if self._pid == os.getpid() or self._stopped.isSet():
+            return
+        self._lock.acquire()
+        try:
+            if self._pid == os.getpid() or self._stopped.isSet():
+                return
+            self._thread = Thread(target=self._work, name='ILogErrorNotifier')
+            self._thread.setDaemon(True)
+            self._thread.start()
+            self._pid = os.getpid()
+        finally:
+            self._lock.release()
+
+    def stop(self, timeout=10):
+        """Stop the digest thread of this process, the errors collected
+        so far are sent first.
+        """
+        self._lock.acquire()
+        try:
+            self._stopped.set()
+            thread = self._thread
+            if self._pid != os.getpid():
+                thread = None
+            self._thread = None
+        finally:
+            self._lock.release()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _get_admin_emails(self):
+        """Return the addresses of the administrators.  If the database is
+        not reachable, which might very well be the reason for the errors,
+        the last known addresses are used.
+        """
+        from ilog.database import Privilege, cleanup_session
+        try:
+            try:
+                admins = Privilege.query.get('ILOG_ADMIN').priveliged_users
+                self._admin_emails = [admin.email for admin in admins]
+            except Exception:
+                log.exception('Could not look up the administrators, using '
+                              'the last known addresses')
+        finally:
+            cleanup_session()
+        return self._admin_emails
+
+    def flush(self):
+        """Send the digest of the errors collected so far."""
+        from ilog.i18n import _
+        from ilog.utils.mail import send_email
+        self._lock.acquire()
+        try:
+            errors = [self._errors[key] for key in self._order]
+            self._errors = {}
+            self._order = []
+        finally:
+            self._lock.release()
+        if not errors:
+            return
+        if not self._claim_digest():
+            self._restore(errors)
+            return
+
+        recipients = self._get_admin_emails()
+        if not recipients:
+            log.error('Dropping the notification of %d errors, no '
+                      'administrator to send it to', len(errors))
+            return
+        template = self.app.template_env.get_template(
+                                            'mails/error_notification.txt')
+        email_contents = template.render(errors=errors)
+        send_email(_(u"Server Errors on ILog"), email_contents, recipients)
+
+    def _claim_digest(self):
+        """Return `True` if no process sent a digest within the interval,
+        the time of this one is recorded then.
+        """
+        filename = os.path.join(self.app.instance_folder, _STAMP_FILENAME)
+        try:
+            f = open(filename, 'a+')
+        except IOError:
+            log.exception('Could not open %s, sending the digest', filename)
+            return True
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                last_sent = float(f.read().strip() or 0)
+            except ValueError:
+                last_sent = 0
+            now = time()
+            if 0 <= now - last_sent < self.interval:
+                return False
+            f.seek(0)
+            f.truncate()
+            f.write('%f' % now)
+            f.flush()
+            return True
+        finally:
+            f.close()
+
+    def _restore(self, errors):
+        """Put the errors of a digest that was not sent back in front of
+        the ones collected in the meantime.
+        """
+        self._lock.acquire()
+        try:
+            for entry in reversed(errors):
+                fingerprint = entry['fingerprint']
+                newer = self._errors.get(fingerprint)
+                if newer is not None:
+                    entry['count'] += newer['count']
+                    entry['last_seen'] = newer['last_seen']
+                    self._order.remove(fingerprint)
+                self._errors[fingerprint] = entry
+                self._order.insert(0, fingerprint)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while not self._stopped.isSet():
+            self._stopped.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Could not send the error notification')
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+"""
+A preforking HTTP server for production.
+
+The master process sets the application up once, loads everything that is
+loaded lazily otherwise (templates, translations, url map) and then forks
+the workers, which share that memory copy-on-write and accept connections
+on the socket the master opened.  A worker exits after a configurable
+number of requests and the master replaces it.
+
+Signals: ``TERM`` and ``INT`` shut the server down, ``HUP`` replaces all
+workers gracefully, they finish their current request first.
+"""
+
+import os
+import errno
+import select
+import signal
+import socket
+import logging
+from random import randint
+from time import sleep
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+log = logging.getLogger(__name__)
+
+
+class _RequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        log.info('%s - %s', self.address_string(), format % args)
+
+
+def warm_up(app):
+    """Load the templates, translations and url rules the application would
+    otherwise load on the first requests.
+    """
+    from ilog import i18n
+    env = app.template_env
+    for name in env.list_templates():
+        try:
+            env.get_template(name)
+        except Exception:
+            log.exception('Could not load template %r', name)
+    i18n.load_all_translations()
+    # matching compiles and sorts the rules of the url map
+    try:
+        app.url_adapter.match('/')
+    except Exception:
+        pass
+
+
+class PreforkServer(object):
+    """Runs `workers` worker processes for the application in
+    `instance_folder`.  Every worker handles up to `max_requests` requests,
+    give or take ten percent so that they are not all replaced at once.
+    """
+
+    def __init__(self, instance_folder, host='127.0.0.1', port=4000,
+                 workers=4, max_requests=1000, backlog=128):
+        self.instance_folder = instance_folder
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_requests = max_requests
+        self.backlog = backlog
+        self.children = set()
+        self.running = False
+        self.app = None
+        self.socket = None
+
+    def setup(self):
+        """Set up the application and open the socket in the master."""
+        from ilog import _core
+        self.app = _core.setup(self.instance_folder)
+        warm_up(self.app)
+        # the workers create their own connections
+        self.app.database_engine.dispose()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(self.backlog)
+        # all workers wait for the same socket, the ones that lose the race
+        # for a connection must not block in accept
+        self.socket.setblocking(0)
+
+    def serve_forever(self):
+        if self.app is None:
+            self.setup()
+        self.running = True
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_recycle)
+        log.info('Serving on http://%s:%d/ with %d workers', self.host,
+                 self.port, self.workers)
+        try:
+            while self.running:
+                while len(self.children) < self.workers:
+                    self.spawn_worker()
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno == errno.ECHILD:
+                        sleep(0.1)
+                        continue
+                    raise
+                self.children.discard(pid)
+        finally:
+            self.stop_workers()
+            self.socket.close()
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+        exit_code = 0
+        try:
+            try:
+                self.run_worker()
+            except Exception:
+                log.exception('Worker %d failed', os.getpid())
+                exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def stop_workers(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                self.children.discard(pid)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            self.children.discard(pid)
+
+    def _handle_stop(self, signum, frame):
+        self.running = False
+
+    def _handle_recycle(self, signum, frame):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run_worker(self):
+        """The main loop of a worker process."""
+        state = {'running': True, 'handled': 0}
+        def stop(signum, frame):
+            state['running'] = False
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+        # a forked process must not share the connections of its parent
+        self.app.database_engine.dispose()
+
+        app = self.app
+        def application(environ, start_response):
+            # configuration changes are applied like the development
+            # dispatcher does, code changes need a restart of the server
+            state['handled'] += 1
+            if app.cfg.changed_external:
+                app.reload_config()
+            return app(environ, start_response)
+
+        server = WSGIServer((self.host, self.port), _RequestHandler,
+                            bind_and_activate=False)
+        server.socket.close()
+        server.socket = self.socket
+        server.server_name = socket.getfqdn(self.host)
+        server.server_port = self.port
+        server.setup_environ()
+        server.set_app(application)
+        server.timeout = 1
+
+        limit = self.max_requests + randint(-self.max_requests // 10,
+                                            self.max_requests // 10)
+        while state['running'] and state['handled'] < limit:
+            try:
+                server.handle_request()
+            except (socket.error, select.error), e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        log.debug('Worker %d exits after %d requests', os.getpid(),
+                  state['handled'])
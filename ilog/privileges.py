@@ -148,20 +148,23 @@ def bind_privileges(container, privileges, user=None):
 #                if privilege in privs.iter_privileges():
 #                    db.session.delete(notification)
 
-    # add new privileges
+    # add new privileges and the ones they depend on, the rows are looked up
+    # all at once and the missing ones created
+    names = []
     for name in new_privileges.difference(currently_attached):
         privilege = app.privileges[name]
-        db_privilege = DBPrivilege.query.get(privilege.name)
-        if not db_privilege:
-            db_privilege = DBPrivilege(privilege.name)
-        container.add(db_privilege)
-        # add dependable privileges
+        names.append(privilege.name)
         if privilege.dependencies:
-            for privilege in privilege.dependencies.iter_privileges():
-                db_privilege = DBPrivilege.query.get(privilege.name)
-                if not db_privilege:
-                    db_privilege = DBPrivilege(privilege.name)
-                container.add(db_privilege)
+            names.extend(x.name for x in
+                         privilege.dependencies.iter_privileges())
+    if not names:
+        return
+    db_privileges = DBPrivilege.query.get_many(names)
+    for name in names:
+        db_privilege = db_privileges.get(name)
+        if db_privilege is None:
+            db_privilege = db_privileges[name] = DBPrivilege(name)
+        container.add(db_privilege)
 
 
 def require_privilege(expr):
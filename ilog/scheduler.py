@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+"""
+The scheduler for the periodic maintenance jobs of ILog.
+
+Jobs are declared in the modules that implement them with the `job`
+decorator::
+
+    @job('purge_sessions', '17 * * * *')
+    def purge_sessions(app):
+        ...
+
+The schedule is either a number of seconds or a cron expression
+(``minute hour day month weekday``, in UTC).  Either way the runs fall on
+fixed points in time, the same for all processes, which allows the
+processes to agree on who runs which.
+
+Every web process runs a scheduler (``app.scheduler``) in a background
+thread that is started with the first request.  When a run of a job is
+due, the processes race for it in the ``scheduler_locks`` table and only
+the one that claims it runs the job, so a job runs once per schedule no
+matter how many workers and nodes there are.  Jobs declared as ``local``
+deal with something every node has of its own, like a folder on the local
+disk; they are claimed per host and run once on every node.  The jobs are
+run by a small
+pool of threads of their own, the durations are kept on the lock rows and
+in the metrics.
+"""
+
+import os
+import socket
+import logging
+from calendar import timegm
+from datetime import datetime, timedelta
+from Queue import Queue
+from threading import Event, Lock, Thread
+from time import time
+
+from ilog import metrics
+
+log = logging.getLogger(__name__)
+
+#: the declared jobs by name, see `job`
+JOBS = {}
+
+#: shortcuts for common cron expressions
+CRON_ALIASES = {
+    '@hourly':  '0 * * * *',
+    '@daily':   '0 0 * * *',
+    '@weekly':  '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly':  '0 0 1 1 *'
+}
+
+
+def job(name, schedule, setting=None, timeout=3600, local=False):
+    """Declare the decorated function as a job run on `schedule`.  If
+    `setting` is given the configuration value of that name, if set,
+    replaces the schedule.  A process that claimed a run is expected to
+    finish it within `timeout` seconds, afterwards the others consider it
+    dead and claim the next run themselves.  A `local` job is run once on
+    every host instead of once in the cluster.
+    """
+    def decorator(f):
+        JOBS[name] = (f, schedule, setting, timeout, local)
+        return f
+    return decorator
+
+
+class IntervalSchedule(object):
+    """Every `seconds` seconds, counted from the epoch."""
+
+    def __init__(self, seconds):
+        self.seconds = int(seconds)
+        if self.seconds <= 0:
+            raise ValueError('the interval must be positive')
+
+    def next_after(self, stamp):
+        return (int(stamp) // self.seconds + 1) * self.seconds
+
+    def __repr__(self):
+        return '<%s %ds>' % (self.__class__.__name__, self.seconds)
+
+
+class CronSchedule(object):
+    """The points in time matching a cron expression, in UTC."""
+
+    _fields = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        self.expression = CRON_ALIASES.get(expression.strip(), expression)
+        parts = self.expression.split()
+        if len(parts) != 5:
+            raise ValueError('a cron expression has five fields: %r' %
+                             expression)
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            self._parse_field(part, low, high)
+            for part, (low, high) in zip(parts, self._fields)]
+        # sunday is both 0 and 7
+        self.weekdays = frozenset(x % 7 for x in weekdays)
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    def _parse_field(self, field, low, high):
+        values = set()
+        for item in field.split(','):
+            step = 1
+            if '/' in item:
+                item, step = item.split('/', 1)
+                step = int(step)
+            if item == '*':
+                start, end = low, high
+            elif '-' in item:
+                start, end = map(int, item.split('-', 1))
+            else:
+                start = end = int(item)
+                if step != 1:
+                    end = high
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError('invalid cron field: %r' % field)
+            values.update(xrange(start, end + 1, step))
+        return frozenset(values)
+
+    def _day_matches(self, dt):
+        # like cron, if both the day and the weekday are restricted either
+        # of them has to match
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def next_after(self, stamp):
+        dt = datetime.utcfromtimestamp(int(stamp) // 60 * 60) + \
+             timedelta(minutes=1)
+        # five years cover every valid expression, even the 29th of february
+        limit = dt + timedelta(days=5 * 366)
+        while dt < limit:
+            if dt.month not in self.months:
+                year, month = divmod(dt.month, 12)
+                dt = datetime(dt.year + year, month + 1, 1)
+            elif not self._day_matches(dt):
+                dt = datetime(dt.year, dt.month, dt.day) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = datetime(dt.year, dt.month, dt.day, dt.hour) + \
+                     timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return timegm(dt.utctimetuple())
+        raise ValueError('%r never matches' % self.expression)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.expression)
+
+
+def parse_schedule(schedule):
+    """Return the schedule for a number of seconds or a cron expression."""
+    if isinstance(schedule, (int, long, float)):
+        return IntervalSchedule(schedule)
+    schedule = schedule.strip()
+    if schedule.isdigit():
+        return IntervalSchedule(int(schedule))
+    return CronSchedule(schedule)
+
+
+class Job(object):
+    """A declared job bound to a scheduler."""
+
+    def __init__(self, name, func, schedule, timeout=3600, local=False):
+        self.name = name
+        self.func = func
+        self.schedule = schedule
+        self.timeout = timeout
+        self.local = local
+        self.next_run = schedule.next_after(time())
+        self.running = False
+        self.last_run = None
+        self.last_duration = None
+
+    @property
+    def lock_name(self):
+        """The name the runs are claimed under, per host for local jobs."""
+        if self.local:
+            # the short host name, the lock names are 50 characters at most
+            host = socket.gethostname().split('.', 1)[0]
+            return ('%s@%s' % (self.name, host))[:50]
+        return self.name
+
+    def __repr__(self):
+        return '<%s %r %r>' % (self.__class__.__name__, self.name,
+                               self.schedule)
+
+
+class Scheduler(object):
+    """Runs the declared jobs of an application."""
+
+    #: seconds the thread sleeps at most
+    poll_interval = 60
+
+    def __init__(self, app):
+        self.app = app
+        self.jobs = {}
+        self.identity = None
+        self._queue = Queue()
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._lock = Lock()
+        self._threads = []
+        self._pid = None
+        self.update_schedules()
+
+    @property
+    def settings(self):
+        """The configuration keys the schedules depend on."""
+        return set(x[2] for x in JOBS.itervalues() if x[2] is not None)
+
+    def update_schedules(self):
+        """(Re)create the jobs from the declarations and the configuration.
+        A job whose schedule can't be parsed is left out.
+        """
+        schedules = {}
+        for name, (func, schedule, setting, timeout, local) in \
+                JOBS.iteritems():
+            if setting is not None and self.app.cfg[setting]:
+                schedule = self.app.cfg[setting]
+            try:
+                schedules[name] = parse_schedule(schedule)
+            except ValueError, e:
+                log.error('Not scheduling job %r: %s', name, e)
+        self._lock.acquire()
+        try:
+            jobs = {}
+            for name, schedule in schedules.iteritems():
+                func, timeout, local = JOBS[name][0], JOBS[name][3], \
+                                       JOBS[name][4]
+                # a job that is running keeps its object, that's the one
+                # the job thread resets when it's done
+                job = self.jobs.get(name)
+                if job is None:
+                    job = Job(name, func, schedule, timeout, local)
+                else:
+                    job.func = func
+                    job.schedule = schedule
+                    job.timeout = timeout
+                    job.local = local
+                    job.next_run = schedule.next_after(time())
+                jobs[name] = job
+            self.jobs = jobs
+        finally:
+            self._lock.release()
+        self._wakeup.set()
+
+    def ensure_running(self):
+        """Start the scheduler thread and the job threads if they are not
+        running in this process and the scheduler is enabled.
+        """
+        if self._pid == os.getpid() or self._stopped.isSet() or \
+           not self.app.cfg['scheduler_enabled']:
+            return
+        self._lock.acquire()
+        try:
+            if self._pid == os.getpid() or self._stopped.isSet():
+                return
+            self.identity = '%s:%d' % (socket.gethostname(), os.getpid())
+            self._queue = Queue()
+            self._threads = []
+            for idx in xrange(max(1, self.app.cfg['scheduler_workers'])):
+                thread = Thread(target=self._run_jobs,
+                                name='ILogSchedulerWorker-%d' % idx)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+            thread = Thread(target=self._work, name='ILogScheduler')
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+            self._pid = os.getpid()
+        finally:
+            self._lock.release()
+
+    def stop(self, timeout=10):
+        """Stop the threads of this process, no more runs are claimed.  A
+        job that is running is finished, waiting for it ends after
+        `timeout` seconds.
+        """
+        self._lock.acquire()
+        try:
+            self._stopped.set()
+            self._wakeup.set()
+            threads = self._threads
+            if self._pid != os.getpid():
+                # the threads of the parent process don't exist here
+                threads = []
+            else:
+                for thread in threads:
+                    self._queue.put(None)
+            self._threads = []
+        finally:
+            self._lock.release()
+        deadline = time() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time()))
+
+    def dispatch_pending(self, now=None):
+        """Hand the due jobs to the job threads and return the time the
+        next one is due.
+        """
+        if now is None:
+            now = time()
+        self._lock.acquire()
+        try:
+            if self._stopped.isSet():
+                return now + self.poll_interval
+            for job in self.jobs.itervalues():
+                if job.next_run > now:
+                    continue
+                scheduled = job.next_run
+                job.next_run = job.schedule.next_after(now)
+                if job.running:
+                    log.warning('Job %r is still running, skipping the run '
+                                'scheduled for %s', job.name,
+                                datetime.utcfromtimestamp(scheduled))
+                    continue
+                job.running = True
+                self._queue.put((job, scheduled))
+            return min([job.next_run for job in self.jobs.itervalues()] +
+                       [now + self.poll_interval])
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        self._create_lock_table()
+        while not self._stopped.isSet():
+            next_run = time() + self.poll_interval
+            # the scheduler might have been disabled in the meantime
+            if self.app.cfg['scheduler_enabled']:
+                try:
+                    next_run = self.dispatch_pending()
+                except Exception:
+                    log.exception('Could not dispatch the scheduled jobs')
+            if self._stopped.isSet():
+                break
+            self._wakeup.wait(max(0, next_run - time()))
+            self._wakeup.clear()
+
+    def _run_jobs(self):
+        while 1:
+            item = self._queue.get()
+            if item is None:
+                return
+            job, scheduled = item
+            try:
+                self.run_job(job, scheduled)
+            finally:
+                job.running = False
+
+    def run_job(self, job, scheduled):
+        """Run `job` for the run scheduled at `scheduled` (a timestamp) if
+        this process manages to claim it.
+        """
+        from ilog.database import cleanup_session
+        scheduled = datetime.utcfromtimestamp(scheduled)
+        try:
+            if not self._claim(job, scheduled):
+                log.debug('Run of %r at %s claimed by another process',
+                          job.name, scheduled)
+                return
+        except Exception:
+            log.exception('Could not claim the run of job %r', job.name)
+            return
+
+        started = time()
+        status = 'ok'
+        try:
+            try:
+                job.func(self.app)
+            except Exception:
+                status = 'failed'
+                log.exception('Job %r failed', job.name)
+        finally:
+            cleanup_session()
+        duration = time() - started
+        job.last_run = started
+        job.last_duration = duration
+        metrics.job_runs.inc(job=job.name, status=status)
+        metrics.job_duration.observe(duration, job=job.name)
+        log.info('Job %r finished (%s) in %.3fs', job.name, status, duration)
+        try:
+            self._release(job, duration, status)
+        except Exception:
+            log.exception('Could not release the run of job %r', job.name)
+
+    # -- the lock table -------------------------------------------------------
+
+    def _create_lock_table(self):
+        from ilog.database import SchedulerLock
+        try:
+            SchedulerLock.__table__.create(bind=self.app.database_engine,
+                                           checkfirst=True)
+        except Exception:
+            log.exception('Could not create the scheduler lock table')
+
+    def _claim(self, job, scheduled):
+        """Claim the run of `job` at `scheduled`.  A run can be claimed if
+        it's later than the last claimed one and nobody holds the lock or
+        the holder exceeded the timeout of the job.
+        """
+        from sqlalchemy.exc import IntegrityError
+        from ilog.database import db, SchedulerLock
+        table = SchedulerLock.__table__
+        engine = self.app.database_engine
+        now = datetime.utcnow()
+        values = dict(scheduled=scheduled, holder=self.identity,
+                      locked_until=now + timedelta(seconds=job.timeout))
+        result = engine.execute(table.update(db.and_(
+            table.c.name == job.lock_name,
+            table.c.scheduled < scheduled,
+            db.or_(table.c.locked_until == None,
+                   table.c.locked_until < now))), **values)
+        if result.rowcount:
+            return True
+        try:
+            engine.execute(table.insert(), name=job.lock_name, **values)
+        except IntegrityError:
+            # the job is known, the run was claimed or the job is running
+            return False
+        return True
+
+    def _release(self, job, duration, status):
+        from ilog.database import db, SchedulerLock
+        table = SchedulerLock.__table__
+        self.app.database_engine.execute(table.update(db.and_(
+            table.c.name == job.lock_name,
+            table.c.holder == self.identity)),
+            locked_until=None, last_duration=duration, last_status=status)
+
+
+@job('expire_activations', 3600, setting='activation_expiry_interval')
+def expire_activations(app):
+    """Delete the accounts that were not activated in time."""
+    from ilog.database import db, User
+    deleted = User.query.delete_too_old_activations()
+    db.commit()
+    if deleted:
+        log.info('Deleted %d expired account registrations', deleted)
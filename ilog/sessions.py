@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.sessions
+    ~~~~~~~~~~~~~
+
+    This module implements the session handling.  By default the session
+    data is stored in a signed cookie serialized as JSON, which is a lot
+    smaller and cheaper to load than pickle.  If the sessions get big the
+    data can be kept on the server instead, the cookie then only holds the
+    session id.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+from time import time
+
+import simplejson
+from werkzeug.contrib.securecookie import SecureCookie
+
+from ilog.scheduler import job
+
+
+#: the lifetime of permanent sessions in seconds
+PERMANENT_SESSION_LIFETIME = 60 * 60 * 24 * 31
+
+
+class JSONSecureCookie(SecureCookie):
+    """A secure cookie that serializes the values with JSON instead of
+    pickle.  Tuples come back as lists.
+    """
+    serialization_method = simplejson
+
+
+def get_session_store(app):
+    """Return the server side session store for the application or `None`
+    if the session data is stored in the cookie.  This is called during the
+    application setup by the application itself.
+    """
+    return stores[app.cfg['session_store']](app)
+
+
+def load_session(app, request):
+    """Load the session for the request."""
+    cookie_name = app.cfg['cookie_name']
+    if app.session_store is None:
+        return JSONSecureCookie.load_cookie(request, cookie_name,
+                                            app.secret_key)
+    sid = request.cookies.get(cookie_name)
+    if not sid or not app.session_store.is_valid_key(sid):
+        return app.session_store.new()
+    return app.session_store.get(sid)
+
+
+def renew_session(app, session):
+    """Return a copy of `session` under a new session id, the old one is
+    removed from the store.  Called on login and logout so that a session
+    id planted by somebody else never becomes an authenticated session.
+    Cookie sessions carry no id and are returned as they are.
+    """
+    if app.session_store is None:
+        return session
+    new_session = app.session_store.new()
+    new_session.update(session)
+    # the new id has to reach the client even if the session is empty
+    new_session.modified = True
+    if not session.new:
+        app.session_store.delete(session)
+    return new_session
+
+
+def save_session(app, request, response):
+    """Save the session of the request if it was changed."""
+    session = request.session
+    if not session.should_save:
+        return
+    cookie_name = app.cfg['cookie_name']
+    if session.get('pmt'):
+        max_age = PERMANENT_SESSION_LIFETIME
+        expires = time() + max_age
+    else:
+        max_age = expires = None
+
+    if app.session_store is None:
+        # set the secret key explicitly at the end of the request
+        # to not log out the administrator if he changes the secret
+        # key in the config editor.
+        session.secret_key = app.secret_key
+        session.save_cookie(response, cookie_name, max_age=max_age,
+                            expires=expires, session_expires=expires)
+    elif not session:
+        app.session_store.delete(session)
+        response.delete_cookie(cookie_name)
+    else:
+        app.session_store.save(session)
+        response.set_cookie(cookie_name, session.sid, max_age=max_age,
+                            expires=expires, httponly=True)
+
+
+def _get_filesystem_store(app):
+    from werkzeug.contrib.sessions import FilesystemSessionStore
+    path = os.path.join(app.instance_folder, app.cfg['session_path'])
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    # session ids the client made up are replaced by fresh ones
+    return FilesystemSessionStore(path, renew_missing=True)
+
+
+@job('purge_sessions', '17 * * * *', local=True)
+def purge_sessions(app):
+    """Remove the session files of the filesystem store that were not
+    written for longer than a permanent session lives.  The session folder
+    can be on the local disk of every node, so this runs on all of them.
+    """
+    store = app.session_store
+    if store is None or not hasattr(store, 'filename_template'):
+        return
+    prefix, suffix = store.filename_template.split('%s', 1)
+    deadline = time() - PERMANENT_SESSION_LIFETIME
+    for filename in os.listdir(store.path):
+        if not (filename.startswith(prefix) and filename.endswith(suffix)):
+            continue
+        filename = os.path.join(store.path, filename)
+        try:
+            if os.path.getmtime(filename) < deadline:
+                os.remove(filename)
+        except OSError:
+            # removed by somebody else in the meantime
+            pass
+
+
+#: the session store factories.
+stores = {
+    'cookie':       lambda app: None,
+    'filesystem':   _get_filesystem_store
+}
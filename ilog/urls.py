@@ -95,5 +95,6 @@ urls_map = Map([
             Rule('/cache', endpoint='admin.options.cache'),
         ])
     ]),
+    Rule('/metrics', endpoint='metrics'),
     Rule('/_static/<string:path>', endpoint='static', build_only=True)
 ], default_subdomain='', charset='utf-8', strict_slashes=True)
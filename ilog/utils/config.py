@@ -5,7 +5,7 @@
 
     This module implements the configuration.  The configuration is a more or
     less flat thing saved as ini in the instance folder.  If the configuration
-    changes the application is reloaded automatically.
+    changes the new values are applied to the running application.
 
 
     :copyright: (c) 2010 by the Zine Team, see AUTHORS for more details.
@@ -14,6 +14,7 @@
 import os
 import logging
 from os import path
+from tempfile import mkstemp
 from threading import Lock
 
 from ilog.i18n import lazy_gettext, _
@@ -153,7 +154,7 @@ class Configuration(object):
         self.config_vars = default_vars.copy()
         self.hidden_keys = hidden_keys
         self._values = {}
-        self._converted_values = {}
+        self._snapshot = {}
         self._comments = {}
         self._lock = Lock()
 
@@ -162,13 +163,24 @@ class Configuration(object):
         if not path.exists(self.filename):
             self.exists = False
             self._load_time = 0
-            return
-
-        # otherwise parse the file and copy all values into the internal
-        # values dict.  Do that also for values not covered by the current
-        # `config_vars` dict to preserve variables of disabled plugins
-        self._load_time = path.getmtime(self.filename)
-        self.exists = True
+            self._snapshot = self._make_snapshot(self._values)
+        else:
+            self.exists = True
+            self._load()
+        #: the snapshot the application was built from or last applied, see
+        #: `reload`
+        self._applied_snapshot = self._snapshot
+
+    def _load(self):
+        """Parse the configuration file and replace the values, comments and
+        the snapshot with the ones found in the file.
+        """
+        # parse the file and copy all values into the internal values dict.
+        # Do that also for values not covered by the current `config_vars`
+        # dict to preserve variables of disabled plugins
+        load_time = path.getmtime(self.filename)
+        values = {}
+        comments = {}
         section = self.main_section
         current_comment = ''
         f = file(self.filename)
@@ -181,43 +193,71 @@ class Configuration(object):
                 elif line[0] == '[' and line[-1] == ']':
                     section = line[1:-1].strip()
                     if current_comment.strip():
-                        self._comments['[%s]' % section] = current_comment
+                        comments['[%s]' % section] = current_comment
                     current_comment = ''
                 elif '=' not in line:
                     key = line.strip()
                     value = ''
                     if current_comment.strip():
-                        self._comments[key] = current_comment
+                        comments[key] = current_comment
                     current_comment = ''
                 else:
                     key, value = line.split('=', 1)
                     key = key.strip()
                     if section != self.main_section:
                         key = section + '/' + key
-                    self._values[key] = unquote_value(value.strip())
+                    values[key] = unquote_value(value.strip())
                     if current_comment.strip():
-                        self._comments[key] = current_comment
+                        comments[key] = current_comment
                     current_comment = ''
             # comments at the end of the file
             if current_comment.strip():
-                self._comments[' end '] = current_comment
+                comments[' end '] = current_comment
         finally:
             f.close()
+        snapshot = self._make_snapshot(values)
+        self._values = values
+        self._comments = comments
+        self._snapshot = snapshot
+        self._load_time = load_time
+
+    def reload(self):
+        """Re-read the configuration file in place.  Returns a set with the
+        keys whose values changed since the last reload, changes committed
+        by this process in between included, so that the caller can apply
+        them all.
+        """
+        self._lock.acquire()
+        try:
+            self._load()
+            applied_snapshot = self._applied_snapshot
+            self._applied_snapshot = self._snapshot
+        finally:
+            self._lock.release()
+        return set(key for key in self.config_vars
+                   if applied_snapshot.get(key) != self._snapshot[key])
+
+    def _make_snapshot(self, values, converted_values={}):
+        """Convert all configuration variables into a new lookup dict.  Every
+        key is available with and without the main section prefix so that
+        reads are plain dict lookups.  The dict returned is never modified
+        afterwards, changes build a new one and replace the old in one go.
+        """
+        snapshot = {}
+        prefix = self.main_section + '/'
+        for key, field in self.config_vars.iteritems():
+            if key in converted_values:
+                value = converted_values[key]
+            elif key in values:
+                value = from_string(values[key], field)
+            else:
+                value = field.get_default()
+            snapshot[key] = snapshot[prefix + key] = value
+        return snapshot
 
     def __getitem__(self, key):
         """Return the value for a key."""
-        if key.startswith('%s/' % self.main_section):
-            key = key[5:]
-        try:
-            return self._converted_values[key]
-        except KeyError:
-            field = self.config_vars[key]
-        try:
-            value = from_string(self._values[key], field)
-        except KeyError:
-            value = field.get_default()
-        self._converted_values[key] = value
-        return value
+        return self._snapshot[key]
 
     def change_single(self, key, value):
         """Create and commit a transaction for a single key-value-pair."""
@@ -230,15 +270,18 @@ class Configuration(object):
         return ConfigTransaction(self)
 
     def touch(self):
-        """Touch the file to trigger a reload."""
+        """Touch the file to trigger a configuration reload."""
         os.utime(self.filename, None)
 
     @property
     def changed_external(self):
-        """True if there are changes on the file system."""
+        """True if there are changes on the file system, or committed ones
+        that were not reloaded yet.
+        """
         if not path.isfile(self.filename):
             return False
-        return path.getmtime(self.filename) > self._load_time
+        return self._snapshot is not self._applied_snapshot or \
+               path.getmtime(self.filename) > self._load_time
 
     def __iter__(self):
         """Iterate over all keys"""
@@ -464,8 +507,16 @@ class ConfigTransaction(object):
             for section in sections:
                 section[1].sort()
 
+            # write the new configuration into a temporary file next to the
+            # real one and rename it over the old file afterwards.  That way
+            # other processes either see the old or the new file, never a
+            # partially written one.
+            folder, filename = path.split(path.abspath(self.cfg.filename))
+            tmp_filename = None
             try:
-                f = file(self.cfg.filename, 'w')
+                fd, tmp_filename = mkstemp(prefix='.%s.' % filename,
+                                           dir=folder)
+                f = os.fdopen(fd, 'w')
                 try:
                     for idx, (section, items) in enumerate(sections):
                         if '[%s]' % section in self.cfg._comments:
@@ -483,16 +534,30 @@ class ConfigTransaction(object):
                             f.write('%s = %s\n' % (key, quote_value(value)))
                     if ' end ' in self.cfg._comments:
                         f.write(self.cfg._comments[' end '])
+                    f.flush()
+                    os.fsync(f.fileno())
                 finally:
                     f.close()
-            except IOError, e:
+                if path.exists(self.cfg.filename):
+                    os.chmod(tmp_filename,
+                             os.stat(self.cfg.filename).st_mode & 0777)
+                os.rename(tmp_filename, self.cfg.filename)
+            except (IOError, OSError), e:
                 log.error('Could not write configuration: %s' % e, 'config')
+                if tmp_filename is not None and path.exists(tmp_filename):
+                    os.remove(tmp_filename)
                 raise ConfigurationTransactionError(e)
-            self.cfg._values.update(self._values)
-            self.cfg._converted_values.update(self._converted_values)
+            values = self.cfg._values.copy()
+            values.update(self._values)
+            converted_values = self._converted_values.copy()
             for key in self._remove:
-                self.cfg._values.pop(key, None)
-                self.cfg._converted_values.pop(key, None)
+                values.pop(key, None)
+                converted_values.pop(key, None)
+            # readers never see a half updated configuration, the new
+            # snapshot replaces the old one with a single assignment
+            snapshot = self.cfg._make_snapshot(values, converted_values)
+            self.cfg._values = values
+            self.cfg._snapshot = snapshot
         finally:
             self.cfg._lock.release()
         self._committed = True
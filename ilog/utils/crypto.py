@@ -5,9 +5,14 @@
 #
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
+import os
 import string
-from random import choice
+import hashlib
 from hashlib import sha1, md5
+from Queue import Queue, Full
+from random import choice
+from threading import Event, Lock, Thread
+from time import time
 
 SALT_CHARS = string.ascii_lowercase + string.digits
 SECRET_KEY_CHARS = string.ascii_letters + string.digits + string.punctuation
@@ -22,15 +27,153 @@ def gen_secret_key():
     """Generate a new secret key."""
     return ''.join(choice(SECRET_KEY_CHARS) for _ in xrange(64))
 
-def gen_pwhash(password):
-    """Return a the password encrypted in sha format with a random salt."""
+class PasswordHasher(object):
+    """Base class for the password hashing methods.  A hash is stored as
+    ``method$salt$hashval``, what the parts mean is up to the hasher.
+    Subclasses are registered with :func:`register_hasher`.
+    """
+
+    #: the name used as method in the hashes
+    name = None
+
+    #: the cost used if none is configured.  `None` for methods without
+    #: a cost parameter.
+    default_cost = None
+
+    def encode(self, password, salt, cost=None):
+        """Return the hash for a password."""
+        raise NotImplementedError()
+
+    def verify(self, pwhash, password):
+        """Check a password against a hash of this method."""
+        raise NotImplementedError()
+
+    def get_cost(self, pwhash):
+        """Return the cost a hash was created with."""
+        return None
+
+
+class _DigestHasher(PasswordHasher):
+    digest = None
+
+    def encode(self, password, salt, cost=None):
+        h = self.digest()
+        h.update(salt)
+        h.update(password)
+        return '%s$%s$%s' % (self.name, salt, h.hexdigest())
+
+    def verify(self, pwhash, password):
+        method, salt, hashval = pwhash.split('$', 2)
+        return constant_time_compare(self.encode(password, salt), pwhash)
+
+
+class PlainHasher(PasswordHasher):
+    name = 'plain'
+
+    def encode(self, password, salt, cost=None):
+        return 'plain$$%s' % password
+
+    def verify(self, pwhash, password):
+        return constant_time_compare(pwhash.split('$', 2)[2], password)
+
+
+class MD5Hasher(_DigestHasher):
+    name = 'md5'
+    digest = md5
+
+
+class SHA1Hasher(_DigestHasher):
+    name = 'sha'
+    digest = sha1
+
+
+class PBKDF2Hasher(PasswordHasher):
+    """PBKDF2 with HMAC-SHA256, hashes look like this::
+
+        pbkdf2$50000$salt$hashval
+
+    The cost is the number of iterations.
+    """
+    name = 'pbkdf2'
+    default_cost = 50000
+
+    def encode(self, password, salt, cost=None):
+        if cost is None:
+            cost = self.default_cost
+        hashval = pbkdf2_hmac('sha256', password, salt, cost)
+        return 'pbkdf2$%d$%s$%s' % (cost, salt, hashval.encode('hex'))
+
+    def verify(self, pwhash, password):
+        try:
+            method, cost, salt, hashval = pwhash.split('$', 3)
+            cost = int(cost)
+        except ValueError:
+            return False
+        return constant_time_compare(self.encode(password, salt, cost), pwhash)
+
+    def get_cost(self, pwhash):
+        try:
+            return int(pwhash.split('$', 2)[1])
+        except (IndexError, ValueError):
+            return None
+
+
+def _pbkdf2_hmac(hash_name, password, salt, iterations):
+    """Pure python fallback for `hashlib.pbkdf2_hmac` which was added in
+    Python 2.7.8.
+    """
+    import hmac
+    from struct import pack
+    digest = getattr(hashlib, hash_name)
+    mac = hmac.new(password, None, digest)
+    def prf(data):
+        h = mac.copy()
+        h.update(data)
+        return h.digest()
+    # ILog only uses keys with the length of the digest, one block
+    u = prf(salt + pack('>I', 1))
+    rv = [ord(x) for x in u]
+    for _ in xrange(iterations - 1):
+        u = prf(u)
+        rv = [x ^ ord(y) for x, y in zip(rv, u)]
+    return ''.join(chr(x) for x in rv)
+
+pbkdf2_hmac = getattr(hashlib, 'pbkdf2_hmac', _pbkdf2_hmac)
+
+
+#: the registered hashers by method name
+HASHERS = {}
+
+#: the method used for new hashes if none is configured
+DEFAULT_METHOD = 'pbkdf2'
+
+def register_hasher(hasher):
+    """Register a `PasswordHasher` instance."""
+    HASHERS[hasher.name] = hasher
+
+for hasher in PlainHasher(), MD5Hasher(), SHA1Hasher(), PBKDF2Hasher():
+    register_hasher(hasher)
+del hasher
+
+
+def constant_time_compare(a, b):
+    """Compare two strings in a time that does not depend on how many
+    characters match.
+    """
+    if len(a) != len(b):
+        return False
+    rv = 0
+    for x, y in zip(a, b):
+        rv |= ord(x) ^ ord(y)
+    return rv == 0
+
+
+def gen_pwhash(password, method=DEFAULT_METHOD, cost=None):
+    """Return the password hashed with the given method and a random salt."""
     if isinstance(password, unicode):
         password = password.encode('utf-8')
-    salt = gen_salt(6)
-    h = sha1()
-    h.update(salt)
-    h.update(password)
-    return 'sha$%s$%s' % (salt, h.hexdigest())
+    return HASHERS[method].encode(password, gen_salt(6), cost)
+
 
 def check_pwhash(pwhash, password):
     """Check a password against a given hash value. Since many forums save md5
@@ -51,20 +194,130 @@ def check_pwhash(pwhash, password):
     sha passwords::
 
         sha$123456$118083bd04c79ab51944a9ef863efcd9c048dd9a
+
+    pbkdf2 passwords::
+
+        pbkdf2$50000$123456$a6f1e35b8a7d5a4b...
+
+    Other methods can be added with :func:`register_hasher`.
     """
     if isinstance(password, unicode):
         password = password.encode('utf-8')
     if pwhash.count('$') < 2:
         return False
-    method, salt, hashval = pwhash.split('$', 2)
-    if method == 'plain':
-        return hashval == password
-    elif method == 'md5':
-        h = md5()
-    elif method == 'sha':
-        h = sha1()
-    else:
+    hasher = HASHERS.get(pwhash.split('$', 1)[0])
+    if hasher is None:
         return False
-    h.update(salt)
-    h.update(password)
-    return h.hexdigest() == hashval
+    return hasher.verify(pwhash, password)
+
+
+def pwhash_needs_update(pwhash, method=DEFAULT_METHOD, cost=None):
+    """True if the hash was not created with the given method and cost.
+    Used to rehash passwords when they are checked successfully.
+    """
+    if pwhash.split('$', 1)[0] != method:
+        return True
+    hasher = HASHERS[method]
+    if hasher.default_cost is None:
+        # the method has no cost, the configured one is for other methods
+        return False
+    if cost is None:
+        cost = hasher.default_cost
+    return hasher.get_cost(pwhash) != cost
+
+
+class HashingPoolFull(RuntimeError):
+    """Raised if too many password hashes are waiting to be calculated."""
+
+
+class HashingPool(object):
+    """A bounded pool of threads calculating password hashes.  Slow hashing
+    methods keep the request threads waiting, but the number of hashes being
+    calculated at the same time is limited and if more than `queue_size`
+    are waiting new ones are refused right away with `HashingPoolFull`.
+    `hashlib.pbkdf2_hmac` releases the GIL, so the hashes are calculated in
+    parallel.
+    """
+
+    def __init__(self, workers=4, queue_size=32):
+        self.workers = workers
+        self.queue = Queue(queue_size)
+        self._lock = Lock()
+        self._threads = []
+        self._pid = None
+
+    def _ensure_running(self):
+        # threads don't survive a fork, restart them in new processes
+        if self._pid == os.getpid():
+            return
+        self._lock.acquire()
+        try:
+            if self._pid == os.getpid():
+                return
+            self._threads = []
+            for idx in xrange(self.workers):
+                worker = Thread(target=self._work,
+                                name='ILogHashingWorker-%d' % idx)
+                worker.setDaemon(True)
+                worker.start()
+                self._threads.append(worker)
+            self._pid = os.getpid()
+        finally:
+            self._lock.release()
+
+    def stop(self, timeout=10):
+        """Stop the worker threads of this process once the hashes in the
+        queue are calculated.  They are started again when needed.
+        """
+        self._lock.acquire()
+        try:
+            threads = self._threads
+            if self._pid != os.getpid():
+                threads = []
+            for thread in threads:
+                self.queue.put((None, None, None))
+            self._threads = []
+            self._pid = None
+        finally:
+            self._lock.release()
+        deadline = time() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time()))
+
+    def _work(self):
+        while 1:
+            func, args, job = self.queue.get()
+            if func is None:
+                return
+            try:
+                job['result'] = func(*args)
+            except Exception, e:
+                job['error'] = e
+            job['done'].set()
+
+    def apply(self, func, *args):
+        """Call `func` in one of the pool's threads and return the result."""
+        self._ensure_running()
+        job = {'done': Event()}
+        try:
+            self.queue.put_nowait((func, args, job))
+        except Full:
+            raise HashingPoolFull('too many password hashes in the queue')
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['result']
+
+
+hashing_pool = HashingPool()
+
+
+def benchmark_hasher(method, cost=None, rounds=5):
+    """Return the average number of seconds it takes to check a password
+    hashed with the given method and cost.
+    """
+    pwhash = gen_pwhash('benchmark', method, cost)
+    started = time()
+    for _ in xrange(rounds):
+        check_pwhash(pwhash, 'benchmark')
+    return (time() - started) / rounds
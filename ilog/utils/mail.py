@@ -10,11 +10,16 @@
 import os
 import re
 import logging
+import simplejson
+from threading import Event, Lock, Thread
+from time import time
+from uuid import uuid4
 try:
     from email.mime.text import MIMEText
 except ImportError:
     from email.MIMEText import MIMEText
-from smtplib import SMTP, SMTPException
+from smtplib import SMTP, SMTPException, SMTPRecipientsRefused, \
+     SMTPResponseException
 from urlparse import urlparse
 
 from ilog.utils.validators import is_valid_email
@@ -46,15 +51,68 @@ def split_email(s):
 
 def send_email(subject, text, to_addrs, quiet=True):
     """Send a mail using the `EMail` class.  This will log the email instead
-    if the application configuration wants to log email.
+    if the application configuration wants to log email.  Otherwise the
+    mail is put into the outgoing mail queue and delivered in the background,
+    this function returns as soon as the mail is spooled.  If `quiet` is
+    `False` errors spooling the mail are raised.
     """
     log.debug("Sending email with subject \"%s\" to %s", subject, to_addrs)
     e = EMail(subject, text, to_addrs)
     if e.app.cfg['log_email_only']:
         return e.log()
     if quiet:
-        return e.send_quiet()
-    return e.send()
+        return e.queue_quiet()
+    return e.queue()
+
+
+def open_smtp_connection(app):
+    """Open a new connection to the SMTP server configured for the
+    application.  If configured TLS is started and the connection is
+    authenticated.
+    """
+    try:
+        log.debug("Connecting to %s:%d", app.cfg['smtp_host'],
+                  app.cfg['smtp_port'])
+        smtp = SMTP(app.cfg['smtp_host'], app.cfg['smtp_port'])
+    except SMTPException, e:
+        log.exception(e)
+        raise RuntimeError(str(e))
+
+    if app.cfg['smtp_use_tls']:
+        log.debug("Starting TLS communication.")
+        #smtp.set_debuglevel(1)
+        smtp.ehlo()
+        if not smtp.esmtp_features.has_key('starttls'):
+            # XXX: untranslated because python exceptions do not support
+            # unicode messages.
+            raise RuntimeError('TLS enabled but server does not '
+                               'support TLS')
+        smtp.starttls()
+        smtp.ehlo()
+
+    if app.cfg['smtp_user']:
+        try:
+            log.debug("Authenticating with user \"%s\"",
+                      app.cfg['smtp_user'])
+            smtp.login(app.cfg['smtp_user'], app.cfg['smtp_password'])
+        except SMTPException, e:
+            log.exception(e)
+            raise RuntimeError(str(e))
+    return smtp
+
+
+def close_smtp_connection(app, smtp):
+    """Close a connection opened with `open_smtp_connection`."""
+    if app.cfg['smtp_use_tls']:
+        # avoid false failure detection when the server closes
+        # the SMTP connection with TLS enabled
+        import socket
+        try:
+            smtp.quit()
+        except socket.sslerror:
+            pass
+    else:
+        smtp.quit()
 
 
 class EMail(object):
@@ -119,37 +177,8 @@ class EMail(object):
             f.close()
 
     def send(self):
-        """Send the message."""
-        try:
-            log.debug("Sending email through %s:%d", self.app.cfg['smtp_host'],
-                      self.app.cfg['smtp_port'])
-            smtp = SMTP(self.app.cfg['smtp_host'], self.app.cfg['smtp_port'])
-        except SMTPException, e:
-            log.exception(e)
-            raise RuntimeError(str(e))
-
-        if self.app.cfg['smtp_use_tls']:
-            log.debug("Starting TLS communication.")
-            #smtp.set_debuglevel(1)
-            smtp.ehlo()
-            if not smtp.esmtp_features.has_key('starttls'):
-                # XXX: untranslated because python exceptions do not support
-                # unicode messages.
-                raise RuntimeError('TLS enabled but server does not '
-                                   'support TLS')
-            smtp.starttls()
-            smtp.ehlo()
-
-        if self.app.cfg['smtp_user']:
-            try:
-                log.debug("Authenticating with user \"%s\"",
-                          self.app.cfg['smtp_user'])
-                smtp.login(self.app.cfg['smtp_user'],
-                           self.app.cfg['smtp_password'])
-            except SMTPException, e:
-                log.exception(e)
-                raise RuntimeError(str(e))
-
+        """Send the message right away, bypassing the mail queue."""
+        smtp = open_smtp_connection(self.app)
         msgtext = self.format()
         try:
             try:
@@ -157,16 +186,19 @@ class EMail(object):
             except SMTPException, e:
                 raise RuntimeError(str(e))
         finally:
-            if self.app.cfg['smtp_use_tls']:
-                # avoid false failure detection when the server closes
-                # the SMTP connection with TLS enabled
-                import socket
-                try:
-                    smtp.quit()
-                except socket.sslerror:
-                    pass
-            else:
-                smtp.quit()
+            close_smtp_connection(self.app, smtp)
+
+    def queue(self):
+        """Put the message into the application's mail queue."""
+        self.app.mail_queue.put(self)
+
+    def queue_quiet(self):
+        """Queue the message, swallowing exceptions."""
+        try:
+            return self.queue()
+        except Exception:
+            log.exception('Could not queue email')
+            return
 
     def send_quiet(self):
         """Send the message, swallowing exceptions."""
@@ -175,5 +207,257 @@ class EMail(object):
         except Exception:
             return
 
+
+class MailQueue(object):
+    """The outgoing mail queue of an application.  Messages are spooled to
+    a folder in the instance folder (``new/``) and delivered by a pool of
+    worker threads.  Each worker keeps its SMTP connection open and sends
+    all the messages waiting in the spool over it before it goes idle.
+
+    A worker claims a message by moving it to ``cur/``.  Moves are atomic,
+    so several processes can work on the same spool.  Messages that fail
+    temporarily go back to ``new/`` with their number of attempts in the
+    filename and, as modification time, the time of the next attempt, which
+    is put off longer after every failure.  Messages refused by the server
+    for good, or that failed `max_attempts` times, end up in ``failed/``.
+    """
+
+    #: number of messages a worker claims at once
+    batch_size = 20
+
+    #: seconds between two looks into the spool if nobody wakes us up
+    poll_interval = 10
+
+    #: seconds an idle SMTP connection is kept open
+    idle_timeout = 60
+
+    #: seconds a message may stay claimed before it's considered abandoned
+    claim_timeout = 600
+
+    #: seconds before the first retry of a message, doubled for every retry
+    retry_delay = 60
+
+    #: the longest time in seconds between two attempts
+    max_retry_delay = 3600
+
+    #: the attempts after which a message is given up
+    max_attempts = 10
+
+    def __init__(self, app):
+        self.app = app
+        self.path = os.path.join(app.instance_folder,
+                                 app.cfg['mail_spool_path'])
+        for folder in 'tmp', 'new', 'cur', 'failed':
+            folder = os.path.join(self.path, folder)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._lock = Lock()
+        self._workers = []
+        self._pid = None
+
+    def put(self, email):
+        """Spool an `EMail` for delivery."""
+        data = simplejson.dumps({
+            'from':     email.from_addr,
+            'to':       email.to_addrs,
+            'message':  email.format().decode('utf-8')
+        })
+        # write to tmp/ first so that workers never see partial files
+        filename = '%d.%s' % (time() * 1000, uuid4().hex)
+        tmp_filename = os.path.join(self.path, 'tmp', filename)
+        f = open(tmp_filename, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp_filename, os.path.join(self.path, 'new', filename))
+        self.ensure_running()
+        self._wakeup.set()
+
+    def __len__(self):
+        """The number of messages waiting for delivery."""
+        return len(os.listdir(os.path.join(self.path, 'new')))
+
+    def ensure_running(self):
+        """Start the worker threads if they are not running in this process.
+        Threads don't survive a fork which is why the process id is checked.
+        """
+        if self._pid == os.getpid() or self._stopped.isSet():
+            return
+        self._lock.acquire()
+        try:
+            if self._pid == os.getpid() or self._stopped.isSet():
+                return
+            self._workers = []
+            for idx in xrange(max(1, self.app.cfg['mail_workers'])):
+                worker = Thread(target=self._work,
+                                name='ILogMailWorker-%d' % idx)
+                worker.setDaemon(True)
+                worker.start()
+                self._workers.append(worker)
+            self._pid = os.getpid()
+        finally:
+            self._lock.release()
+
+    def stop(self, timeout=10):
+        """Stop the worker threads of this process.  The messages a worker
+        is delivering are finished, the others stay in the spool.  Waits up
+        to `timeout` seconds for each worker.
+        """
+        self._lock.acquire()
+        try:
+            self._stopped.set()
+            self._wakeup.set()
+            workers = self._workers
+            if self._pid != os.getpid():
+                # the threads of the parent process don't exist here
+                workers = []
+            self._workers = []
+        finally:
+            self._lock.release()
+        for worker in workers:
+            worker.join(timeout)
+
+    def _claim(self):
+        """Claim up to `batch_size` spooled messages."""
+        self._release_abandoned()
+        claimed = []
+        now = time()
+        new_folder = os.path.join(self.path, 'new')
+        for filename in sorted(os.listdir(new_folder)):
+            new_filename = os.path.join(new_folder, filename)
+            cur_filename = os.path.join(self.path, 'cur', filename)
+            try:
+                if os.path.getmtime(new_filename) > now:
+                    # waiting for its next attempt
+                    continue
+                # the claim time, renaming keeps the modification time
+                # which `_release_abandoned` looks at
+                os.utime(new_filename, None)
+                os.rename(new_filename, cur_filename)
+            except OSError:
+                # another worker was faster
+                continue
+            claimed.append(cur_filename)
+            if len(claimed) >= self.batch_size:
+                break
+        return claimed
+
+    def _release_abandoned(self):
+        """Put messages back that were claimed by a worker that died."""
+        cur_folder = os.path.join(self.path, 'cur')
+        deadline = time() - self.claim_timeout
+        for filename in os.listdir(cur_folder):
+            cur_filename = os.path.join(cur_folder, filename)
+            try:
+                if os.path.getmtime(cur_filename) < deadline:
+                    os.rename(cur_filename,
+                              os.path.join(self.path, 'new', filename))
+            except OSError:
+                pass
+
+    def _deliver(self, smtp, filename):
+        f = open(filename)
+        try:
+            data = simplejson.load(f)
+        finally:
+            f.close()
+        try:
+            smtp.sendmail(data['from'].encode('utf-8'),
+                          [x.encode('utf-8') for x in data['to']],
+                          data['message'].encode('utf-8'))
+        except SMTPRecipientsRefused, e:
+            self._fail(filename, e)
+        except SMTPResponseException, e:
+            # the sender or the message was refused, for good if the
+            # server answered with a 5xx code
+            if e.smtp_code >= 500:
+                self._fail(filename, e)
+            else:
+                self._retry(filename, e)
+        else:
+            os.remove(filename)
+
+    def _fail(self, filename, error):
+        log.error('Mail %s refused by the server: %s', filename, error)
+        os.rename(filename, os.path.join(self.path, 'failed',
+                                         os.path.basename(filename)))
+
+    def _retry(self, filename, error):
+        """Put a claimed message back for a later attempt or give it up
+        if it failed too often.
+        """
+        parts = os.path.basename(filename).split('.')
+        attempts = 1
+        if len(parts) > 2:
+            attempts = int(parts[2]) + 1
+        if attempts >= self.max_attempts:
+            log.error('Giving up mail %s after %d attempts', filename,
+                      attempts)
+            self._fail(filename, error)
+            return
+        retry_at = time() + min(self.retry_delay * 2 ** (attempts - 1),
+                                self.max_retry_delay)
+        os.utime(filename, (retry_at, retry_at))
+        os.rename(filename, os.path.join(self.path, 'new', '%s.%s.%d' % (
+            parts[0], parts[1], attempts)))
+
+    def _work(self):
+        smtp = None
+        last_used = 0
+        while not self._stopped.isSet():
+            self._wakeup.wait(self.poll_interval)
+            if self._stopped.isSet():
+                break
+            self._wakeup.clear()
+            claimed = []
+            try:
+                claimed = self._claim()
+                while claimed:
+                    if smtp is not None and time() - last_used > 5:
+                        # the server might have dropped the idle connection
+                        try:
+                            smtp.noop()
+                        except Exception:
+                            smtp = None
+                    if smtp is None:
+                        smtp = open_smtp_connection(self.app)
+                    while claimed:
+                        self._deliver(smtp, claimed[0])
+                        claimed.pop(0)
+                    last_used = time()
+                    if self._stopped.isSet():
+                        break
+                    claimed = self._claim()
+            except Exception, e:
+                log.exception('Could not deliver queued mails')
+                # give the messages back, the next try might work better
+                for filename in claimed:
+                    try:
+                        self._retry(filename, e)
+                    except OSError:
+                        pass
+                if smtp is not None:
+                    try:
+                        smtp.close()
+                    except Exception:
+                        pass
+                    smtp = None
+                continue
+            if smtp is not None and time() - last_used > self.idle_timeout:
+                try:
+                    close_smtp_connection(self.app, smtp)
+                except Exception:
+                    pass
+                smtp = None
+        if smtp is not None:
+            try:
+                close_smtp_connection(self.app, smtp)
+            except Exception:
+                pass
+
+
 # circular imports
 from ilog.application import get_application
@@ -6,14 +6,15 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 
-from ilog.views import account, admin, base, networks
+from ilog.views import account, admin, base, channels, networks
 from ilog.views.admin import options
 from ilog.views.admin.manage import (users, groups, networks as admin_networks,
-                                     channels, bots)
+                                     channels as admin_channels, bots)
 
 all_views = {
     # Main Handler
     'index'             : base.index,
+    'metrics'           : base.metrics,
 
     # Account Handlers
     'account.rpx'           : account.rpx_post,
@@ -31,8 +32,8 @@ all_views = {
     'network.channels'  : networks.channels,
 
     # Channel Handlers
-    'channel.index'     : '',
-    'channel.browse'    : '',
+    'channel.index'     : channels.index,
+    'channel.browse'    : channels.browse,
 
     # Administration
     'admin.index'                   : admin.index,
@@ -184,8 +184,9 @@ def register(request):
 
         account = User(username=request.form.get('username'),
                        email=request.form.get('email'),
-                       display_name=request.form.get('display_name'),
-                       passwd=request.form.get('new_password'))
+                       display_name=request.form.get('display_name'))
+        # hashed during the validation
+        account.passwd_hash = form.password_hash
         account.set_activation_key()
         account.providers.add(
             Provider(identifier=request.form.get('identifier'),
@@ -246,11 +247,8 @@ def rpx_providers_post(request, token=None):
     return redirect_to('account.profile')
 
 def activate_account(request, key):
-    # Delete too old activations
-    old_registrations = User.query.too_old_activations().delete()
-    log.debug("Deleted %d old expired account registrations",
-              old_registrations)
-    account = User.query.filter(User.activation_key==key).first()
+    # too old activations are deleted by the `expire_activations` job
+    account = User.query.by_activation_key(key)
     if not account:
         flash("No account could be activated. Maybe it was too old.", "error")
         return redirect_back('index')
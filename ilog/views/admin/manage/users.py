@@ -21,10 +21,127 @@ def render_accounts_view(template_name, *args, **kwargs):
                               *args, **kwargs)
 
 
+#: the number of users shown on one page of the list
+USERS_PER_PAGE = 50
+
+#: the columns the list can be sorted by
+SORT_COLUMNS = {
+    'username': User.username,
+    'email':    User.email,
+    'id':       User.id
+}
+
+
+def _parse_cursor(cursor, sort):
+    """A cursor is the sort value and the id of a user separated by a
+    colon, the id always comes last.  A user without a sort value, that is
+    without an email address, has only the id as cursor.
+    """
+    try:
+        if sort == 'email' and u':' not in cursor:
+            return None, int(cursor)
+        value, user_id = cursor.rsplit(u':', 1)
+        user_id = int(user_id)
+        if sort == 'id':
+            value = int(value)
+    except ValueError:
+        raise NotFound()
+    return value, user_id
+
+
+def _make_cursor(user, sort):
+    value = getattr(user, sort)
+    if value is None:
+        return unicode(user.id)
+    return u'%s:%d' % (value, user.id)
+
+
+def get_users_page(sort='username', descending=False, search=None,
+                   cursor=None, backwards=False, limit=USERS_PER_PAGE):
+    """Return one page of users and whether there are more in the direction
+    of the paging.  The pages are addressed by the sort value and id of the
+    last user of the previous page (or the first user of the next page if
+    paging `backwards`), so every page is an index range scan no matter how
+    deep in the list it is.  The groups and providers shown in the list
+    are loaded in the same query.  Users without an email address come
+    last when sorting by address, in either order.
+    """
+    column = SORT_COLUMNS[sort]
+    query = User.query.options(
+        db.eagerload('groups'), db.eagerload('providers'),
+        db.undefer('email'), db.undefer('register_date'))
+    if search:
+        query = query.prefix_search(search)
+
+    # going backwards is going forward in the reversed order
+    forward = descending == backwards
+    nullable = sort == 'email'
+    if cursor is not None:
+        value, user_id = _parse_cursor(cursor, sort)
+        if forward:
+            after_id = User.id > user_id
+        else:
+            after_id = User.id < user_id
+        if value is None:
+            # only users without an address follow, unless going back
+            criterion = db.and_(column == None, after_id)
+            if backwards:
+                criterion = db.or_(criterion, column != None)
+        else:
+            if forward:
+                criterion = column > value
+            else:
+                criterion = column < value
+            criterion = db.or_(criterion, db.and_(column == value, after_id))
+            if nullable and not backwards:
+                criterion = db.or_(criterion, column == None)
+        query = query.filter(criterion)
+    if nullable:
+        # NULLs sort differently in every database, they're put last
+        # explicitly
+        missing = db.case([(column == None, 1)], else_=0)
+        query = query.order_by(backwards and missing.desc() or missing.asc())
+    if forward:
+        query = query.order_by(column.asc(), User.id.asc())
+    else:
+        query = query.order_by(column.desc(), User.id.desc())
+
+    users = query.limit(limit + 1).all()
+    has_more = len(users) > limit
+    users = users[:limit]
+    if backwards:
+        users.reverse()
+    return users, has_more
+
+
 @require_privilege(ILOG_ADMIN)
 def list(request):
-    users = User.query.all()
-    return render_accounts_view('list.html', users=users)
+    sort = request.args.get('sort')
+    if sort not in SORT_COLUMNS:
+        sort = 'username'
+    descending = request.args.get('order') == 'desc'
+    search = request.args.get('q', u'').strip() or None
+    after = request.args.get('after')
+    before = request.args.get('before')
+
+    users, has_more = get_users_page(sort, descending, search,
+                                     before or after, bool(before))
+    if before:
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after is not None, has_more
+
+    args = {'sort': sort, 'order': descending and 'desc' or 'asc'}
+    if search:
+        args['q'] = search
+    prev_args = next_args = None
+    if users and has_prev:
+        prev_args = dict(args, before=_make_cursor(users[0], sort))
+    if users and has_next:
+        next_args = dict(args, after=_make_cursor(users[-1], sort))
+    return render_accounts_view('list.html', users=users, sort=sort,
+                                descending=descending, search=search or u'',
+                                prev_args=prev_args, next_args=next_args)
 
 
 @require_privilege(ILOG_ADMIN)
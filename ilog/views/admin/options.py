@@ -75,6 +75,7 @@ class BasicOptionsForm(_ConfigForm):
     language        = config_field('language', label=_(u'Language'))
     timezone        = config_field('timezone', label=_(u'Timezone'))
     cookie_name     = config_field('cookie_name', label=_(u'Cookie Name'))
+    session_store   = config_field('session_store', label=_(u'Session Store'))
 
 
 class AdvancedOptionsForm(_ConfigForm):
@@ -87,6 +88,10 @@ class AdvancedOptionsForm(_ConfigForm):
                                        label=_(u'Maintenance Mode'))
     passthrough_errors  = config_field('passthrough_errors',
                                        label=_(u'Passtrough Errors'))
+    password_hash_method = config_field('password_hash_method',
+                                        label=_(u'Password Hash Method'))
+    password_hash_cost  = config_field('password_hash_cost',
+                                       label=_(u'Password Hash Cost'))
 
 
 class CacheOptionsForm(_ConfigForm):
@@ -111,6 +116,7 @@ class EmailOptionsForm(_ConfigForm):
     smtp_from_name  = config_field('smtp_port', label=_(u'From Name'))
     smtp_use_tls    = config_field('smtp_use_tls', label=_(u'Use TLS'))
     log_email_only  = config_field('log_email_only', label=_(u'Log Email Only'))
+    mail_workers    = config_field('mail_workers', label=_(u'Mail Workers'))
     email_signature = config_field('email_signature',
                                    label=_(u'Email Signature'),
                                    widget=forms.Textarea)
@@ -6,10 +6,14 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 
-from ilog.application import (get_request, render_response, url_for,
-                              add_metanav_item, add_navbar_item)
+from werkzeug.exceptions import NotFound
+
+from ilog import metrics as _metrics
+from ilog.application import (Response, get_request, render_response,
+                              url_for, add_metanav_item, add_navbar_item)
 from ilog.database import Channel
 from ilog.i18n import _
+from ilog.utils.crypto import constant_time_compare
 from ilog.privileges import ILOG_ADMIN, ENTER_ADMIN_PANEL, ENTER_ACCOUNT_PANEL
 
 #def render_view(template_name, _active_menu_item='network.index', **values):
@@ -108,3 +112,30 @@ from ilog.privileges import ILOG_ADMIN, ENTER_ADMIN_PANEL, ENTER_ACCOUNT_PANEL
 def index(request):
     channels_count = Channel.query.count()
     return render_response('index.html', channels_count=channels_count)
+
+def _may_scrape_metrics(request):
+    if request.user.is_admin:
+        return True
+    token = request.app.cfg['metrics_token']
+    if token:
+        scheme, _, value = request.headers.get('Authorization', '') \
+            .partition(' ')
+        if scheme.lower() == 'bearer' and \
+           constant_time_compare(value.strip(), token.encode('utf-8')):
+            return True
+    # behind a proxy all requests come from the proxy, the address the
+    # proxy forwards can be forged by the client
+    if request.is_behind_proxy:
+        return False
+    return request.remote_addr in request.app.cfg['metrics_allowed_hosts']
+
+def metrics(request):
+    """The metrics of all processes for Prometheus.  Only the
+    administrators, scrapers with the configured token and, unless ILog
+    runs behind a proxy, the configured hosts may see them.
+    """
+    if not _may_scrape_metrics(request):
+        raise NotFound()
+    _metrics.mail_queue_depth.set(len(request.app.mail_queue))
+    return Response(_metrics.generate_latest(),
+                    content_type=_metrics.CONTENT_TYPE)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from datetime import date, datetime, timedelta
+
+from werkzeug.exceptions import NotFound
+
+from ilog.application import Response, render_response
+from ilog.database import db, Channel, IrcEvent, Network
+from ilog.utils.http import redirect_to
+
+#: the number of events shown on one page of a day
+EVENTS_PER_PAGE = 500
+
+
+def get_channel_or_404(network, channel):
+    channel = Channel.query.join(Network).filter(db.and_(
+        Network.slug == network, Channel.name == channel)).first()
+    if channel is None:
+        raise NotFound()
+    return channel
+
+
+def get_day_period(year, month=None, day=None):
+    """Return the start and the end of the period the URL arguments point
+    to.  The days are UTC days, the same the events are stored in.
+    """
+    try:
+        start = date(year, month or 1, day or 1)
+    except ValueError:
+        raise NotFound()
+    if day is not None:
+        end = start + timedelta(days=1)
+    elif month is not None:
+        end = date(year + month // 12, month % 12 + 1, 1)
+    else:
+        end = date(year + 1, 1, 1)
+    return (datetime(start.year, start.month, start.day),
+            datetime(end.year, end.month, end.day))
+
+
+def make_period_response(request, channel, start, end, page):
+    """If the period is over its events never change again.  In that case
+    return a response with a strong etag, derived from the number of events
+    and the id of the last one, and the stamp of the last event as last
+    modified date.  If the client has that version already the response
+    is a ``304 Not Modified`` one, otherwise the caller renders the page
+    into it.  For periods that are still running `None` is returned.
+
+    The pages are rendered for the user, in their locale and timezone and
+    with their navigation, so the etag includes those and the response may
+    only be cached by the browser.
+    """
+    if end > datetime.utcnow():
+        return None
+    count, last_id, last_stamp = db.session.query(
+        db.func.count(IrcEvent.id), db.func.max(IrcEvent.id),
+        db.func.max(IrcEvent.stamp)
+    ).filter(db.and_(IrcEvent.channel_id == channel.id,
+                     IrcEvent.stamp >= start,
+                     IrcEvent.stamp < end)).one()
+    response = Response()
+    response.set_etag('channel-%d-%s-%s-%d-%d-%d-%d-%s-%s' % (
+        channel.id, start.strftime('%Y%m%d'), end.strftime('%Y%m%d'),
+        count, last_id or 0, page, request.user.id or 0, request.locale,
+        request.tz_info.zone))
+    if last_stamp is not None:
+        if last_stamp.tzinfo is not None:
+            last_stamp = last_stamp.replace(tzinfo=None) - \
+                         last_stamp.utcoffset()
+        response.last_modified = last_stamp.replace(microsecond=0)
+    else:
+        response.last_modified = end
+    response.cache_control.private = True
+    response.headers['Vary'] = 'Cookie'
+    response.make_conditional(request)
+    return response
+
+
+def index(request, network, channel):
+    get_channel_or_404(network, channel)
+    today = datetime.utcnow()
+    return redirect_to('channel.browse', network=network, channel=channel,
+                       year=today.year, month=today.month, day=today.day)
+
+
+def browse(request, network, channel, year, month=None, day=None, page=1):
+    if page < 1:
+        raise NotFound()
+    channel = get_channel_or_404(network, channel)
+    start, end = get_day_period(year, month, day)
+
+    # answer the conditional requests for the past periods before doing
+    # any of the heavy work
+    response = make_period_response(request, channel, start, end, page)
+    if response is not None and response.status_code == 304:
+        return response
+
+    events = IrcEvent.query.filter(db.and_(
+        IrcEvent.channel_id == channel.id,
+        IrcEvent.stamp >= start,
+        IrcEvent.stamp < end
+    )).options(db.eagerload('identity')) \
+      .order_by(IrcEvent.stamp, IrcEvent.id) \
+      .offset((page - 1) * EVENTS_PER_PAGE).limit(EVENTS_PER_PAGE + 1).all()
+    if page > 1 and not events:
+        raise NotFound()
+    has_next = len(events) > EVENTS_PER_PAGE
+
+    rendered = render_response('channels/browse.html', channel=channel,
+                               network=network, start=start, end=end,
+                               events=events[:EVENTS_PER_PAGE], year=year,
+                               month=month, day=day, page=page,
+                               has_next=has_next)
+    if response is None:
+        return rendered
+    response.data = rendered.data
+    response.mimetype = rendered.mimetype
+    return response